@@ -19,97 +19,510 @@
 
 from __future__ import print_function, unicode_literals
 
+import bisect
 import datetime
 import os
 import subprocess
 import sys
 import time
-import tempfile
-import cPickle as pickle
-import textwrap
 from collections import defaultdict
+from uuid import UUID
 
+import btrfs_ioctl
+from cleaner import (
+    Cleaner,
+    format_size,
+    get_targets,
+)
+from extents import estimate_tree
 from fstab import Fstab
-from dpkg_history import DpkgHistory
+from groups import (
+    SnapshotGroup,
+    read_group_config,
+)
+from journal import Journal
+from locking import (
+    LockTimeout,
+    NullLock,
+    VolumeLock,
+)
+from metrics import (
+    HISTORY_FILE,
+    RunHistory,
+    collect,
+    read_metrics_dir,
+    write_textfile,
+)
+from mounts import (
+    RUN_DIR,
+    TOP_LEVEL_OPTIONS,
+    find_top_level_mount,
+)
+from precheck import (
+    COALESCE_CACHE,
+    CONFIG_CACHE,
+    apt_config,
+    coalesce_window,
+    last_snapshot_time,
+    save_last_snapshot_time,
+    supported,
+)
 import snapshots
 from snapshots import (
     Snapshot,
     SNAP_PREFIX,
     PARENT_LINK, 
     CHANGES_FILE, 
+    TRASH_DIR,
+)
+from sizes import (
+    SIZES_FILE,
+    SizeCache,
+    walk,
 )
+from space import (
+    SpaceGuard,
+    measure,
+    read_space_config,
+)
+from storage import DiskStorage
+
 
+# how many subvolumes to pass to a single "btrfs subvolume delete"
+DELETE_BATCH_SIZE = 100
+COMMIT_MODES = ("after", "each")
 
 NO_HISTORY = {'purge': [], 'upgrade': [], 'auto-install': [], 'remove': [],
     'install': []}
 
 
-def supported(fstab="/etc/fstab"):
-    """ verify that the system supports apt btrfs snapshots
-        by checking if the right fs layout is used etc
-    """
-    # check for the helper binary
-    if not os.path.exists("/sbin/btrfs"):
-        return False
-    # check the fstab
-    fstab = Fstab(fstab)
-    entry = fstab.get_supported_btrfs_root_fstab_entry()
-    return entry is not None
-
-
 class LowLevelCommands(object):
     """ lowlevel commands invoked to perform various tasks like
         interact with mount and btrfs tools
     """
-    def mount(self, fs_spec, mountpoint):
-        ret = subprocess.call(["mount", fs_spec, mountpoint])
+    def mount(self, fs_spec, mountpoint, options=None):
+        if options is None:
+            ret = subprocess.call(["mount", fs_spec, mountpoint])
+        else:
+            ret = subprocess.call(["mount", "-o", options, fs_spec,
+                                   mountpoint])
+        return ret == 0
+
+    def make_private(self, mountpoint):
+        ret = subprocess.call(["mount", "--make-private", mountpoint])
         return ret == 0
 
     def umount(self, mountpoint):
         ret = subprocess.call(["umount", mountpoint])
         return ret == 0
 
-    def btrfs_subvolume_snapshot(self, source, dest):
-        ret = subprocess.call(["btrfs", "subvolume", "snapshot",
-                               source, dest])
+    def btrfs_subvolume_snapshot(self, source, dest, readonly=False):
+        cmd = ["btrfs", "subvolume", "snapshot"]
+        if readonly:
+            cmd.append("-r")
+        ret = subprocess.call(cmd + [source, dest])
         return ret == 0
 
     def btrfs_delete_snapshot(self, snapshot):
         ret = subprocess.call(["btrfs", "subvolume", "delete", snapshot])
         return ret == 0
 
+    def btrfs_subvolume_sync(self, path, timeout=None):
+        """ wait until the deleted subvolumes have really gone, or for
+            timeout seconds at most
+        """
+        try:
+            sync = subprocess.Popen(["btrfs", "subvolume", "sync", path])
+        except OSError:
+            return False
+        if timeout is None:
+            return sync.wait() == 0
+        deadline = time.time() + timeout
+        while sync.poll() is None:
+            if time.time() >= deadline:
+                sync.kill()
+                sync.wait()
+                return False
+            time.sleep(0.1)
+        return sync.returncode == 0
+
+    def btrfs_filesystem_sync(self, path):
+        """ commit the current transaction of the filesystem """
+        try:
+            ret = subprocess.call(["btrfs", "filesystem", "sync", path])
+        except OSError:
+            return False
+        return ret == 0
+
+    def btrfs_subvolume_generation(self, path):
+        """ return the uuid of the subvolume at path and the generation in
+            which it was last written to, or None if btrfs won't say
+        """
+        try:
+            output = subprocess.check_output(
+                ["btrfs", "subvolume", "show", path])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        fields = {}
+        for line in output.decode("utf-8").splitlines():
+            key, sep, value = line.partition(":")
+            if sep:
+                fields.setdefault(key.strip(), value.strip())
+        try:
+            return fields["UUID"], int(fields["Generation"])
+        except (KeyError, ValueError):
+            return None
+
+    def btrfs_subvolume_list(self, path):
+        """ return the id, generation and uuid of each subvolume of the
+            volume mounted at path by name, or None if btrfs won't say
+        """
+        try:
+            output = subprocess.check_output(
+                ["btrfs", "subvolume", "list", "-u", path])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        subvolumes = {}
+        for line in output.decode("utf-8").splitlines():
+            # ID 257 gen 12 top level 5 uuid 0f7f... path @apt-snapshot-...
+            fields, sep, name = line.partition(" path ")
+            fields = fields.split()
+            try:
+                subvolumes[name] = (int(fields[1]), int(fields[3]),
+                                    fields[fields.index("uuid") + 1])
+            except (IndexError, ValueError):
+                continue
+        return subvolumes
+
+    def btrfs_qgroup_show(self, path):
+        """ return the exclusive and referenced bytes of each subvolume by
+            id, or None unless quotas are enabled on the volume at path
+        """
+        try:
+            with open(os.devnull, "w") as devnull:
+                output = subprocess.check_output(
+                    ["btrfs", "qgroup", "show", "--raw", path],
+                    stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        qgroups = {}
+        for line in output.decode("utf-8").splitlines():
+            # qgroupid rfer excl
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].startswith("0/"):
+                continue
+            try:
+                qgroups[int(fields[0][2:])] = (int(fields[2]), int(fields[1]))
+            except ValueError:
+                continue
+        return qgroups
+
+    def btrfs_space(self, path):
+        """ return the unallocated bytes of the filesystem at path and how
+            many more bytes of metadata it can hold, or None if btrfs won't
+            say
+        """
+        try:
+            output = subprocess.check_output(
+                ["btrfs", "filesystem", "usage", "-b", path])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        unallocated = metadata = None
+        ratio = 1.0
+        for line in output.decode("utf-8").splitlines():
+            key, sep, value = line.strip().partition(":")
+            if key == "Device unallocated":
+                unallocated = int(value.split()[0])
+            elif key == "Metadata ratio":
+                ratio = float(value.split()[0])
+            elif key.startswith("Metadata,"):
+                fields = dict(f.strip().split(":", 1)
+                              for f in value.split("(")[0].split(","))
+                metadata = int(fields["Size"]) - int(fields["Used"])
+        if unallocated is None or metadata is None:
+            return None
+        return unallocated, metadata + int(unallocated / ratio)
+
+    def btrfs_delete_snapshots(self, snapshots, commit=None):
+        """ delete several snapshots using one btrfs call per batch,
+            commit may be "after" or "each", see btrfs-subvolume(8).
+            Returns the list of those that could not be deleted.
+        """
+        failed = []
+        for i in range(0, len(snapshots), DELETE_BATCH_SIZE):
+            batch = snapshots[i:i + DELETE_BATCH_SIZE]
+            cmd = ["btrfs", "subvolume", "delete"]
+            if commit is not None:
+                cmd.append("--commit-%s" % commit)
+            ret = subprocess.call(cmd + batch)
+            if ret != 0:
+                # btrfs carries on after an error, so see what is left
+                failed.extend([p for p in batch if os.path.lexists(p)])
+        return failed
+
+
+class IoctlCommands(LowLevelCommands):
+    """ lowlevel commands that talk to the kernel directly through the btrfs
+        ioctls and the mount syscall instead of forking the btrfs tools.
+        Falls back to the subprocess based commands if the kernel says no.
+    """
+    def _sync(self, path):
+        try:
+            btrfs_ioctl.sync(path)
+        except OSError:
+            pass
+
+    def mount(self, fs_spec, mountpoint, options=None):
+        try:
+            btrfs_ioctl.mount(fs_spec, mountpoint, data=options)
+        except OSError:
+            return super(IoctlCommands, self).mount(fs_spec, mountpoint,
+                                                    options)
+        return True
+
+    def make_private(self, mountpoint):
+        try:
+            btrfs_ioctl.make_private(mountpoint)
+        except OSError:
+            return super(IoctlCommands, self).make_private(mountpoint)
+        return True
+
+    def umount(self, mountpoint):
+        try:
+            btrfs_ioctl.umount(mountpoint)
+        except OSError:
+            return super(IoctlCommands, self).umount(mountpoint)
+        return True
+
+    def btrfs_subvolume_snapshot(self, source, dest, readonly=False):
+        try:
+            btrfs_ioctl.snapshot(source, dest, readonly)
+        except OSError:
+            return super(IoctlCommands, self).btrfs_subvolume_snapshot(
+                source, dest, readonly)
+        return True
+
+    def btrfs_delete_snapshot(self, snapshot):
+        try:
+            btrfs_ioctl.destroy(snapshot)
+        except OSError:
+            return super(IoctlCommands, self).btrfs_delete_snapshot(snapshot)
+        return True
+
+    def btrfs_filesystem_sync(self, path):
+        try:
+            btrfs_ioctl.sync(path)
+        except OSError:
+            return super(IoctlCommands, self).btrfs_filesystem_sync(path)
+        return True
+
+    def btrfs_subvolume_generation(self, path):
+        try:
+            info = btrfs_ioctl.subvol_info(path)
+        except OSError:
+            return super(IoctlCommands, self).btrfs_subvolume_generation(
+                path)
+        return "%s" % UUID(bytes=bytes(bytearray(info.uuid))), \
+            info.generation
+
+    def btrfs_space(self, path):
+        try:
+            free = btrfs_ioctl.unallocated(path)
+            spaces = btrfs_ioctl.space_info(path)
+        except OSError:
+            return super(IoctlCommands, self).btrfs_space(path)
+        metadata = None
+        for space in spaces:
+            if space.flags & btrfs_ioctl.BTRFS_BLOCK_GROUP_METADATA:
+                metadata = space.total_bytes - space.used_bytes + \
+                    free // btrfs_ioctl.copies(space.flags)
+        if metadata is None:
+            return super(IoctlCommands, self).btrfs_space(path)
+        return free, metadata
+
+    def btrfs_delete_snapshots(self, snapshots, commit=None):
+        failed = []
+        for snapshot in snapshots:
+            try:
+                btrfs_ioctl.destroy(snapshot)
+            except OSError:
+                failed.append(snapshot)
+                continue
+            if commit == "each":
+                self._sync(os.path.dirname(snapshot))
+        if commit == "after" and len(failed) < len(snapshots):
+            self._sync(os.path.dirname(snapshots[0]))
+        if len(failed) > 0:
+            failed = super(IoctlCommands, self).btrfs_delete_snapshots(
+                failed, commit)
+        return failed
+
+
+class SimulatedCommands(LowLevelCommands):
+    """ the commands for a volume simulated by a MemoryStorage, whose
+        subvolumes it makes and deletes. There is nothing to mount and
+        nothing known of generations, sizes or free space.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def mount(self, fs_spec, mountpoint, options=None):
+        return True
+
+    def make_private(self, mountpoint):
+        return True
+
+    def umount(self, mountpoint):
+        return True
+
+    def btrfs_subvolume_snapshot(self, source, dest, readonly=False):
+        return self.storage.snapshot(source, dest, readonly)
+
+    def btrfs_delete_snapshot(self, snapshot):
+        return self.storage.delete(snapshot)
+
+    def btrfs_subvolume_sync(self, path, timeout=None):
+        return True
+
+    def btrfs_filesystem_sync(self, path):
+        return True
+
+    def btrfs_subvolume_generation(self, path):
+        return None
+
+    def btrfs_subvolume_list(self, path):
+        return None
+
+    def btrfs_qgroup_show(self, path):
+        return None
+
+    def btrfs_space(self, path):
+        return None
+
+    def btrfs_delete_snapshots(self, snapshots, commit=None):
+        return [s for s in snapshots if not self.storage.delete(s)]
+
+
+BACKENDS = {
+    "subprocess": LowLevelCommands,
+    "ioctl": IoctlCommands,
+}
+
+
+def get_commands(backend="auto"):
+    """ return the lowlevel commands for the given backend, "auto" picks
+        the ioctl backend whenever it is usable
+    """
+    if backend == "auto":
+        if btrfs_ioctl.is_available():
+            backend = "ioctl"
+        else:
+            backend = "subprocess"
+    if backend not in BACKENDS:
+        raise Exception("Unknown backend '%s'" % backend)
+    return BACKENDS[backend]()
+
 
 class AptBtrfsSnapshot(object):
     """ the high level object that interacts with the snapshot system """
 
-    def __init__(self, fstab="/etc/fstab", sandbox=None):
+    def __init__(self, fstab="/etc/fstab", sandbox=None,
+                 backend="subprocess", persistent_mount=False, group=None,
+                 read_only=None, space_guard=None, storage=None):
         self.fstab = Fstab(fstab)
-        self.commands = LowLevelCommands()
-        # if we haven't been given a testing ground to play in, mount the real
+        # where the snapshots and their metadata are read and written, a
+        # MemoryStorage simulates the whole volume, subvolumes included
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+        if storage.simulated:
+            self.commands = SimulatedCommands(storage)
+            if sandbox is None:
+                sandbox = storage.mp
+        else:
+            self.commands = get_commands(backend)
+        # if we haven't been given a testing ground to play in, use the real
         # root volume
         self.test = sandbox is not None
+        self.temporary_mp = False
         self.mp = sandbox
         if self.mp is None:
-            uuid = self.fstab.uuid_for_mountpoint("/")
+            self.mp = self._mount_root_volume(persistent_mount)
+        snapshots.setup(self.mp, self.storage)
+        # apt's settings for us, see _get_config
+        self.config = None
+        # the subvolumes snapshotted along with @
+        if group is None:
+            group = [] if self.test else read_group_config(self._get_config())
+        self.group = SnapshotGroup(self.mp, self.commands, group,
+                                   self.storage)
+        # whether create makes read-only snapshots by default
+        if read_only is None:
+            read_only = (not self.test and
+                         snapshots.read_only_config(self._get_config()))
+        self.read_only = read_only
+        # checks there is room before each snapshot, see _get_space_guard
+        self.space_guard = space_guard
+
+    def _get_config(self):
+        """ apt's configuration under APT::Snapshots, apt-config is asked
+            once at most, and outside test mode not again until apt's
+            configuration changes
+        """
+        if self.config is None:
+            self.config = apt_config(None if self.test else CONFIG_CACHE)
+        return self.config
+
+    def reload(self):
+        """ read the snapshots on the volume again """
+        snapshots.setup(self.mp, self.storage)
+
+    def _mount_root_volume(self, persistent):
+        """ return where the top level of the root volume is mounted, if it
+            isn't mount it, either under RUN_DIR where it stays mounted for
+            the next run, or on a temporary mountpoint that close() unmounts
+        """
+        uuid = self.fstab.uuid_for_mountpoint("/")
+        mountpoint = find_top_level_mount(uuid)
+        if mountpoint is not None:
+            return mountpoint
+        if persistent:
+            mountpoint = RUN_DIR
+            if not os.path.isdir(mountpoint):
+                os.makedirs(mountpoint, 0o700)
+        else:
+            import tempfile
             mountpoint = tempfile.mkdtemp(prefix="apt-btrfs-snapshot-mp-")
-            if not self.commands.mount(uuid, mountpoint):
+        if not self.commands.mount(uuid, mountpoint, TOP_LEVEL_OPTIONS):
+            if not persistent:
                 os.rmdir(mountpoint)
-                raise Exception("Unable to mount root volume")
-            self.mp = mountpoint
-        snapshots.setup(self.mp)
+            raise Exception("Unable to mount root volume")
+        if persistent:
+            self.commands.make_private(mountpoint)
+        else:
+            self.temporary_mp = True
+        return mountpoint
 
-    def __del__(self):
-        """ unmount root volume if necessary """
-        # This will probably not get run if there are cyclic references.
-        # check thoroughly because we get called even if __init__ fails
-        if not self.test and self.mp is not None:
-            res = self.commands.umount(self.mp)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """ unmount the root volume if it was mounted just for us """
+        if self.temporary_mp and self.mp is not None:
+            self.commands.umount(self.mp)
             os.rmdir(self.mp)
             self.mp = None
+            self.temporary_mp = False
 
-    def _get_now_str(self):
-        return datetime.datetime.now().replace(microsecond=0).isoformat(
-            str('_'))
+    def __del__(self):
+        # a last resort, use close() or a with statement instead.
+        # check thoroughly because we get called even if __init__ fails
+        if getattr(self, "temporary_mp", False):
+            self.close()
 
     def _parse_older_than_to_datetime(self, timefmt):
         if isinstance(timefmt, datetime.datetime):
@@ -121,52 +534,83 @@ class AptBtrfsSnapshot(object):
         return now - datetime.timedelta(days)
         
     def _get_last_snapshot_time(self):
-        last_snapshot = datetime.datetime.fromtimestamp(0.0)
         if self.test:
             last_snapshot_file = '/tmp/apt_last_snapshot'
         else:
             last_snapshot_file = '/run/apt_last_snapshot'
+        return datetime.datetime.fromtimestamp(
+            last_snapshot_time(last_snapshot_file))
 
-        if os.path.exists(last_snapshot_file):
-            try:
-                t = open(last_snapshot_file)
-                last_snapshot = \
-                datetime.datetime.fromtimestamp(float(t.readline()))
-            except:
-                # If we fail to read the timestamp for some reason, just return
-                # the default value silently
-                pass
-            finally:
-                t.close()
-        return last_snapshot
-
-    def _save_last_snapshot_time(self):
+    def _save_last_snapshot_time(self, when):
         if self.test:
             last_snapshot_file = '/tmp/apt_last_snapshot'
         else:
             last_snapshot_file = '/run/apt_last_snapshot'
-        f = open(last_snapshot_file, 'w')
-        f.write(str(time.time()))
-        f.close()
+        save_last_snapshot_time(when, last_snapshot_file)
+
+    def _get_generation(self):
+        """ the uuid and generation of @ """
+        return self.commands.btrfs_subvolume_generation(
+            os.path.join(self.mp, "@"))
+
+    def _get_var_location(self):
+        """ where the dpkg logs are """
+        if self.test:
+            testdir = os.path.dirname(os.path.abspath(__file__))
+            if not testdir.endswith("test"):
+                testdir = os.path.join(testdir, "test")
+            return os.path.join(testdir, "data/var")
+        return "/var/"
 
     def _get_status(self):
-        
+        from dpkg_history import DpkgHistory
         parent = Snapshot("@").parent
         if parent is not None:
             date_parent = parent.date
         else:
             date_parent = None
-        if self.test:
-            testdir = os.path.dirname(os.path.abspath(__file__))
-            if not testdir.endswith("test"):
-                testdir = os.path.join(testdir, "test")
-            var_location = os.path.join(testdir, "data/var")
-            history = DpkgHistory(since = date_parent, 
-                var_location = var_location)
+        actions = Journal(os.path.join(self.mp, "@"), self.storage).actions()
+        if actions is not None:
+            history = DpkgHistory.from_actions(actions,
+                self._get_var_location(), date_parent)
         else:
-            history = DpkgHistory(since = date_parent)
+            history = DpkgHistory(since = date_parent,
+                var_location = self._get_var_location())
         return parent, history
 
+    def _finalise_changes(self, snapshot):
+        """ work out the changes of a new snapshot in a detached process so
+            that apt can get on with its job. Should it die, the changes are
+            worked out the next time they are read.
+        """
+        self._in_background(snapshot.finalise_changes)
+
+    def _in_background(self, work):
+        """ call work() in a detached process, or right away if it can't be
+            done later. The child lets go of whatever it inherited, notably
+            the lock on the volume.
+        """
+        if self.test or self.temporary_mp:
+            # our mountpoint would be gone before the child is done
+            work()
+            return
+        try:
+            pid = os.fork()
+        except OSError:
+            work()
+            return
+        if pid != 0:
+            return
+        try:
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            os.closerange(3, os.sysconf(str("SC_OPEN_MAX")))
+            work()
+        finally:
+            os._exit(0)
+
     def _prettify_changes(self, history, i_indent="- ", s_indent="    "):
         if history == None or history == NO_HISTORY:
             return [i_indent + "No packages operations recorded"]
@@ -180,6 +624,7 @@ class AptBtrfsSnapshot(object):
                 packages = ", ".join(packages)
                 if sys.stdout.isatty():
                     # if we are in a terminal, wrap text to match its width
+                    import textwrap
                     rows, columns = os.popen('stty size', 'r').read().split()
                     packages = textwrap.wrap(packages, width=int(columns), 
                         initial_indent=s_indent, subsequent_indent=s_indent,
@@ -191,7 +636,7 @@ class AptBtrfsSnapshot(object):
         """ show current root's parent and recent changes """
         return self.show("@")
     
-    def show(self, snapshot, compact=False):
+    def show(self, snapshot, compact=False, sizes=False):
         """ show details pertaining to given snapshot """
         snapshot = Snapshot(snapshot)
         if snapshot.name == "@":
@@ -216,6 +661,10 @@ class AptBtrfsSnapshot(object):
             if snapshot.name != "@":
                 print(mainline)
             print("Parent: %s" % parent)
+            if sizes and snapshot.name != "@":
+                found = self._get_sizes([snapshot])
+                print("Size: %s" % self._describe_size(
+                    found.get(snapshot.name)))
             if parent == "unknown" and snapshot.name == "@":
                 print("dpkg history shown for the last 30 days")
             print("dpkg history:")
@@ -225,8 +674,14 @@ class AptBtrfsSnapshot(object):
         
         return True
     
-    def create(self, tag=""):
-        """ create a new apt-snapshot of @, tagging it if a tag is given """
+    def create(self, tag="", force=False, read_only=None):
+        """ create a new apt-snapshot of @, tagging it if a tag is given.
+            Untagged snapshots are skipped when the last one is recent or
+            nothing has been written to @ since its parent was made, unless
+            forced. Read-only snapshots keep their metadata in META_DIR.
+        """
+        if read_only is None:
+            read_only = self.read_only
         if 'APT_NO_SNAPSHOTS' in os.environ and tag == "":
             print("Shell variable APT_NO_SNAPSHOTS found, skipping creation")
             return True
@@ -234,55 +689,214 @@ class AptBtrfsSnapshot(object):
             print("Shell variable APT_NO_SNAPSHOTS found, but tag supplied, "
                 "creating snapshot")
         last = self._get_last_snapshot_time()
+        when = time.time()
+        now = datetime.datetime.fromtimestamp(when)
+        if self.test:
+            window = coalesce_window()
+        else:
+            window = coalesce_window(COALESCE_CACHE)
 
         # If there is a recent snapshot and no tag supplied, skip creation
-        if tag == "" \
-        and last > datetime.datetime.now() - datetime.timedelta(seconds=60):
+        if tag == "" and not force \
+        and last > now - datetime.timedelta(seconds=window):
             print("A recent snapshot already exists: %s" % last)
             return True
         
-        # make snapshot
-        snap_id = SNAP_PREFIX + self._get_now_str() + tag
-        res = self.commands.btrfs_subvolume_snapshot(
-            os.path.join(self.mp, "@"),
-            os.path.join(self.mp, snap_id))
+        # nor if @ is as it was when its parent was made
+        parent = Snapshot("@").parent
+        if tag == "" and not force and parent is not None \
+        and parent.generation is not None \
+        and parent.generation == self._get_generation() \
+        and self.group.unchanged_since(parent.name):
+            print("Nothing has changed since %s, skipping creation" % parent)
+            return True
+        
+        # nor if the volume is nearly full and no room can be made in time
+        if not self._make_room(parent):
+            print("WARNING: not enough free space, no snapshot was taken")
+            return True
+        
+        # make snapshot, closing the journal's account of the changes
+        snap_id = snapshots.new_name(tag, now)
+        journal = Journal(os.path.join(self.mp, "@"), self.storage)
+        journal.mark(snap_id)
+        res = self.group.snapshot(snap_id, readonly=read_only)
+        journal.compact()
+        if read_only:
+            snapshots.make_sidecar(snap_id)
+            Snapshot(snap_id).parent = parent
         
         # set root's new parent
         Snapshot("@").parent = snap_id
         
-        # find and store dpkg changes
-        parent, history = self._get_status()
-        Snapshot(snap_id).changes = history
+        # store dpkg changes straight from the journal, else note which to
+        # store, they are worked out from the logs later
+        since = None
+        if parent is not None:
+            since = parent.date
+        snapshot = Snapshot(snap_id)
+        actions = Journal(os.path.join(self.mp, snap_id),
+                          self.storage).actions(closed=True)
+        if actions is not None:
+            from dpkg_history import DpkgHistory
+            snapshot.changes = DpkgHistory.from_actions(actions,
+                self._get_var_location(), since)
+        else:
+            snapshot.mark_changes_pending(since, datetime.datetime.now(),
+                                          self._get_var_location())
+            self._finalise_changes(snapshot)
         
-        self._save_last_snapshot_time()
+        # remember how @ was, once our own writes to it are committed
+        generation = None
+        if self.commands.btrfs_filesystem_sync(self.mp):
+            generation = self._get_generation()
+            self.group.record_generations(snap_id)
+        snapshot.generation = generation
+        
+        self._save_last_snapshot_time(when)
         return res
     
+    def _get_space_guard(self):
+        """ the SpaceGuard given, else one set up as apt's configuration
+            says, there is none in test mode unless given
+        """
+        if self.space_guard is None and not self.test:
+            try:
+                self.space_guard = SpaceGuard(
+                    **read_space_config(self._get_config()))
+            except Exception as e:
+                print("WARNING: %s, using the defaults" % e)
+                self.space_guard = SpaceGuard()
+        return self.space_guard
+
+    def _make_room(self, keep):
+        """ return whether there is room for a new snapshot, deleting the
+            oldest untagged snapshots but keep if need be
+        """
+        guard = self._get_space_guard()
+        if guard is None:
+            return True
+        # branch points are kept, as by every other automatic deletion
+        candidates = [s for s in snapshots.get_list()
+                      if s.tag == "" and not s == keep and
+                      len(s.children) < 2]
+
+        def prune(snapshot, timeout):
+            # only what was just trashed, then wait for the cleaner to free
+            # it, but no longer than timeout
+            path = self._check_deletable(snapshot)
+            if path is None:
+                return
+            snapshot.will_delete()
+            trashed = []
+            self._trash([path], trashed)
+            if (self._delete_many(trashed, commit="after") and
+                    self.commands.btrfs_subvolume_sync(self.mp,
+                                                       timeout=timeout)):
+                # the space the cleaner freed is free once committed
+                self.commands.btrfs_filesystem_sync(self.mp)
+
+        return guard.admit(lambda: measure(self.mp, self.commands),
+                           candidates, prune)
+
     def tag(self, snapshot, tag):
         """ Adds/replaces the tag for the given snapshot """
         children = Snapshot(snapshot).children
 
-        pos = len(SNAP_PREFIX)
-        new_name = snapshot[:pos + 19] + tag
+        new_name = SNAP_PREFIX + Snapshot(snapshot).stamp + tag
         old_snap = os.path.join(self.mp, snapshot)
         new_snap = os.path.join(self.mp, new_name)
-        os.rename(old_snap, new_snap)
+        self.storage.rename(old_snap, new_snap)
+        snapshots.rename_sidecar(snapshot, new_name)
+        self.group.rename(snapshot, new_name)
         
         tagged = Snapshot(new_name)
         for child in children:
             child.parent = tagged
         return True
 
-    def list(self):
+    def list(self, sizes=False):
         # The function name will not clash with reserved keywords. It is only
         # accessible via self.list()
         print("Available snapshots:")
-        print("  \n".join(snapshots.get_list()))
+        snapshot_list = snapshots.get_list()
+        if not sizes:
+            print("  \n".join(s.name for s in snapshot_list))
+            return True
+        found = self._get_sizes(snapshot_list)
+        for s in snapshot_list:
+            print("%s  (%s)" % (s.name,
+                                self._describe_size(found.get(s.name))))
+        self._note_missing_sizes(snapshot_list, found)
         return True
 
+    def _get_sizes(self, snapshot_list, walk_missing=True):
+        """ return the exclusive and referenced bytes of the given snapshots
+            by name, from the qgroups when quotas are enabled, else from the
+            extent walk. Its results are cached, the snapshots missing from
+            the cache are walked in the background and left out meanwhile,
+            or just left out unless walk_missing.
+        """
+        subvolumes = self.commands.btrfs_subvolume_list(self.mp)
+        if subvolumes is None:
+            subvolumes = {}
+        qgroups = None
+        if len(subvolumes) > 0:
+            qgroups = self.commands.btrfs_qgroup_show(self.mp)
+        if qgroups is not None:
+            return dict((s.name, qgroups[subvolumes[s.name][0]])
+                        for s in snapshot_list
+                        if s.name in subvolumes and
+                        subvolumes[s.name][0] in qgroups)
+        cache = SizeCache(os.path.join(self.mp, SIZES_FILE),
+                          [s.name for s in snapshots.get_list()], self.storage)
+        found = {}
+        jobs = []
+        for s in snapshot_list:
+            key = None
+            if s.name in subvolumes:
+                key = "%s:%d" % (subvolumes[s.name][2], subvolumes[s.name][1])
+            cached = cache.get(s.name, key)
+            if cached is not None:
+                found[s.name] = cached
+            else:
+                jobs.append((s.name, os.path.join(self.mp, s.name), key))
+        if len(jobs) > 0 and walk_missing:
+            if self.test or self.temporary_mp:
+                found.update(walk(cache, jobs))
+            else:
+                self._in_background(lambda: self._walk_sizes(cache, jobs))
+        return found
+
+    def _walk_sizes(self, cache, jobs):
+        """ walk the snapshots of jobs unless another walk is under way """
+        lock = VolumeLock(cache.path + ".lock", timeout=0)
+        try:
+            lock.acquire()
+        except LockTimeout:
+            return
+        try:
+            walk(cache, jobs)
+        finally:
+            lock.release()
+
+    def _describe_size(self, size):
+        if size is None:
+            return "size not known yet"
+        return "%s exclusive, %s referenced" % (format_size(size[0]),
+                                                format_size(size[1]))
+
+    def _note_missing_sizes(self, snapshot_list, found):
+        missing = len([s for s in snapshot_list if s.name not in found])
+        if missing > 0:
+            print("The sizes of %d snapshots are being worked out, ask "
+                  "again later" % missing)
+
     def list_older_than(self, timefmt):
         older_than = self._parse_older_than_to_datetime(timefmt)
         print("Available snapshots older than '%s':" % timefmt)
-        print("  \n".join(snapshots.get_list(older_than=older_than)))
+        print("  \n".join(s.name for s in
+                         snapshots.get_list(older_than=older_than)))
         return True
 
     def _prompt_for_tag(self):
@@ -300,11 +914,11 @@ class AptBtrfsSnapshot(object):
         snapshot = Snapshot(snapshot)
         new_root = os.path.join(self.mp, snapshot.name)
         if (
-                os.path.isdir(new_root) and
+                self.storage.isdir(new_root) and
                 snapshot.name.startswith(SNAP_PREFIX)):
             default_root = os.path.join(self.mp, "@")
             staging = os.path.join(self.mp, "@apt-btrfs-staging")
-            if os.path.lexists(staging):
+            if self.storage.lexists(staging):
                 raise Exception("Reserved directory @apt-btrfs-staging "
                     "exists\nPlease remove from btrfs volume root before "
                     "trying again")
@@ -313,23 +927,32 @@ class AptBtrfsSnapshot(object):
             date, history = self._get_status()
             Snapshot("@").changes = history
                 
-            # snapshot the requested default so as not to remove it
+            # snapshot the requested default so as not to remove it, and
+            # the members of its group, before anything live is touched
             res = self.commands.btrfs_subvolume_snapshot(new_root, staging)
             if not res:
                 raise Exception("Could not create snapshot")
+            try:
+                members = self.group.stage(snapshot.name, staging)
+            except Exception:
+                self._delete_many([staging])
+                raise
 
             # make backup name
-            backup = os.path.join(self.mp, 
-                SNAP_PREFIX + self._get_now_str()) + tag
-            # if backup name is already in use, wait a sec and try again
-            if os.path.exists(backup):
-                time.sleep(1)
-                backup = os.path.join(self.mp, 
-                    SNAP_PREFIX + self._get_now_str())
+            backup = os.path.join(self.mp, snapshots.new_name(tag))
 
             # move everything into place
-            os.rename(default_root, backup)
-            os.rename(staging, default_root)
+            moves = [(default_root, backup), (staging, default_root)]
+            try:
+                moves.extend(self.group.moves(members,
+                                              os.path.basename(backup),
+                                              staging))
+                self._swap(moves)
+            except OSError as e:
+                self._delete_many([staging] + [staging + m for m in members])
+                self.group.forget(os.path.basename(backup))
+                raise Exception("Could not put %s in place, nothing was "
+                                "changed: %s" % (snapshot.name, e))
             
             # remove @/etc/apt-btrfs-changes & set root's new parent
             new_default = Snapshot("@")
@@ -344,6 +967,20 @@ class AptBtrfsSnapshot(object):
                   "\"%s\"" % SNAP_PREFIX)
         return True
 
+    def _swap(self, moves):
+        """ rename each (old, new) of moves in turn. If one fails, those
+            done are undone and the error raised
+        """
+        done = []
+        try:
+            for old, new in moves:
+                self.storage.rename(old, new)
+                done.append((old, new))
+        except OSError:
+            for old, new in reversed(done):
+                self.storage.rename(new, old)
+            raise
+
     def rollback(self, number=1, tag=""):
         back_to = Snapshot("@")
         for i in range(number):
@@ -353,76 +990,255 @@ class AptBtrfsSnapshot(object):
                 return False
         return self.set_default(back_to, tag)
 
-    def delete(self, snapshot):
-        snapshot = Snapshot(snapshot)
-        to_delete = os.path.join(self.mp, snapshot.name)
-        res = True
-        if (
-                os.path.isdir(to_delete) and
+    def _check_deletable(self, snapshot):
+        """ return the path of the snapshot if it may be deleted """
+        path = os.path.join(self.mp, snapshot.name)
+        if (self.storage.isdir(path) and
                 snapshot.name.startswith(SNAP_PREFIX)):
-            
-            # correct parent links and combine change info
-            parent = snapshot.parent
-            children = snapshot.children
-            old_history = snapshot.changes
-            
-            # clean-ups in the global vars of 
-            snapshots.list_of.remove(snapshot)
-            if parent != None and parent.name in snapshots.children:
-                snapshots.children[parent.name].remove(snapshot)
-            
-            for child in children:
-                child.parent = parent
-                
-                # and do the same again in the global vars of snapshots
-                # messy but necessary for delete_older_than to work
-                snapshots.parents[child.name] = parent
-                if parent != None:
-                    snapshots.children[parent.name].append(child) # necessary
-                
-                newer_history = child.changes
-                if old_history == None:
-                    combined = newer_history
-                elif newer_history == None:
-                    combined = None
-                else:
-                    combined = old_history + newer_history
-                child.changes = combined
-            
-            res = self.commands.btrfs_delete_snapshot(to_delete)
-        else:
-            print("You have selected an invalid snapshot. Please make sure "
-                  "that it exists, and that its name starts with "
-                  "\"%s\"" % SNAP_PREFIX)
-        return res
-    
-    def delete_older_than(self, timefmt):
+            return path
+        print("You have selected an invalid snapshot. Please make sure "
+              "that it exists, and that its name starts with "
+              "\"%s\"" % SNAP_PREFIX)
+        return None
+
+    def _delete_many(self, paths, commit=None):
+        """ delete the given subvolumes in as few btrfs calls as possible """
+        if len(paths) == 0:
+            return True
+        failed = self.commands.btrfs_delete_snapshots(paths, commit=commit)
+        for path in failed:
+            print("Failed to delete %s" % os.path.basename(path))
+        return len(failed) == 0
+
+    def _trash(self, paths, trashed=None):
+        """ move subvolumes into the trash, a rename is all it takes, the
+            actual deletion is left to reclaim(). Where they went is added
+            to trashed if given
+        """
+        from exporter import EXPORT_DIR
+        trash = os.path.join(self.mp, TRASH_DIR)
+        if len(paths) > 0 and not self.storage.isdir(trash):
+            self.storage.mkdir(trash)
+        for path in paths:
+            name = os.path.basename(path)
+            # the members of its group go too
+            moves = [(path, name)]
+            moves.extend((member, "%s.%s" % (name, os.path.basename(member)))
+                         for member in self.group.member_paths(name))
+            # and its read-only clone, which pins as much as it does
+            clone = os.path.join(self.mp, EXPORT_DIR, name)
+            if self.storage.isdir(clone):
+                moves.append((clone, "%s.export" % name))
+            for source, name in moves:
+                dest = os.path.join(trash, name)
+                i = 1
+                while self.storage.lexists(dest):
+                    dest = os.path.join(trash, "%s.%d" % (name, i))
+                    i += 1
+                self.storage.rename(source, dest)
+                if trashed is not None:
+                    trashed.append(dest)
+            snapshots.remove_sidecar(os.path.basename(path))
+            self.group.forget(os.path.basename(path))
+        return True
+
+    def delete(self, snapshot, dry_run=False):
+        snapshot = Snapshot(snapshot)
+        to_delete = self._check_deletable(snapshot)
+        if to_delete is None:
+            return True
+        if dry_run:
+            estimate = estimate_tree(to_delete)
+            for member in self.group.member_paths(snapshot.name):
+                estimate_tree(member, estimate)
+            print("Deleting %s would free about %s of its %s" % (
+                snapshot.name, format_size(estimate.freed),
+                format_size(estimate.bytes)))
+            return True
+        # correct parent links and combine change info
+        snapshot.will_delete()
+        return self._trash([to_delete])
+
+    def delete_older_than(self, timefmt, throttle=None):
         older_than = self._parse_older_than_to_datetime(timefmt)
-        res = True
         list_of = snapshots.get_list(older_than=older_than)
         list_of.sort(key = lambda x: x.date, reverse = True)
+        to_delete = []
         for snap in list_of:
             if len(snap.children) < 2 and snap.tag == "":
-                res &= self.delete(snap)
+                path = self._check_deletable(snap)
+                if path is not None:
+                    snap.will_delete()
+                    to_delete.append(path)
+        res = self._trash(to_delete)
+        if throttle is not None:
+            # in maintenance mode free the space straight away
+            res &= self.reclaim(throttle=throttle)
         return res
-    
+
     def prune(self, snapshot):
         snapshot = Snapshot(snapshot)
-        res = True
         if len(snapshot.children) != 0:
             raise Exception("Snapshot is not the end of a branch")
+        to_delete = []
         while True:
             parent = snapshot.parent
-            res &= self.delete(snapshot)
+            path = self._check_deletable(snapshot)
+            if path is not None:
+                snapshot.will_delete()
+                to_delete.append(path)
             snapshot = parent
             if snapshot == None or len(snapshot.children) != 0:
                 break
+        return self._trash(to_delete)
+
+    def maintain(self, policy, dry_run=False, commit=None, throttle=None):
+        """ apply the retention policy and reclaim the space of the deleted
+            snapshots, all in one go
+        """
+        # branch points are kept, as delete-older-than does
+        protect = set(s for s in snapshots.get_list() if len(s.children) > 1)
+        protect.add(Snapshot("@").parent)
+        keep, delete = policy.plan(snapshots.get_list(), protect=protect)
+        print("Keeping %d snapshots, deleting %d" % (len(keep), len(delete)))
+        if dry_run:
+            for snap in delete:
+                print("Would delete %s" % snap.name)
+            return True
+        to_delete = []
+        for snap in delete:
+            path = self._check_deletable(snap)
+            if path is not None:
+                snap.will_delete()
+                to_delete.append(path)
+        res = self._trash(to_delete)
+        res &= self.reclaim(commit=commit, throttle=throttle)
+        return res
+
+    def reclaim(self, commit=None, throttle=None):
+        """ destroy the deleted snapshots waiting in the trash, if a throttle
+            is given the deletions are paced and those left over when its
+            budget runs out stay in the trash until next time
+        """
+        trash = os.path.join(self.mp, TRASH_DIR)
+        if not self.storage.isdir(trash):
+            return True
+        victims = [os.path.join(trash, e)
+                   for e in sorted(self.storage.listdir(trash))]
+        if throttle is None:
+            res = self._delete_many(victims, commit)
+        else:
+            results = []
+            left = throttle.run(victims,
+                lambda batch: results.append(self._delete_many(batch, commit)),
+                between=lambda: self.commands.btrfs_subvolume_sync(
+                    self.mp, timeout=throttle.time_left()))
+            if len(left) > 0:
+                print("Time is up, %d snapshots left in the trash" % len(left))
+            res = all(results) and len(left) == 0
+        if res:
+            try:
+                self.storage.rmdir(trash)
+            except OSError:
+                # something was deleted meanwhile, it can wait until next time
+                pass
         return res
     
-    def tree(self):
+    def export(self, destination, names=None, receive=False,
+               compress=True):
+        """ send the snapshots named, or all of them, to destination as
+            incremental streams where possible
+        """
+        from exporter import (
+            Exporter,
+            FileSink,
+            ReceiveSink,
+        )
+        all_snapshots = snapshots.get_list()
+        if names:
+            snapshot_list = []
+            for name in names:
+                snapshot = Snapshot(name)
+                if snapshot not in all_snapshots:
+                    print("You have selected an invalid snapshot: %s" % name)
+                    return False
+                snapshot_list.append(snapshot)
+        else:
+            snapshot_list = all_snapshots
+        if receive:
+            sink = ReceiveSink(destination)
+        else:
+            sink = FileSink(destination, compress)
+        exporter = Exporter(self.mp, self.commands, sink,
+                            storage=self.storage)
+        return exporter.export(snapshot_list, all_snapshots)
+
+    def record_run(self, command, seconds, ok):
+        """ remember how long command took and whether it succeeded, for
+            the metrics
+        """
+        path = os.path.join(self.mp, HISTORY_FILE)
+        # held for a moment, the volume lock may not be
+        if self.storage.simulated:
+            lock = NullLock()
+        else:
+            lock = VolumeLock(path + ".lock", timeout=5)
+        try:
+            with lock:
+                history = RunHistory(path, self.storage)
+                history.observe(command, seconds, ok)
+                history.save()
+        except (IOError, OSError, LockTimeout) as e:
+            print("WARNING: unable to save the run history: %s" % e)
+
+    def metrics(self, directory=None, auto=False, quick=False):
+        """ write the metrics of the snapshots to the textfile collector's
+            directory. With auto, as after create and maintain, nothing is
+            written unless the directory exists and failing is no error.
+            With quick, as after create, btrfs isn't asked for anything and
+            the sizes are the ones last saved by the extent walk.
+        """
+        if directory is None:
+            directory = read_metrics_dir(self._get_config())
+        if auto and not os.path.isdir(directory):
+            return True
+        snapshot_list = snapshots.get_list()
+        trash = os.path.join(self.mp, TRASH_DIR)
+        in_trash = 0
+        if self.storage.isdir(trash):
+            in_trash = len(self.storage.listdir(trash))
+        if quick:
+            cache = SizeCache(os.path.join(self.mp, SIZES_FILE),
+                              [s.name for s in snapshot_list], self.storage)
+            found = cache.known()
+        else:
+            # no walking, only the sizes known already
+            found = self._get_sizes(snapshot_list, walk_missing=False)
+        metrics = collect(snapshot_list, Snapshot("@").parent,
+                          history=RunHistory(os.path.join(self.mp,
+                                                          HISTORY_FILE),
+                                             self.storage),
+                          trash=in_trash, sizes=found, space=measure(self.mp))
+        try:
+            path = write_textfile(directory, metrics.text())
+        except (IOError, OSError) as e:
+            print("%s: unable to write the metrics: %s" % (
+                "WARNING" if auto else "ERROR", e))
+            return auto
+        if not auto:
+            print("Metrics written to %s" % path)
+        return True
+
+    def tree(self, sizes=False):
         date_parent, history = self._get_status()
-        tree = TreeView(history)
+        found = None
+        if sizes:
+            snapshot_list = snapshots.get_list()
+            found = self._get_sizes(snapshot_list)
+        tree = TreeView(history, found)
         tree.print()
+        if sizes:
+            self._note_missing_sizes(snapshot_list, found)
     
     def recent(self, number, snapshot):
         print("%s and its predecessors. Showing %d snapshots.\n" % (snapshot, 
@@ -437,19 +1253,51 @@ class AptBtrfsSnapshot(object):
                 print()
         return True
     
-    def clean(self, what="apt-cache"):
-        snapshot_list = snapshots.get_list()
-        for snapshot in snapshot_list:
-            path = os.path.join(self.mp, snapshot.name)
-            if what == "apt-cache":
-                path = os.path.join(path, "var/cache/apt/archives")
-                if not os.path.exists(path):
-                    continue
-                dirlist = os.listdir(path)
-                for f in dirlist:
-                    fpath = os.path.join(path, f)
-                    if f.endswith(".deb") and os.path.lexists(fpath):
-                        os.remove(fpath)
+    def clean(self, what="apt-cache", throttle=None, dry_run=False,
+              workers=4, estimate=True):
+        """ remove the files of the given clean targets from all snapshots,
+            see cleaner.TARGETS. Unless estimate is False, files whose data
+            is all still used by the same file in @ are skipped.
+        """
+        cleaner = Cleaner(get_targets(what), dry_run=dry_run, workers=workers,
+                          estimate=estimate, live=os.path.join(self.mp, "@"))
+        snapshot_list = []
+        for s in snapshots.get_list():
+            if snapshots.has_sidecar(s.name):
+                print("Skipping read-only snapshot %s" % s.name)
+            else:
+                snapshot_list.append((s.name, os.path.join(self.mp, s.name)))
+        reports = []
+        if throttle is None:
+            reports = cleaner.clean(snapshot_list)
+        else:
+            left = throttle.run(snapshot_list,
+                lambda batch: reports.extend(cleaner.clean(batch)))
+            if len(left) > 0:
+                print("Time is up, %d snapshots left to clean" % len(left))
+        if dry_run:
+            verb = "Would remove"
+        else:
+            verb = "Removed"
+        files = size = freed = 0
+        for report in reports:
+            if report.skipped > 0:
+                print("Skipped %d shared files (%s) in %s" % (report.skipped,
+                    format_size(report.skipped_bytes), report.name))
+            if report.files == 0:
+                continue
+            files += report.files
+            size += report.bytes
+            freed += report.freed
+            print("%s %d files (%s) from %s" % (verb, report.files,
+                format_size(report.bytes), report.name))
+        if freed != size:
+            print("%s %d files (%s, about %s freed) in total" % (verb, files,
+                format_size(size), format_size(freed)))
+        else:
+            print("%s %d files (%s) in total" % (verb, files,
+                format_size(size)))
+        return True
 
 
 class Junction(object):
@@ -463,8 +1311,9 @@ class Junction(object):
 class TreeView(object):
     """ TreeView pretty printer """
     
-    def __init__(self, latest_changes):
+    def __init__(self, latest_changes, sizes=None):
         self.latest_changes = latest_changes
+        self.sizes = sizes
     
     def _print_up_to_junction(self, snapshot):
         """ walks up the snapshot tree until the next one has more than one 
@@ -473,7 +1322,8 @@ class TreeView(object):
         padding = self._spacer()
         
         while True:
-            print(padding + str(snapshot) + self._brief_changes(snapshot))
+            print(padding + str(snapshot) + self._brief_changes(snapshot) +
+                  self._brief_size(snapshot))
             snapshot = snapshot.parent
             if snapshot == None or len(snapshot.children) > 1:
                 return snapshot
@@ -498,30 +1348,60 @@ class TreeView(object):
             out = ["none"]
         return " (" + " ".join(out) + ")"
     
+    def _brief_size(self, snapshot):
+        if self.sizes is None or snapshot.name == "@":
+            return ""
+        if snapshot.name not in self.sizes:
+            return " [?]"
+        return " [%s]" % format_size(self.sizes[snapshot.name][0])
+    
     def _spacer(self, stop_before_column=None):
         connected = u"│  "
         orphan = u"   "
         spacer = ""
         if stop_before_column == None:
             stop_before_column = self.column
+        orphans = set(self.orphans)
         for col in range(1, stop_before_column):
-            if col in self.orphans:
+            if col in orphans:
                 spacer += orphan
             else:
                 spacer += connected
         return spacer
     
+    def _newest_and_oldest(self):
+        """ the newest and oldest junctions waiting for branches, the same
+            ones sorting the junctions by date would give, without sorting
+        """
+        if len(self.junctions) == 0:
+            return None, None
+        ends = []
+        for date, pick in ((self.dates[-1], -1), (self.dates[0], 0)):
+            found = self.by_date[date]
+            if len(found) > 1:
+                # ties go the way a stable sort of the junctions leaves them
+                found = [j for j in self.junctions if j.date == date]
+            ends.append(found[pick])
+        return ends[0], ends[1]
+    
+    def _add_junction(self, junction):
+        self.junctions[junction] = Junction(junction, self.column)
+        bisect.insort(self.dates, junction.date)
+        self.by_date[junction.date].append(junction)
+    
+    def _remove_junction(self, junction):
+        del self.junctions[junction]
+        del self.dates[bisect.bisect_left(self.dates, junction.date)]
+        self.by_date[junction.date].remove(junction)
+    
     def _sort_key(self, snapshot):
         """ key for sorting the to_print list in order to assure that the 
             different branches are printed coherently
         """
         if snapshot.name == "@" or len(self.junctions) == 0:
             return snapshot.date
-        junctions = self.junctions.keys()
-        junctions.sort(key = lambda x: x.date)
-        oldest = junctions[0]
-        newest = junctions[-1]
-        fca = snapshots.first_common_ancestor(newest, snapshot) 
+        newest, oldest = self.ends
+        fca = self.ancestry.first_common_ancestor(newest, snapshot)
         if fca == None or oldest.date < fca.date:
             return snapshot.date
         return fca.date
@@ -531,12 +1411,16 @@ class TreeView(object):
         self.column = 1
         self.orphans = []
         self.junctions = {}
+        self.dates = []
+        self.by_date = defaultdict(list)
+        self.ancestry = snapshots.Ancestry()
         
         no_children = [Snapshot("@")]
         for snap in snapshots.get_list():
             if len(snap.children) == 0:
                 no_children.append(snap)
         to_print = no_children
+        self.ends = self._newest_and_oldest()
         to_print.sort(key = self._sort_key)
         
         while True:
@@ -546,7 +1430,12 @@ class TreeView(object):
                 break
 
             junction = self._print_up_to_junction(snapshot)
-            to_print.sort(key = self._sort_key)
+            # the keys only depend on the newest and oldest junctions, while
+            # they stay the same the list stays sorted as it is
+            ends = self._newest_and_oldest()
+            if ends != self.ends:
+                self.ends = ends
+                to_print.sort(key = self._sort_key)
             
             if junction == None:
                 
@@ -559,7 +1448,7 @@ class TreeView(object):
                 # new junction found
                 print(self._spacer() + u"│  ")
                 
-                self.junctions[junction] = Junction(junction, self.column)
+                self._add_junction(junction)
                 self.junctions[junction].branches_left_to_print -= 1
                 
             else:
@@ -586,7 +1475,7 @@ class TreeView(object):
                     self.column = self.junctions[junction].columns[0] - 1
                     self.orphans = [x for x in self.orphans 
                                           if x <= self.column]
-                    del self.junctions[junction]
+                    self._remove_junction(junction)
             
             self.column += 1
     
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+""" time how long apt waits on the pre-invoke hook when there is nothing to
+    do, with the old two command hook and with create --if-supported
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                      "apt-btrfs-snapshot")
+
+HOOKS = (
+    ("supported && create", [["supported"], ["create"]]),
+    ("create --if-supported", [["create", "--if-supported"]]),
+)
+
+
+def run_hook(commands, env):
+    start = time.time()
+    for command in commands:
+        with open(os.devnull, "w") as devnull:
+            ret = subprocess.call([sys.executable, SCRIPT] + command,
+                                  stdout=devnull, stderr=devnull, env=env)
+        if ret != 0:
+            break
+    return time.time() - start
+
+
+def bench(commands, runs, env):
+    times = sorted(run_hook(commands, env) for i in range(runs))
+    return times[0], times[len(times) // 2]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    # APT_NO_SNAPSHOTS takes the early way out, as does the debounce, and
+    # needs neither root nor btrfs
+    env = dict(os.environ, APT_NO_SNAPSHOTS="1")
+    print("%-24s %10s %10s" % ("hook", "min (ms)", "median (ms)"))
+    for name, commands in HOOKS:
+        best, median = bench(commands, args.runs, env)
+        print("%-24s %10.1f %10.1f" % (name, best * 1000, median * 1000))
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+""" time the commands against generated sandbox volumes of growing size, to
+    see how they scale with the number of snapshots. With --memory the
+    volumes are simulated in memory, so that disk speed is left out, or
+    replaced by the costs given with --costs.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import copy
+import cPickle as pickle
+import datetime
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, TOP)
+import snapshots
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from convert import convert
+from dpkg_history import DpkgHistory
+from snapshots import (
+    CHANGES_FILE,
+    PARENT_DOTS,
+    PARENT_LINK,
+    SNAP_PREFIX,
+    STAMP_FORMAT,
+)
+from storage import (
+    DiskStorage,
+    MemoryStorage,
+)
+
+FSTAB = os.path.join(TOP, "test", "data", "fstab")
+START = datetime.datetime(2013, 1, 1)
+KINDS = ("install", "upgrade", "remove", "purge")
+# exponents above this are flagged as superlinear
+SUPERLINEAR = 1.2
+
+
+def make_volume(path, count, branching=0.1, tags=0.1, changes=20, seed=0,
+                storage=None):
+    """ make a sandbox volume like test/data/model_root in path, with @ and
+        count snapshots an hour apart. Each snapshot follows the one before,
+        or with probability branching an older one, starting a branch. A
+        share tags of them are tagged and each has changes naming that many
+        packages. The volume is on disk unless another storage is given.
+    """
+    if storage is None:
+        storage = DiskStorage()
+    rand = random.Random(seed)
+    storage.makedirs(os.path.join(path, "@", "etc"))
+    names = []
+    for i in range(count):
+        date = START + datetime.timedelta(hours=i)
+        name = SNAP_PREFIX + date.strftime(STAMP_FORMAT)
+        if rand.random() < tags:
+            name += "-tag%d" % i
+        storage.makedirs(os.path.join(path, name, "etc"))
+        if i > 0:
+            parent = names[-1]
+            if i > 1 and rand.random() < branching:
+                parent = names[rand.randrange(i - 1)]
+            storage.symlink(PARENT_DOTS + parent,
+                            os.path.join(path, name, PARENT_LINK))
+            history = DpkgHistory(since=START + datetime.timedelta(hours=i-1),
+                                  do_parse=False)
+            for j in range(changes):
+                history[KINDS[j % len(KINDS)]].append(
+                    ("package%d" % j, "1.%d" % i))
+            storage.write(os.path.join(path, name, CHANGES_FILE),
+                          pickle.dumps(history))
+        names.append(name)
+    if len(names) > 0:
+        storage.symlink(PARENT_DOTS + names[-1],
+                        os.path.join(path, "@", PARENT_LINK))
+    return names
+
+
+def _newest(apt_btrfs):
+    return max(snapshots.get_list(), key=lambda s: s.date).name
+
+
+def _middle(apt_btrfs):
+    snapshot_list = sorted(snapshots.get_list(), key=lambda s: s.date)
+    return snapshot_list[len(snapshot_list) // 2].date
+
+
+# what each command does, and whether it changes the volume, in which case
+# it gets a fresh copy each time
+COMMANDS = (
+    ("load", False, lambda a: a.reload()),
+    ("list", False, lambda a: a.list()),
+    ("tree", False, lambda a: a.tree()),
+    ("status", False, lambda a: a.status()),
+    ("show", False, lambda a: a.show(_newest(a))),
+    ("recent", False, lambda a: a.recent(10, "@")),
+    ("list-older-than", False, lambda a: a.list_older_than(_middle(a))),
+    ("delete-older-than", True, lambda a: a.delete_older_than(_middle(a))),
+    ("convert", True, lambda a: convert(a.mp)),
+)
+
+
+class Discard(object):
+    """ swallows what the commands print """
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def time_command(volume, work, changes_volume, runs):
+    """ return the best time of runs of work on volume, a path or a
+        MemoryStorage, and the storage operations of the last run. The time
+        on a MemoryStorage includes what its operations are charged.
+    """
+    times = []
+    for i in range(runs):
+        path = storage = volume
+        if isinstance(volume, MemoryStorage):
+            path = None
+            if changes_volume:
+                storage = copy.deepcopy(volume)
+        else:
+            storage = DiskStorage()
+            if changes_volume:
+                path = volume + ".copy"
+                shutil.copytree(volume, path, symlinks=True)
+        stdout = sys.stdout
+        try:
+            apt_btrfs = AptBtrfsSnapshot(fstab=FSTAB, sandbox=path,
+                                         storage=storage)
+            storage.reset()
+            sys.stdout = Discard()
+            start = time.time()
+            work(apt_btrfs)
+            times.append(time.time() - start + storage.charged)
+            ops = Counter(storage.ops)
+        finally:
+            sys.stdout = stdout
+            if changes_volume and path is not None:
+                shutil.rmtree(path)
+    return min(times), ops
+
+
+def exponent(counts, times):
+    """ the slope of log(time) against log(count) between the last two, 1
+        for linear scaling, 2 for quadratic
+    """
+    if len(counts) < 2 or times[-2] <= 0 or times[-1] <= 0:
+        return None
+    return (math.log(times[-1] / times[-2]) /
+            math.log(float(counts[-1]) / counts[-2]))
+
+
+def report(counts, results, out=sys.stdout):
+    out.write("%-18s" % "command")
+    for count in counts:
+        out.write(" %10s" % ("n=%d" % count))
+    out.write(" %9s\n" % "exponent")
+    for name, times in results:
+        out.write("%-18s" % name)
+        for t in times:
+            out.write(" %8.1fms" % (t * 1000))
+        slope = exponent(counts, times)
+        if slope is None:
+            out.write(" %9s\n" % "-")
+        else:
+            out.write(" %9.2f%s\n" % (slope, " !" if slope > SUPERLINEAR
+                                      else ""))
+
+
+def report_ops(count, ops, out=sys.stdout):
+    out.write("\nstorage operations with n=%d:\n" % count)
+    for name, counted in ops:
+        out.write("%-18s %s\n" % (name, " ".join(
+            "%s=%d" % op for op in sorted(counted.items()))))
+
+
+def parse_costs(text):
+    """ turn "stat=0.0001,write=0.002" into a dict of costs in seconds """
+    costs = {}
+    for item in text.split(","):
+        op, sep, cost = item.partition("=")
+        costs[op] = float(cost)
+    return costs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--counts", default="100,300,1000",
+                        help="the numbers of snapshots to try, comma "
+                        "separated (default: %(default)s)")
+    parser.add_argument("-b", "--branching", type=float, default=0.1,
+                        help="chance that a snapshot starts a branch "
+                        "(default: %(default)s)")
+    parser.add_argument("-t", "--tags", type=float, default=0.1,
+                        help="share of tagged snapshots "
+                        "(default: %(default)s)")
+    parser.add_argument("-c", "--changes", type=int, default=20,
+                        help="packages in each changes file "
+                        "(default: %(default)s)")
+    parser.add_argument("-r", "--runs", type=int, default=3)
+    parser.add_argument("--commands", default=None,
+                        help="the commands to time, comma separated, out of "
+                        "%s" % ", ".join(c[0] for c in COMMANDS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-m", "--memory", action="store_true",
+                        help="simulate the volumes in memory")
+    parser.add_argument("--costs", default=None,
+                        help="with --memory, what each storage operation "
+                        "costs in seconds, e.g. stat=0.0001,write=0.002")
+    args = parser.parse_args()
+
+    counts = [int(c) for c in args.counts.split(",")]
+    commands = COMMANDS
+    if args.commands:
+        wanted = args.commands.split(",")
+        commands = [c for c in COMMANDS if c[0] in wanted]
+    costs = None
+    if args.costs:
+        if not args.memory:
+            parser.error("--costs needs --memory")
+        costs = parse_costs(args.costs)
+    tmpdir = tempfile.mkdtemp(prefix="apt-btrfs-bench-")
+    results = [(name, []) for name, changes_volume, work in commands]
+    ops = []
+    try:
+        for count in counts:
+            if args.memory:
+                volume = MemoryStorage(costs=costs)
+                make_volume(volume.mp, count, args.branching, args.tags,
+                            args.changes, args.seed, volume)
+            else:
+                volume = os.path.join(tmpdir, "volume%d" % count)
+                make_volume(volume, count, args.branching, args.tags,
+                            args.changes, args.seed)
+            ops = []
+            for (name, times), (n, changes_volume, work) in zip(results,
+                                                                commands):
+                best, counted = time_command(volume, work, changes_volume,
+                                             args.runs)
+                times.append(best)
+                ops.append((name, counted))
+            if not args.memory:
+                shutil.rmtree(volume)
+    finally:
+        shutil.rmtree(tmpdir)
+    report(counts, results)
+    report_ops(counts[-1], ops)
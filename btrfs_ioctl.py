@@ -0,0 +1,425 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+
+# see linux/btrfs.h
+BTRFS_IOCTL_MAGIC = 0x94
+BTRFS_PATH_NAME_MAX = 4087
+BTRFS_SUBVOL_NAME_MAX = 4039
+BTRFS_SUBVOL_RDONLY = 1 << 1
+BTRFS_VOL_NAME_MAX = 255
+BTRFS_UUID_SIZE = 16
+BTRFS_FSID_SIZE = 16
+BTRFS_DEVICE_PATH_NAME_MAX = 1024
+BTRFS_BLOCK_GROUP_DATA = 1 << 0
+BTRFS_BLOCK_GROUP_METADATA = 1 << 2
+BTRFS_BLOCK_GROUP_RAID1 = 1 << 4
+BTRFS_BLOCK_GROUP_DUP = 1 << 5
+BTRFS_BLOCK_GROUP_RAID10 = 1 << 6
+BTRFS_BLOCK_GROUP_RAID1C3 = 1 << 9
+BTRFS_BLOCK_GROUP_RAID1C4 = 1 << 10
+
+# see linux/mount.h
+MS_PRIVATE = 1 << 18
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+
+def _ioc(direction, nr, size, magic=BTRFS_IOCTL_MAGIC):
+    """ equivalent of the _IOC macro from asm-generic/ioctl.h """
+    return (direction << 30) | (size << 16) | (magic << 8) | nr
+
+
+class VolArgs(ctypes.Structure):
+    """ struct btrfs_ioctl_vol_args """
+    _fields_ = [
+        ("fd", ctypes.c_int64),
+        ("name", ctypes.c_char * (BTRFS_PATH_NAME_MAX + 1)),
+    ]
+
+
+class VolArgsV2(ctypes.Structure):
+    """ struct btrfs_ioctl_vol_args_v2 """
+    _fields_ = [
+        ("fd", ctypes.c_int64),
+        ("transid", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+        ("unused", ctypes.c_uint64 * 4),
+        ("name", ctypes.c_char * (BTRFS_SUBVOL_NAME_MAX + 1)),
+    ]
+
+
+class Timespec(ctypes.Structure):
+    """ struct btrfs_ioctl_timespec """
+    _fields_ = [
+        ("sec", ctypes.c_uint64),
+        ("nsec", ctypes.c_uint32),
+    ]
+
+
+class SubvolInfo(ctypes.Structure):
+    """ struct btrfs_ioctl_get_subvol_info_args """
+    _fields_ = [
+        ("treeid", ctypes.c_uint64),
+        ("name", ctypes.c_char * (BTRFS_VOL_NAME_MAX + 1)),
+        ("parent_id", ctypes.c_uint64),
+        ("dirid", ctypes.c_uint64),
+        ("generation", ctypes.c_uint64),
+        ("flags", ctypes.c_uint64),
+        ("uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+        ("parent_uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+        ("received_uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+        ("ctransid", ctypes.c_uint64),
+        ("otransid", ctypes.c_uint64),
+        ("stransid", ctypes.c_uint64),
+        ("rtransid", ctypes.c_uint64),
+        ("ctime", Timespec),
+        ("otime", Timespec),
+        ("stime", Timespec),
+        ("rtime", Timespec),
+        ("reserved", ctypes.c_uint64 * 8),
+    ]
+
+
+class SpaceArgs(ctypes.Structure):
+    """ struct btrfs_ioctl_space_args, without the trailing array """
+    _fields_ = [
+        ("space_slots", ctypes.c_uint64),
+        ("total_spaces", ctypes.c_uint64),
+    ]
+
+
+class SpaceInfo(ctypes.Structure):
+    """ struct btrfs_ioctl_space_info """
+    _fields_ = [
+        ("flags", ctypes.c_uint64),
+        ("total_bytes", ctypes.c_uint64),
+        ("used_bytes", ctypes.c_uint64),
+    ]
+
+
+class FsInfo(ctypes.Structure):
+    """ struct btrfs_ioctl_fs_info_args """
+    _fields_ = [
+        ("max_id", ctypes.c_uint64),
+        ("num_devices", ctypes.c_uint64),
+        ("fsid", ctypes.c_uint8 * BTRFS_FSID_SIZE),
+        ("nodesize", ctypes.c_uint32),
+        ("sectorsize", ctypes.c_uint32),
+        ("clone_alignment", ctypes.c_uint32),
+        ("csum_type", ctypes.c_uint16),
+        ("csum_size", ctypes.c_uint16),
+        ("flags", ctypes.c_uint64),
+        ("generation", ctypes.c_uint64),
+        ("metadata_uuid", ctypes.c_uint8 * BTRFS_FSID_SIZE),
+        ("reserved", ctypes.c_uint8 * 944),
+    ]
+
+
+class DevInfo(ctypes.Structure):
+    """ struct btrfs_ioctl_dev_info_args """
+    _fields_ = [
+        ("devid", ctypes.c_uint64),
+        ("uuid", ctypes.c_uint8 * BTRFS_UUID_SIZE),
+        ("bytes_used", ctypes.c_uint64),
+        ("total_bytes", ctypes.c_uint64),
+        ("unused", ctypes.c_uint64 * 379),
+        ("path", ctypes.c_char * BTRFS_DEVICE_PATH_NAME_MAX),
+    ]
+
+
+BTRFS_IOC_SYNC = _ioc(0, 8, 0)
+BTRFS_IOC_SNAP_DESTROY = _ioc(_IOC_WRITE, 15, ctypes.sizeof(VolArgs))
+BTRFS_IOC_SNAP_CREATE_V2 = _ioc(_IOC_WRITE, 23, ctypes.sizeof(VolArgsV2))
+BTRFS_IOC_GET_SUBVOL_INFO = _ioc(_IOC_READ, 60, ctypes.sizeof(SubvolInfo))
+BTRFS_IOC_SPACE_INFO = _ioc(_IOC_READ | _IOC_WRITE, 20,
+                            ctypes.sizeof(SpaceArgs))
+BTRFS_IOC_DEV_INFO = _ioc(_IOC_READ | _IOC_WRITE, 30, ctypes.sizeof(DevInfo))
+BTRFS_IOC_FS_INFO = _ioc(_IOC_READ, 31, ctypes.sizeof(FsInfo))
+
+
+# see linux/fiemap.h
+FIEMAP_MAX_OFFSET = 2 ** 64 - 1
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+
+
+class Fiemap(ctypes.Structure):
+    """ struct fiemap, without the trailing array of extents """
+    _fields_ = [
+        ("start", ctypes.c_uint64),
+        ("length", ctypes.c_uint64),
+        ("flags", ctypes.c_uint32),
+        ("mapped_extents", ctypes.c_uint32),
+        ("extent_count", ctypes.c_uint32),
+        ("reserved", ctypes.c_uint32),
+    ]
+
+
+class FiemapExtent(ctypes.Structure):
+    """ struct fiemap_extent """
+    _fields_ = [
+        ("logical", ctypes.c_uint64),
+        ("physical", ctypes.c_uint64),
+        ("length", ctypes.c_uint64),
+        ("reserved64", ctypes.c_uint64 * 2),
+        ("flags", ctypes.c_uint32),
+        ("reserved", ctypes.c_uint32 * 3),
+    ]
+
+
+FS_IOC_FIEMAP = _ioc(_IOC_READ | _IOC_WRITE, 11, ctypes.sizeof(Fiemap),
+                     magic=ord("f"))
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def _encode(path):
+    if path is None or isinstance(path, bytes):
+        return path
+    return path.encode("utf-8")
+
+
+def _check(ret, path=None):
+    if ret != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+
+
+def _ioctl(fd, request, args, path=None):
+    libc = _get_libc()
+    _check(libc.ioctl(fd, ctypes.c_ulong(request), ctypes.byref(args)), path)
+
+
+def _open_dir(path):
+    return os.open(path, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+
+
+_fiemap_requests = {}
+_space_requests = {}
+
+
+def _fiemap_request(count):
+    """ a struct fiemap followed by room for count extents """
+    if count not in _fiemap_requests:
+        class FiemapRequest(ctypes.Structure):
+            _fields_ = [
+                ("fiemap", Fiemap),
+                ("extents", FiemapExtent * count),
+            ]
+        _fiemap_requests[count] = FiemapRequest
+    return _fiemap_requests[count]()
+
+
+def _space_request(count):
+    """ a struct btrfs_ioctl_space_args followed by room for count spaces """
+    if count not in _space_requests:
+        class SpaceRequest(ctypes.Structure):
+            _fields_ = [
+                ("args", SpaceArgs),
+                ("spaces", SpaceInfo * count),
+            ]
+        _space_requests[count] = SpaceRequest
+    return _space_requests[count]()
+
+
+def is_available():
+    """ the ioctls are only available on linux and need a usable libc """
+    if not os.uname()[0] == "Linux":
+        return False
+    try:
+        _get_libc()
+    except OSError:
+        return False
+    return True
+
+
+def snapshot(source, dest, readonly=False):
+    """ snapshot the subvolume at source as dest """
+    parent, name = os.path.split(os.path.abspath(dest))
+    args = VolArgsV2()
+    args.name = _encode(name)
+    if readonly:
+        args.flags = BTRFS_SUBVOL_RDONLY
+    source_fd = _open_dir(source)
+    try:
+        parent_fd = _open_dir(parent)
+        try:
+            args.fd = source_fd
+            _ioctl(parent_fd, BTRFS_IOC_SNAP_CREATE_V2, args, dest)
+        finally:
+            os.close(parent_fd)
+    finally:
+        os.close(source_fd)
+
+
+def destroy(path):
+    """ delete the subvolume at path """
+    parent, name = os.path.split(os.path.abspath(path))
+    args = VolArgs()
+    args.name = _encode(name)
+    parent_fd = _open_dir(parent)
+    try:
+        _ioctl(parent_fd, BTRFS_IOC_SNAP_DESTROY, args, path)
+    finally:
+        os.close(parent_fd)
+
+
+def sync(path):
+    """ commit the current transaction of the filesystem holding path """
+    fd = _open_dir(path)
+    try:
+        _check(_get_libc().ioctl(fd, ctypes.c_ulong(BTRFS_IOC_SYNC), None),
+               path)
+    finally:
+        os.close(fd)
+
+
+def subvol_info(path):
+    """ return the SubvolInfo of the subvolume holding path, any user may
+        ask since linux 4.18
+    """
+    info = SubvolInfo()
+    fd = _open_dir(path)
+    try:
+        _ioctl(fd, BTRFS_IOC_GET_SUBVOL_INFO, info, path)
+    finally:
+        os.close(fd)
+    return info
+
+
+def space_info(path):
+    """ return the SpaceInfo of each kind of block group of the filesystem
+        holding path, i.e. how much is allocated to data, metadata and
+        system chunks and how much of that is used
+    """
+    fd = _open_dir(path)
+    try:
+        # the first call only counts them
+        request = _space_request(0)
+        _ioctl(fd, BTRFS_IOC_SPACE_INFO, request, path)
+        count = request.args.total_spaces
+        request = _space_request(count)
+        request.args.space_slots = count
+        _ioctl(fd, BTRFS_IOC_SPACE_INFO, request, path)
+    finally:
+        os.close(fd)
+    return request.spaces[:min(count, request.args.total_spaces)]
+
+
+def unallocated(path):
+    """ return how many bytes of the devices of the filesystem holding path
+        are not allocated to any chunk yet
+    """
+    fd = _open_dir(path)
+    try:
+        fs_info = FsInfo()
+        _ioctl(fd, BTRFS_IOC_FS_INFO, fs_info, path)
+        free = 0
+        for devid in range(1, fs_info.max_id + 1):
+            dev_info = DevInfo()
+            dev_info.devid = devid
+            try:
+                _ioctl(fd, BTRFS_IOC_DEV_INFO, dev_info, path)
+            except OSError as e:
+                # device ids of removed devices are not reused
+                if e.errno == errno.ENODEV:
+                    continue
+                raise
+            free += dev_info.total_bytes - dev_info.bytes_used
+    finally:
+        os.close(fd)
+    return free
+
+
+def copies(flags):
+    """ how many copies of each chunk a block group profile keeps """
+    if flags & BTRFS_BLOCK_GROUP_RAID1C4:
+        return 4
+    if flags & BTRFS_BLOCK_GROUP_RAID1C3:
+        return 3
+    if flags & (BTRFS_BLOCK_GROUP_RAID1 | BTRFS_BLOCK_GROUP_DUP |
+                BTRFS_BLOCK_GROUP_RAID10):
+        return 2
+    return 1
+
+
+def resolve_fs_spec(fs_spec):
+    """ turn a UUID=... or LABEL=... fstab spec into a device path """
+    for key, directory in (("UUID=", "/dev/disk/by-uuid"),
+                           ("LABEL=", "/dev/disk/by-label")):
+        if fs_spec.startswith(key):
+            return os.path.realpath(
+                os.path.join(directory, fs_spec[len(key):]))
+    return fs_spec
+
+
+def mount(fs_spec, mountpoint, fstype="btrfs", flags=0, data=None):
+    """ mount the btrfs filesystem identified by fs_spec on mountpoint """
+    libc = _get_libc()
+    device = resolve_fs_spec(fs_spec)
+    ret = libc.mount(_encode(device), _encode(mountpoint), _encode(fstype),
+                     ctypes.c_ulong(flags), _encode(data))
+    _check(ret, mountpoint)
+
+
+def make_private(mountpoint):
+    """ stop mount and unmount events propagating to and from mountpoint """
+    _check(_get_libc().mount(None, _encode(mountpoint), None,
+                             ctypes.c_ulong(MS_PRIVATE), None), mountpoint)
+
+
+def umount(mountpoint):
+    """ unmount whatever is mounted on mountpoint """
+    libc = _get_libc()
+    _check(libc.umount2(_encode(mountpoint), 0), mountpoint)
+
+
+def fiemap(fd, start=0, length=FIEMAP_MAX_OFFSET, count=32, flags=0):
+    """ map the given byte range of the open file fd into at most count
+        extents, returns how many there are and the extents themselves.
+        With a count of 0 only the number of extents in the range is
+        returned, which is cheap.
+    """
+    request = _fiemap_request(count)
+    request.fiemap.start = start
+    request.fiemap.length = length
+    request.fiemap.flags = flags
+    request.fiemap.extent_count = count
+    _ioctl(fd, FS_IOC_FIEMAP, request)
+    mapped = request.fiemap.mapped_extents
+    if count == 0:
+        return mapped, []
+    return mapped, request.extents[:min(mapped, count)]
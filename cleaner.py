@@ -0,0 +1,195 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+import stat
+from multiprocessing.dummy import Pool
+
+from extents import file_usage, freed_by, shares_data
+
+
+TARGETS = {}
+# directory entries removed at a time, in inode order so that the
+# filesystem updates its trees in as few passes as it can
+BATCH = 256
+
+
+class CleanTarget(object):
+    """ a set of files that can be removed from within a snapshot: those in
+        path (relative to the snapshot root) whose name matches
+    """
+
+    def __init__(self, name, path, match, recursive=False):
+        self.name = name
+        self.path = path
+        self.match = match
+        self.recursive = recursive
+
+    def __repr__(self):
+        return "<CleanTarget %s>" % self.name
+
+
+def register_target(name, path, match, recursive=False):
+    TARGETS[name] = CleanTarget(name, path, match, recursive)
+
+
+register_target("apt-cache", "var/cache/apt/archives",
+                lambda f: f.endswith(".deb"))
+_rotated = re.compile(r".*\.[0-9]+(\.gz)?$")
+register_target("rotated-logs", "var/log",
+                lambda f: _rotated.match(f) is not None, recursive=True)
+register_target("var-tmp", "var/tmp", lambda f: True, recursive=True)
+
+
+def get_targets(what):
+    """ turn "apt-cache,var-tmp" or a list of names into CleanTargets """
+    if isinstance(what, CleanTarget):
+        return [what]
+    if isinstance(what, basestring):
+        what = what.split(",")
+    targets = []
+    for name in what:
+        if name not in TARGETS:
+            raise Exception("Unknown clean target '%s', choose from: %s" % (
+                name, ", ".join(sorted(TARGETS))))
+        targets.append(TARGETS[name])
+    return targets
+
+
+def format_size(size):
+    for unit in ("bytes", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024.0
+    if unit == "bytes":
+        return "%d %s" % (size, unit)
+    return "%.1f %s" % (size, unit)
+
+
+class CleanReport(object):
+    """ what was (or would be) removed from one snapshot """
+
+    def __init__(self, name):
+        self.name = name
+        self.files = 0
+        self.bytes = 0
+        self.freed = 0
+        self.paths = []
+        self.skipped = 0
+        self.skipped_bytes = 0
+
+    def add(self, path, size, freed=None):
+        if freed is None:
+            freed = size
+        self.files += 1
+        self.bytes += size
+        self.freed += freed
+        self.paths.append(path)
+
+    def skip(self, path, size):
+        self.skipped += 1
+        self.skipped_bytes += size
+
+
+class Cleaner(object):
+    """ removes the files of the given targets from snapshots, several
+        snapshots at a time. The files are removed batch entries at a time
+        while the snapshot is being walked. With estimate the extents of
+        each file are looked at first to tell how much removing it frees.
+        Given live, the root of the subvolume in use, files whose data is
+        all still that of the same file in live are left alone, since no
+        amount of cleaning snapshots would free it. Files shared only
+        between snapshots are removed, they are freed once all are cleaned.
+    """
+
+    def __init__(self, targets, dry_run=False, workers=4, estimate=False,
+                 batch=BATCH, live=None):
+        self.targets = targets
+        self.dry_run = dry_run
+        self.workers = workers
+        self.estimate = estimate
+        self.batch = batch
+        self.live = live
+
+    def _scan(self, directory, live, target, report, pending):
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return
+        for entry in entries:
+            path = os.path.join(directory, entry)
+            live_path = live and os.path.join(live, entry)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if target.recursive:
+                    self._scan(path, live_path, target, report, pending)
+                continue
+            elif not target.match(entry):
+                continue
+            elif not self.estimate:
+                report.add(path, st.st_size)
+            else:
+                usage = file_usage(path)
+                if (usage is not None and usage[0] > 0 and usage[1] == 0 and
+                        live_path and shares_data(path, live_path)):
+                    report.skip(path, st.st_size)
+                    continue
+                report.add(path, st.st_size, freed_by(usage, st.st_size))
+            pending.append((st.st_ino, path))
+            if len(pending) >= self.batch:
+                self._remove(pending)
+
+    def _remove(self, pending):
+        """ remove the (inode, path) entries pending and empty the list """
+        if not self.dry_run:
+            for ino, path in sorted(pending):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        del pending[:]
+
+    def clean_snapshot(self, name, root):
+        """ clean the snapshot mounted at root """
+        report = CleanReport(name)
+        pending = []
+        for target in self.targets:
+            live = None
+            if self.estimate and self.live is not None:
+                live = os.path.join(self.live, target.path)
+            self._scan(os.path.join(root, target.path), live, target, report,
+                       pending)
+        self._remove(pending)
+        return report
+
+    def clean(self, snapshots):
+        """ clean the (name, root) pairs given and return their reports """
+        if self.workers <= 1 or len(snapshots) <= 1:
+            return [self.clean_snapshot(n, r) for n, r in snapshots]
+        pool = Pool(min(self.workers, len(snapshots)))
+        try:
+            return pool.map(lambda x: self.clean_snapshot(*x), snapshots)
+        finally:
+            pool.close()
+            pool.join()
@@ -34,6 +34,25 @@ from snapshots import (
 )
 from dpkg_history import DpkgHistory
 
+
+def convert(mountpoint):
+    """ chain the snapshots on mountpoint by date, each with the changes
+        found in its dpkg logs since the one before
+    """
+    snaplist = snapshots.get_list()
+    snaplist.sort(key = lambda x: x.date)
+    
+    previous = None
+    for snap in snaplist:
+        if previous:
+            snap.parent = previous
+            location = os.path.join(mountpoint, snap.name, "var")
+            date = previous.date
+            snap.changes = DpkgHistory(var_location=location, since=date)
+        previous = snap
+    Snapshot("@").parent = previous
+
+
 if __name__ == "__main__":
 
     if os.getuid() != 0 and len(sys.argv) == 1:
@@ -48,16 +67,4 @@ if __name__ == "__main__":
         apt_btrfs = AptBtrfsSnapshot(test_mp = sys.argv[1])
     else:
         apt_btrfs = AptBtrfsSnapshot()
-    mountpoint = apt_btrfs.mp
-    snaplist = snapshots.get_list()
-    snaplist.sort(key = lambda x: x.date)
-    
-    previous = None
-    for snap in snaplist:
-        if previous:
-            snap.parent = previous
-            location = os.path.join(mountpoint, snap.name, "var")
-            date = previous.date
-            snap.changes = DpkgHistory(var_location=location, since=date)
-        previous = snap
-    Snapshot("@").parent = previous
+    convert(apt_btrfs.mp)
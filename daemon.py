@@ -0,0 +1,348 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from StringIO import StringIO
+
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from inotify import (
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_DELETE,
+    IN_MODIFY,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    Inotify,
+)
+from journal import JOURNAL
+from locking import (
+    TIMEOUT,
+    LockTimeout,
+    VolumeLock,
+)
+from metrics import TIMED_COMMANDS
+import snapshots
+from space import BUDGET
+
+
+SOCKET_PATH = "/run/apt-btrfs-snapshot.sock"
+# what the daemon answers, and whether only root may ask
+COMMANDS = {
+    "list": False,
+    "show": False,
+    "status": False,
+    "tree": False,
+    "create": True,
+}
+VOLUME_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+FILE_EVENTS = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", 17)
+# the daemon may wait TIMEOUT seconds for the lock, then create may spend
+# the space guard's budget making room before the snapshot itself
+CALL_TIMEOUT = TIMEOUT + BUDGET + 10
+# how long a client has to send its whole request
+READ_TIMEOUT = 1
+
+
+class DaemonError(Exception):
+    pass
+
+
+class CachingAptBtrfsSnapshot(AptBtrfsSnapshot):
+    """ keeps the snapshot graph and the status of @ until told that they
+        changed
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CachingAptBtrfsSnapshot, self).__init__(*args, **kwargs)
+        self.graph_stale = False
+        self.cached_status = None
+
+    def invalidate(self, graph=False):
+        self.cached_status = None
+        if graph:
+            self.graph_stale = True
+
+    def refresh(self):
+        if self.graph_stale:
+            self.reload()
+            self.graph_stale = False
+
+    def _get_status(self):
+        if self.cached_status is None:
+            self.cached_status = super(CachingAptBtrfsSnapshot,
+                                       self)._get_status()
+        return self.cached_status
+
+
+def _peer_uid(connection):
+    try:
+        creds = connection.getsockopt(socket.SOL_SOCKET, SO_PEERCRED,
+                                      struct.calcsize(str("3i")))
+    except socket.error:
+        return None
+    return struct.unpack(str("3i"), creds)[1]
+
+
+class Daemon(object):
+    """ answers list, show, status, tree and create over a UNIX socket, one
+        JSON request per connection, each read in a thread of its own so a
+        client that keeps quiet holds up nobody else:
+            {"command": "show", "args": ["@apt-snapshot-..."]}
+        is answered with
+            {"result": true, "output": "what the command printed"}
+        or {"error": "..."}, with "lock_timeout": true when the lock
+        couldn't be had. The graph is re-read when something changes
+        at the root of the volume, the status of @ when dpkg or apt's hook
+        write to their logs.
+    """
+
+    def __init__(self, apt_btrfs, socket_path=SOCKET_PATH,
+                 var_location="/var/"):
+        self.apt_btrfs = apt_btrfs
+        self.socket_path = socket_path
+        self.var_location = var_location
+        self.sock = None
+        self.inotify = None
+        self.volume_wd = None
+        # requests are run one at a time, handle swaps sys.stdout
+        self.handling = threading.Lock()
+
+    def handle(self, request, uid=0):
+        """ run a request, returns the response """
+        command = request.get("command")
+        if command not in COMMANDS:
+            return {"error": "Unknown command '%s'" % command}
+        if COMMANDS[command] and uid != 0:
+            return {"error": "Only root may %s" % command}
+        started = time.time()
+        lock = VolumeLock(self.apt_btrfs.mp, shared=not COMMANDS[command])
+        try:
+            lock.acquire()
+        except LockTimeout as e:
+            if command in TIMED_COMMANDS:
+                self.apt_btrfs.record_run(command, time.time() - started,
+                                          False)
+            return {"error": "%s" % e, "lock_timeout": True}
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            self.apt_btrfs.refresh()
+            args = request.get("args", [])
+            if uid != 0:
+                refused = self._check_args(command, args)
+                if refused:
+                    return {"error": refused}
+            try:
+                result = getattr(self.apt_btrfs, command)(*args)
+            except Exception:
+                if command in TIMED_COMMANDS:
+                    self.apt_btrfs.record_run(command,
+                                              time.time() - started, False)
+                raise
+            if command in TIMED_COMMANDS:
+                # as the command line does
+                self.apt_btrfs.record_run(command, time.time() - started,
+                                          result)
+                self.apt_btrfs.metrics(auto=True, quick=command == "create")
+        except Exception as e:
+            return {"error": "%s" % e}
+        finally:
+            sys.stdout = stdout
+            lock.release()
+        if COMMANDS[command]:
+            self.apt_btrfs.invalidate(graph=True)
+        return {"result": result, "output": output.getvalue()}
+
+    def _check_args(self, command, args):
+        """ the reason for refusing args from a caller other than root, who
+            may only name a snapshot to show, and one that exists
+        """
+        if command != "show":
+            if args:
+                return "Only root may pass arguments to %s" % command
+            return None
+        if not isinstance(args, list) or len(args) != 1:
+            return "show takes the name of one snapshot"
+        name = args[0]
+        if (not isinstance(name, basestring) or "/" in name or
+                ".." in name):
+            return "Bad snapshot name"
+        if name != "@" and name not in [s.name for s in snapshots.get_list()]:
+            return "No snapshot called %s" % name
+        return None
+
+    def on_events(self, events):
+        for path, mask, name in events:
+            if path == self.apt_btrfs.mp:
+                self.apt_btrfs.invalidate(graph=True)
+            else:
+                self.apt_btrfs.invalidate()
+
+    def _watch(self):
+        self.inotify = Inotify()
+        self.inotify.add_watch(self.apt_btrfs.mp, VOLUME_EVENTS)
+        for directory in (os.path.join(self.var_location, "log"),
+                          os.path.dirname(os.path.join(
+                              self.apt_btrfs.mp, "@", JOURNAL))):
+            try:
+                self.inotify.add_watch(directory, FILE_EVENTS)
+            except OSError:
+                # nothing there yet, status is then never cached for long
+                pass
+
+    def _listen(self):
+        try:
+            os.remove(self.socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        # anybody may ask, commands that change things check who asks
+        os.chmod(self.socket_path, 0o666)
+        self.sock.listen(5)
+
+    def _read_request(self, connection, timeout=READ_TIMEOUT):
+        """ return the request sent on connection, raises socket.timeout
+            unless it is all there within timeout seconds
+        """
+        deadline = time.time() + timeout
+        data = b""
+        while not data.endswith(b"\n"):
+            left = deadline - time.time()
+            if left <= 0:
+                raise socket.timeout("timed out")
+            connection.settimeout(left)
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _serve_connection(self, connection):
+        try:
+            data = self._read_request(connection)
+            try:
+                request = json.loads(data.decode("utf-8"))
+            except ValueError:
+                response = {"error": "Bad request"}
+            else:
+                with self.handling:
+                    response = self.handle(request, _peer_uid(connection))
+            connection.settimeout(READ_TIMEOUT)
+            connection.sendall(json.dumps(response).encode("utf-8"))
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def serve(self, once=False):
+        """ serve requests until killed, or a single one if once """
+        self._listen()
+        self._watch()
+        try:
+            while True:
+                ready, w, x = select.select([self.sock, self.inotify], [],
+                                            [])
+                if self.inotify in ready:
+                    self.on_events(self.inotify.read())
+                if self.sock in ready:
+                    connection, address = self.sock.accept()
+                    worker = threading.Thread(target=self._serve_connection,
+                                              args=(connection,))
+                    worker.daemon = True
+                    worker.start()
+                    if once:
+                        worker.join()
+                        break
+        finally:
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def call(command, args=(), socket_path=SOCKET_PATH, timeout=CALL_TIMEOUT):
+    """ have the daemon run command, returns its result and what it
+        printed, or None if no daemon is listening. Raises LockTimeout if
+        it couldn't have the lock, DaemonError if it answers with another
+        error or doesn't answer in time
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            return None
+        request = {"command": command, "args": list(args)}
+        data = b""
+        try:
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.error as e:
+            # socket.timeout included
+            raise DaemonError("No answer from the daemon: %s" % e)
+    finally:
+        sock.close()
+    try:
+        response = json.loads(data.decode("utf-8"))
+    except ValueError:
+        raise DaemonError("Bad answer from the daemon")
+    if response.get("lock_timeout"):
+        raise LockTimeout(response["error"])
+    if "error" in response:
+        raise DaemonError(response["error"])
+    return response["result"], response["output"]
+
+
+def run(backend="auto", socket_path=SOCKET_PATH):
+    # the changes of new snapshots are worked out in children, which
+    # needn't be waited for
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    apt_btrfs = CachingAptBtrfsSnapshot(backend=backend,
+                                        persistent_mount=True)
+    Daemon(apt_btrfs, socket_path).serve()
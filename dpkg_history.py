@@ -27,12 +27,24 @@ from collections import defaultdict
 import platform
 
 _arch = platform.machine()
-if _arch == "x86_64": _arch = "amd64"
+_arch = {"x86_64": "amd64", "aarch64": "arm64", "i686": "i386",
+         "armv7l": "armhf", "ppc64le": "ppc64el"}.get(_arch, _arch)
+
+
+def _unqualify(package):
+    """ name packages the way extended_states does, without the
+        architecture if it is the native one or all
+    """
+    name, colon, arch = package.partition(":")
+    if arch in (_arch, "all"):
+        return name
+    return package
 
 
 class DpkgHistory(dict):
     """ Parser for the dpkg history logs """
-    def __init__(self, var_location="/var/", since = None, do_parse=True):
+    def __init__(self, var_location="/var/", since = None, do_parse=True,
+                 until=None):
         super(DpkgHistory, self).__init__()
 
         self["install"] = []
@@ -43,6 +55,9 @@ class DpkgHistory(dict):
         
         self.var_location = var_location
         self.since = self._get_date_from_string(since)
+        self.until = None
+        if until is not None:
+            self.until = self._get_date_from_string(until)
         self.auto = []
 
         if do_parse:
@@ -52,6 +67,24 @@ class DpkgHistory(dict):
                 self._split_installs_by_auto()
             self._sort_lists()
 
+    @classmethod
+    def from_actions(cls, actions, var_location="/var/", since=None):
+        """ build the history from (op, package, old version, new version)
+            actions, such as those in the journal, instead of the logs
+        """
+        history = cls(var_location=var_location, since=since, do_parse=False)
+        ops_by_package = defaultdict(list)
+        versions = defaultdict(list)
+        for op, package, old, new in actions:
+            ops_by_package[package].append(op)
+            versions[package].append([old, new])
+        history._distill_ops(ops_by_package, versions)
+        if len(history['install']) > 0:
+            history.auto = history._find_auto_installs()
+            history._split_installs_by_auto()
+        history._sort_lists()
+        return history
+
     def __add__(self, other):
         if self.since < other.since:
             order = self, other
@@ -151,8 +184,10 @@ class DpkgHistory(dict):
             date = datetime.strptime(line[0:19], "%Y-%m-%d %H:%M:%S")
             if date < self.since:
                 continue
+            if self.until is not None and date > self.until:
+                continue
             
-            package = bits[3]
+            package = _unqualify(bits[3])
             ops_by_package[package].append(linetype)
             versions[package].append(bits[4:6])
             
@@ -0,0 +1,308 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import gzip
+import os
+import subprocess
+import time
+
+import snapshots
+from cleaner import format_size
+from locking import (
+    TIMEOUT,
+    LockTimeout,
+    NullLock,
+    VolumeLock,
+)
+from storage import DiskStorage
+
+
+# read-only clones of the exported snapshots, btrfs send needs them and
+# they are the parents of the next incremental streams
+EXPORT_DIR = "@apt-btrfs-export"
+# the names of the snapshots the destination has, one per line
+STATE_FILE = ".apt-btrfs-export"
+# held for the whole of an export, so that two don't share the clones
+EXPORT_LOCK = ".apt-btrfs-export.lock"
+CHUNK_SIZE = 1 << 20
+
+
+def topological_order(snapshot_list):
+    """ return the snapshots given, parents before their children """
+    wanted = set(s.name for s in snapshot_list)
+    seen = set()
+    order = []
+    for snapshot in sorted(snapshot_list, key=lambda x: x.date):
+        chain = []
+        while snapshot is not None and snapshot.name not in seen:
+            seen.add(snapshot.name)
+            chain.append(snapshot)
+            snapshot = snapshot.parent
+        order.extend(s for s in reversed(chain) if s.name in wanted)
+    return order
+
+
+class FileWriter(object):
+
+    def __init__(self, path, compress):
+        self.path = path
+        self.tmp = path + ".part"
+        if compress:
+            self.stream = gzip.open(self.tmp, "wb")
+        else:
+            self.stream = open(self.tmp, "wb")
+
+    def write(self, data):
+        self.stream.write(data)
+
+    def finish(self):
+        self.stream.close()
+        os.rename(self.tmp, self.path)
+        return True
+
+    def abort(self):
+        self.stream.close()
+        os.remove(self.tmp)
+
+
+class FileSink(object):
+    """ stores each stream in a file of its own in directory, gzipped
+        unless told otherwise. btrfs receive -f reads them back.
+    """
+
+    def __init__(self, directory, compress=True):
+        self.directory = directory
+        self.compress = compress
+
+    def __repr__(self):
+        return "<FileSink %s>" % self.directory
+
+    def start(self, name):
+        path = os.path.join(self.directory, name + ".btrfs")
+        if self.compress:
+            path += ".gz"
+        return FileWriter(path, self.compress)
+
+
+class ReceiveWriter(object):
+
+    def __init__(self, directory):
+        self.receive = subprocess.Popen(["btrfs", "receive", directory],
+                                        stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.receive.stdin.write(data)
+
+    def finish(self):
+        self.receive.stdin.close()
+        return self.receive.wait() == 0
+
+    def abort(self):
+        self.receive.kill()
+        self.receive.wait()
+
+
+class ReceiveSink(object):
+    """ receives the streams into directory, on another btrfs volume """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __repr__(self):
+        return "<ReceiveSink %s>" % self.directory
+
+    def start(self, name):
+        return ReceiveWriter(self.directory)
+
+
+class Exporter(object):
+    """ sends snapshots to a sink, each one as an incremental stream from
+        its nearest ancestor the sink already has, or in full when there is
+        none. The snapshots the sink has are listed in its STATE_FILE, so an
+        interrupted export carries on where it stopped.
+        The volume lock is only held while clones are made or deleted, the
+        streams are sent without it so that apt can snapshot meanwhile.
+        The clones are looked at through storage, the sink is on disk.
+    """
+
+    def __init__(self, mp, commands, sink, clock=time.time,
+                 lock_timeout=TIMEOUT, storage=None):
+        self.mp = mp
+        self.commands = commands
+        self.sink = sink
+        self.clock = clock
+        self.lock_timeout = lock_timeout
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+        self.clones = os.path.join(mp, EXPORT_DIR)
+        self.state_file = os.path.join(sink.directory, STATE_FILE)
+
+    def _lock(self, path):
+        if self.storage.simulated:
+            return NullLock()
+        return VolumeLock(path, timeout=self.lock_timeout)
+
+    def _volume_lock(self):
+        return self._lock(self.mp)
+
+    def exported(self):
+        try:
+            with open(self.state_file) as state:
+                return set(line.strip() for line in state if line.strip())
+        except IOError:
+            return set()
+
+    def _mark_exported(self, name):
+        with open(self.state_file, "a") as state:
+            state.write("%s\n" % name)
+            state.flush()
+            os.fsync(state.fileno())
+
+    def _source(self, name):
+        """ where to send snapshot name from, read-only snapshots are sent
+            as they are, the others from their clone
+        """
+        if snapshots.has_sidecar(name):
+            return os.path.join(self.mp, name)
+        return os.path.join(self.clones, name)
+
+    def _clone(self, name):
+        """ return the read-only clone of snapshot name, making it if need
+            be
+        """
+        clone = self._source(name)
+        if not self.storage.isdir(clone):
+            if not self.storage.isdir(self.clones):
+                self.storage.mkdir(self.clones)
+            if not self.commands.btrfs_subvolume_snapshot(
+                    os.path.join(self.mp, name), clone, readonly=True):
+                return None
+        return clone
+
+    def _drop_clones(self, keep):
+        """ delete the clones no longer needed as parents, those left
+            behind when their snapshots were deleted by an older version
+        """
+        try:
+            names = self.storage.listdir(self.clones)
+        except OSError:
+            return
+        stale = [os.path.join(self.clones, n) for n in names if n not in keep]
+        if len(stale) > 0:
+            self.commands.btrfs_delete_snapshots(stale)
+
+    def _base(self, snapshot, exported):
+        """ the nearest ancestor of snapshot the sink has and whose clone
+            is still around
+        """
+        parent = snapshot.parent
+        while parent is not None:
+            if (parent.name in exported and
+                    self.storage.isdir(self._source(parent.name))):
+                return parent
+            parent = parent.parent
+        return None
+
+    def _send(self, clone, base, writer):
+        """ pipe btrfs send into writer, returns the size of the stream or
+            None if it failed
+        """
+        cmd = ["btrfs", "send"]
+        if base is not None:
+            cmd.extend(["-p", base])
+        cmd.append(clone)
+        send = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        size = 0
+        try:
+            while True:
+                chunk = send.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                size += len(chunk)
+        except (IOError, OSError):
+            send.kill()
+            send.wait()
+            writer.abort()
+            return None
+        if send.wait() != 0:
+            writer.abort()
+            return None
+        if not writer.finish():
+            return None
+        return size
+
+    def export(self, snapshot_list, all_snapshots):
+        """ export the snapshots in snapshot_list that the sink lacks.
+            Clones are kept for those among all_snapshots, the snapshots
+            still on the volume.
+        """
+        export_lock = self._lock(os.path.join(self.mp, EXPORT_LOCK))
+        try:
+            with export_lock:
+                return self._export(snapshot_list, all_snapshots)
+        except LockTimeout as e:
+            print(e)
+            return False
+
+    def _export(self, snapshot_list, all_snapshots):
+        exported = self.exported()
+        with self._volume_lock():
+            self._drop_clones(set(s.name for s in all_snapshots))
+        total, started = 0, self.clock()
+        count = 0
+        for snapshot in topological_order(snapshot_list):
+            if snapshot.name in exported:
+                continue
+            with self._volume_lock():
+                clone = self._clone(snapshot.name)
+            if clone is None:
+                print("Could not make a read-only clone of %s" %
+                      snapshot.name)
+                return False
+            base = self._base(snapshot, exported)
+            base_clone = None
+            if base is not None:
+                base_clone = self._source(base.name)
+            start = self.clock()
+            size = self._send(clone, base_clone,
+                              self.sink.start(snapshot.name))
+            if size is None:
+                print("Failed to export %s" % snapshot.name)
+                return False
+            seconds = self.clock() - start
+            self._mark_exported(snapshot.name)
+            exported.add(snapshot.name)
+            if base is None:
+                how = "in full"
+            else:
+                how = "from %s" % base.name
+            print("Exported %s %s: %s in %.1fs (%s/s)" % (
+                snapshot.name, how, format_size(size), seconds,
+                format_size(size / max(seconds, 0.001))))
+            total += size
+            count += 1
+        seconds = self.clock() - started
+        print("Exported %d snapshots: %s in %.1fs (%s/s)" % (
+            count, format_size(total), seconds,
+            format_size(total / max(seconds, 0.001))))
+        return True
@@ -0,0 +1,189 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+import stat
+
+import btrfs_ioctl
+
+
+# extents asked for per FIEMAP call
+BATCH = 256
+# files with more extents than this are sampled rather than fully mapped
+MAX_EXTENTS = 1024
+SAMPLES = 16
+# the inode number of the root directory of every btrfs subvolume
+SUBVOL_ROOT_INO = 256
+
+
+def _extents(fd, start, length, limit=None):
+    """ yield the extents of the open file fd overlapping the given range,
+        at most limit of them
+    """
+    end = start + length
+    seen = 0
+    while start < end:
+        mapped, extents = btrfs_ioctl.fiemap(fd, start, end - start, BATCH)
+        if mapped == 0:
+            return
+        for extent in extents:
+            yield extent
+            seen += 1
+            if (extent.flags & btrfs_ioctl.FIEMAP_EXTENT_LAST or
+                    seen == limit):
+                return
+        last = extents[-1].logical + extents[-1].length
+        if last <= start:
+            return
+        start = last
+
+
+def _usage(extents):
+    total = exclusive = 0
+    for extent in extents:
+        total += extent.length
+        if not extent.flags & btrfs_ioctl.FIEMAP_EXTENT_SHARED:
+            exclusive += extent.length
+    return total, exclusive
+
+
+def file_usage(path, max_extents=MAX_EXTENTS, samples=SAMPLES):
+    """ return how many bytes of data the file at path has and how many of
+        them are not shared with any other file or snapshot, or None if the
+        filesystem won't tell. The extents of files with more than
+        max_extents of them are only looked at in a few evenly spaced
+        windows and the result is extrapolated.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+    except OSError:
+        return None
+    try:
+        count = btrfs_ioctl.fiemap(fd, count=0)[0]
+        if count <= max_extents:
+            return _usage(_extents(fd, 0, btrfs_ioctl.FIEMAP_MAX_OFFSET))
+        size = os.fstat(fd).st_size
+        window = size // samples
+        total = exclusive = 0
+        for i in range(samples):
+            t, e = _usage(_extents(fd, i * window, window, limit=BATCH))
+            total += t
+            exclusive += e
+        if total == 0:
+            return 0, 0
+        return size, size * exclusive // total
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def shares_data(path, other, max_extents=MAX_EXTENTS):
+    """ whether all the data of the file at path is also that of the file
+        at other, as when one is a snapshot's copy of the other. False when
+        the filesystem won't tell or the file has too many extents to look
+        at all of them.
+    """
+    ranges = []
+    for name in (path, other):
+        try:
+            fd = os.open(name, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        except OSError:
+            return False
+        try:
+            if btrfs_ioctl.fiemap(fd, count=0)[0] > max_extents:
+                return False
+            ranges.append(set((e.physical, e.length) for e in _extents(
+                fd, 0, btrfs_ioctl.FIEMAP_MAX_OFFSET)))
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+    return len(ranges[0]) > 0 and ranges[0] <= ranges[1]
+
+
+def freed_by(usage, size):
+    """ scale the usage of a file to its size, so that the result adds up
+        with file sizes
+    """
+    if usage is None or usage[0] == 0:
+        return size
+    return size * usage[1] // usage[0]
+
+
+class ReclaimEstimate(object):
+    """ how much data some files hold and how much removing them would
+        free. It is a lower bound: extents shared only between the files
+        counted are not seen as freed.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.freed = 0
+        self.unknown = 0
+
+    def add(self, path, size):
+        usage = file_usage(path)
+        if usage is None:
+            self.unknown += 1
+        self.files += 1
+        self.bytes += size
+        self.freed += freed_by(usage, size)
+
+
+def estimate_files(paths):
+    """ estimate the space freed by removing the given files """
+    estimate = ReclaimEstimate()
+    for path in paths:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            estimate.add(path, st.st_size)
+    return estimate
+
+
+def estimate_tree(root, estimate=None):
+    """ estimate the space freed by deleting the subvolume at root, the
+        subvolumes nested in it are left out as they would not be deleted.
+        Given an estimate, the subvolume is added to it.
+    """
+    if estimate is None:
+        estimate = ReclaimEstimate()
+    for directory, dirs, files in os.walk(root):
+        for name in list(dirs):
+            try:
+                st = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if st.st_ino == SUBVOL_ROOT_INO:
+                dirs.remove(name)
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                estimate.add(path, st.st_size)
+    return estimate
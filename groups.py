@@ -0,0 +1,198 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+from multiprocessing.dummy import Pool
+
+from precheck import apt_config
+from storage import DiskStorage
+
+
+# the members of a snapshot of @ live in GROUP_DIR/<snapshot name>/
+GROUP_DIR = "@apt-btrfs-groups"
+# the uuid and generation of each member when the snapshot was made
+GENERATIONS_FILE = ".generations"
+CONFIG_KEY = "APT::Snapshots::Group"
+
+
+def read_group_config(config=None):
+    """ return the subvolumes listed in APT::Snapshots::Group, e.g.
+            APT::Snapshots::Group { "@var"; "@home"; };
+        config is what precheck.apt_config returned, asked for if None
+    """
+    if config is None:
+        config = apt_config()
+    return [value for key, value in config
+            if key == CONFIG_KEY + "::" and value]
+
+
+class SnapshotGroup(object):
+    """ the subvolumes at the top level of the volume that are snapshotted
+        along with @, e.g. @var and @home. Their snapshots belong to the
+        snapshot of @ and have no parent link or changes of their own, they
+        are tagged, deleted and rolled back together with it.
+    """
+
+    def __init__(self, mp, commands, members=(), storage=None):
+        self.mp = mp
+        self.commands = commands
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+        for member in members:
+            if "/" in member or not member.startswith("@"):
+                raise Exception("Bad group member '%s', name a subvolume at "
+                                "the top level, e.g. @home" % member)
+        self.members = list(members)
+
+    def __repr__(self):
+        return "<SnapshotGroup %s>" % " ".join(["@"] + self.members)
+
+    def _dir(self, name):
+        return os.path.join(self.mp, GROUP_DIR, name)
+
+    def members_of(self, name):
+        """ return the members snapshotted along with snapshot name """
+        try:
+            entries = self.storage.listdir(self._dir(name))
+        except OSError:
+            return []
+        return sorted(e for e in entries if e.startswith("@"))
+
+    def member_paths(self, name):
+        return [os.path.join(self._dir(name), m)
+                for m in self.members_of(name)]
+
+    def snapshot(self, snap_id, readonly=False):
+        """ snapshot @ as snap_id and the members into its group, all at
+            once so that they are as close to each other as can be.
+            Returns whether they all succeeded.
+        """
+        jobs = [(os.path.join(self.mp, "@"), os.path.join(self.mp, snap_id))]
+        if len(self.members) > 0:
+            self.storage.makedirs(self._dir(snap_id))
+            jobs.extend((os.path.join(self.mp, m),
+                         os.path.join(self._dir(snap_id), m))
+                        for m in self.members)
+        if len(jobs) == 1:
+            return self.commands.btrfs_subvolume_snapshot(
+                *jobs[0], readonly=readonly)
+        pool = Pool(len(jobs))
+        try:
+            results = pool.map(
+                lambda job: self.commands.btrfs_subvolume_snapshot(
+                    *job, readonly=readonly), jobs)
+        finally:
+            pool.close()
+            pool.join()
+        for (source, dest), res in zip(jobs, results):
+            if not res:
+                print("Could not snapshot %s" % os.path.basename(source))
+        return all(results)
+
+    def rename(self, old, new):
+        """ follow the snapshot of @ being renamed """
+        if self.storage.isdir(self._dir(old)):
+            self.storage.rename(self._dir(old), self._dir(new))
+
+    def forget(self, name):
+        """ drop the group of snapshot name once its members are gone """
+        try:
+            self.storage.remove(os.path.join(self._dir(name),
+                                             GENERATIONS_FILE))
+        except OSError:
+            pass
+        try:
+            self.storage.rmdir(self._dir(name))
+            self.storage.rmdir(os.path.join(self.mp, GROUP_DIR))
+        except OSError:
+            # not there, or other snapshots have groups
+            pass
+
+    def stage(self, snapshot, staging):
+        """ copy the members of snapshot to staging + member, ready to be
+            put in place by moves(). Returns the members copied, those
+            snapshot doesn't have or that aren't live are left as they
+            are. If one can't be copied the others are deleted again and an
+            exception raised, nothing live has been touched by then.
+        """
+        members = [m for m in self.members_of(snapshot)
+                   if self.storage.isdir(os.path.join(self.mp, m))]
+        staged = []
+        for member in members:
+            if not self.commands.btrfs_subvolume_snapshot(
+                    os.path.join(self._dir(snapshot), member),
+                    staging + member):
+                self.commands.btrfs_delete_snapshots(staged)
+                raise Exception("Could not create snapshot of %s" % member)
+            staged.append(staging + member)
+        return members
+
+    def moves(self, members, backup, staging):
+        """ the renames that replace the live members with those staged,
+            the replaced ones joining backup, the old @
+        """
+        if len(members) == 0:
+            return []
+        if not self.storage.isdir(self._dir(backup)):
+            self.storage.makedirs(self._dir(backup))
+        moves = []
+        for member in members:
+            moves.append((os.path.join(self.mp, member),
+                          os.path.join(self._dir(backup), member)))
+            moves.append((staging + member, os.path.join(self.mp, member)))
+        return moves
+
+    def record_generations(self, name):
+        """ remember the uuid and generation of the live members """
+        if len(self.members) == 0:
+            return
+        lines = []
+        for member in self.members:
+            generation = self.commands.btrfs_subvolume_generation(
+                os.path.join(self.mp, member))
+            if generation is None:
+                return
+            lines.append("%s %s %d\n" % ((member,) + generation))
+        self.storage.write(os.path.join(self._dir(name), GENERATIONS_FILE),
+                           "".join(lines))
+
+    def unchanged_since(self, name):
+        """ whether none of the live members has been written to since
+            snapshot name was made
+        """
+        if len(self.members) == 0:
+            return True
+        try:
+            data = self.storage.read(os.path.join(self._dir(name),
+                                                  GENERATIONS_FILE))
+            recorded = dict((member, (uuid, int(generation)))
+                            for member, uuid, generation in
+                            (line.split() for line in
+                             data.decode("utf-8").splitlines()))
+        except (IOError, ValueError):
+            return False
+        for member in self.members:
+            generation = self.commands.btrfs_subvolume_generation(
+                os.path.join(self.mp, member))
+            if generation is None or recorded.get(member) != generation:
+                return False
+        return True
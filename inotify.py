@@ -0,0 +1,103 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+
+# see linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event, without the trailing name
+_EVENT = struct.Struct(str("iIII"))
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+
+def _check(ret, path=None):
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), path)
+    return ret
+
+
+def parse_events(data):
+    """ split what was read from an inotify fd into (wd, mask, name) """
+    events = []
+    offset = 0
+    while offset + _EVENT.size <= len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        events.append((wd, mask, name.decode("utf-8", "replace")))
+    return events
+
+
+class Inotify(object):
+    """ a non blocking inotify instance, poll fileno() and call read() """
+
+    def __init__(self):
+        self.fd = _check(_get_libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """ watch path, returns the watch descriptor """
+        encoded = path
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode("utf-8")
+        wd = _check(_get_libc().inotify_add_watch(
+            self.fd, encoded, ctypes.c_uint32(mask)), path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self):
+        """ return the (path watched, mask, name) of the pending events """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError:
+            return []
+        return [(self.watches.get(wd), mask, name)
+                for wd, mask, name in parse_events(data)]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,168 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import time
+
+from storage import DiskStorage
+
+# relative to the root filesystem, so that snapshots take it along
+JOURNAL = "var/lib/apt-btrfs-snapshot/journal"
+MARKER = "@"
+NO_VERSION = "<none>"
+
+
+def _qualify(name, arch, native):
+    """ name packages the way extended_states and DpkgHistory do, only
+        those of a foreign architecture get it after a colon
+    """
+    if arch in (native, "all", "-", None):
+        return name
+    return "%s:%s" % (name, arch)
+
+
+def parse_hook_input(lines):
+    """ turn what apt tells a DPkg::Pre-Install-Pkgs hook with version 3 of
+        the protocol into a list of (op, package, old version, new version)
+    """
+    lines = iter(lines)
+    first = next(lines, "").strip()
+    if first != "VERSION 3":
+        raise ValueError("Unsupported hook protocol '%s'" % first)
+    native = None
+    # the configuration comes first, up to a blank line
+    for line in lines:
+        line = line.strip()
+        if line == "":
+            break
+        key, sep, value = line.partition("=")
+        if key == "APT::Architecture":
+            native = value
+    actions = []
+    for line in lines:
+        bits = line.split()
+        if len(bits) != 9:
+            continue
+        (name, old, old_arch, old_multi, direction, new, new_arch, new_multi,
+         action) = bits
+        if action == "**REMOVE**":
+            actions.append(("remove", _qualify(name, old_arch, native),
+                            old, NO_VERSION))
+        elif old == "-":
+            actions.append(("install", _qualify(name, new_arch, native),
+                            NO_VERSION, new))
+        elif action != "**CONFIGURE**":
+            actions.append(("upgrade", _qualify(name, new_arch, native),
+                            old, new))
+    return actions
+
+
+class Journal(object):
+    """ the package actions apt carried out on a root filesystem, as its
+        hook told us, with a marker line for each snapshot taken of it.
+        The actions that went into a snapshot are those between the last
+        two markers of its copy of the journal.
+    """
+
+    def __init__(self, root="/", storage=None):
+        self.path = os.path.join(root, JOURNAL)
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+
+    def exists(self):
+        return self.storage.lexists(self.path)
+
+    def record(self, actions):
+        """ append the actions of one apt run """
+        directory = os.path.dirname(self.path)
+        if not self.storage.isdir(directory):
+            self.storage.makedirs(directory)
+        lines = ["# %d\n" % time.time()]
+        lines.extend("%s %s %s %s\n" % action for action in actions)
+        self.storage.append(self.path, "".join(lines))
+
+    def mark(self, snap_id):
+        """ note that a snapshot is about to be taken, if there is a journal
+            at all
+        """
+        if not self.exists():
+            return False
+        self.storage.append(self.path, "%s %s\n" % (MARKER, snap_id))
+        return True
+
+    def _read(self):
+        """ return the actions after each marker, keyed by marker index """
+        segments = [[]]
+        markers = []
+        for line in self.storage.read(self.path).decode("utf-8").splitlines():
+            bits = line.split()
+            if len(bits) == 2 and bits[0] == MARKER:
+                markers.append(bits[1])
+                segments.append([])
+            elif len(bits) == 4:
+                segments[-1].append(tuple(bits))
+        return markers, segments
+
+    def actions(self, closed=False):
+        """ return the actions since the last marker or, if closed, those
+            between the last two markers. Returns None if the journal
+            doesn't go back that far.
+        """
+        try:
+            markers, segments = self._read()
+        except IOError:
+            return None
+        needed = 1
+        if closed:
+            needed = 2
+        if len(markers) < needed:
+            return None
+        if closed:
+            return segments[-2]
+        return segments[-1]
+
+    def compact(self):
+        """ drop everything before the last marker, the snapshots hold what
+            came before
+        """
+        try:
+            markers, segments = self._read()
+        except IOError:
+            return
+        if len(markers) == 0:
+            return
+        lines = ["%s %s\n" % (MARKER, markers[-1])]
+        lines.extend("%s %s %s %s\n" % action for action in segments[-1])
+        self.storage.write(self.path, "".join(lines))
+
+
+def record_hook_input(stream, root="/"):
+    """ the DPkg::Pre-Install-Pkgs hook, it must never get in apt's way """
+    # apt expects us to read all of it
+    lines = stream.read().splitlines()
+    try:
+        Journal(root).record(parse_hook_input(lines))
+    except (ValueError, IOError, OSError) as e:
+        print("apt-btrfs-snapshot: not recording package actions: %s" % e,
+              file=sys.stderr)
+    return 0
@@ -0,0 +1,129 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import fcntl
+import os
+import time
+
+
+# commands that only look, several may run at once
+READ_ONLY_COMMANDS = ("supported", "tree", "show", "status", "list",
+                      "list-older-than", "recent", "metrics")
+# commands that take the lock themselves, only while they need it. export
+# makes and deletes its clones under it, but sends the streams without it
+# so that apt doesn't wait for the export to end
+OWN_LOCK_COMMANDS = ("export",)
+TIMEOUT = 60
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def is_read_only(command, dry_run=False):
+    """ whether command leaves the volume as it is """
+    return command in READ_ONLY_COMMANDS or dry_run
+
+
+class VolumeLock(object):
+    """ a reader/writer lock, taken with flock on path. Given the top level
+        directory of a btrfs volume, every mount of it shares the lock, so
+        all the tools working on the volume take turns.
+        Readers share the lock, a writer has it to itself. Both wait for up
+        to timeout seconds and then raise LockTimeout.
+    """
+
+    def __init__(self, path, shared=False, timeout=TIMEOUT, interval=0.1,
+                 clock=time.time, sleep=time.sleep):
+        self.path = path
+        self.shared = shared
+        self.timeout = timeout
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+        self.fd = None
+        self.waited = False
+
+    def __repr__(self):
+        return "<VolumeLock %s %s>" % (
+            self.path, "shared" if self.shared else "exclusive")
+
+    def _open(self):
+        if os.path.isdir(self.path):
+            return os.open(self.path, os.O_RDONLY)
+        return os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    def acquire(self):
+        if self.shared:
+            operation = fcntl.LOCK_SH | fcntl.LOCK_NB
+        else:
+            operation = fcntl.LOCK_EX | fcntl.LOCK_NB
+        fd = self._open()
+        start = self.clock()
+        while True:
+            try:
+                fcntl.flock(fd, operation)
+                break
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            left = self.timeout - (self.clock() - start)
+            if left <= 0:
+                os.close(fd)
+                raise LockTimeout("Another instance held the lock on %s for "
+                                  "more than %d seconds" % (self.path,
+                                                            self.timeout))
+            self.waited = True
+            self.sleep(min(self.interval, left))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            # closing the last descriptor drops the lock
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class NullLock(object):
+    """ stands in for a VolumeLock where nobody else can get at the
+        volume, as when it is simulated in memory
+    """
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
@@ -0,0 +1,139 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import os
+import time
+
+
+PRESSURE_IO = "/proc/pressure/io"
+LOADAVG = "/proc/loadavg"
+
+
+def read_io_pressure(path=PRESSURE_IO):
+    """ return the percentage of the last 10 seconds during which some tasks
+        were stalled on io, or None if the kernel doesn't tell
+    """
+    try:
+        with open(path) as pressure:
+            for line in pressure:
+                bits = line.split()
+                if len(bits) == 0 or bits[0] != "some":
+                    continue
+                for bit in bits[1:]:
+                    key, sep, value = bit.partition("=")
+                    if key == "avg10":
+                        return float(value)
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def read_load(path=LOADAVG):
+    """ return the one minute load average, or None """
+    try:
+        with open(path) as loadavg:
+            return float(loadavg.read().split()[0])
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def _cpu_count():
+    try:
+        return os.sysconf(str("SC_NPROCESSORS_ONLN"))
+    except (ValueError, OSError):
+        return 1
+
+
+class Throttle(object):
+    """ paces maintenance work so that it doesn't hog the disks.
+        Work is done in batches, between batches it waits for the io
+        pressure and the load to drop below the given thresholds and stops
+        altogether once the time budget is spent.
+    """
+
+    def __init__(self, budget=None, max_pressure=10.0, max_load=None,
+                 batch_size=10, backoff=5, max_backoff=60, clock=time.time,
+                 sleep=time.sleep):
+        self.budget = budget
+        self.max_pressure = max_pressure
+        if max_load is None:
+            max_load = _cpu_count()
+        self.max_load = max_load
+        self.batch_size = batch_size
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.start = clock()
+
+    def __repr__(self):
+        return "<Throttle budget=%s max_pressure=%s max_load=%s>" % (
+            self.budget, self.max_pressure, self.max_load)
+
+    def time_left(self):
+        if self.budget is None:
+            return None
+        return self.budget - (self.clock() - self.start)
+
+    def under_pressure(self):
+        pressure = read_io_pressure()
+        if pressure is not None and pressure > self.max_pressure:
+            return True
+        load = read_load()
+        return load is not None and load > self.max_load
+
+    def wait(self):
+        """ back off while the system is busy, returns False if the budget
+            ran out in the meantime
+        """
+        delay = self.backoff
+        while True:
+            left = self.time_left()
+            if left is not None and left <= 0:
+                return False
+            if not self.under_pressure():
+                return True
+            if left is not None:
+                self.sleep(min(delay, left))
+            else:
+                self.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def run(self, items, work, between=None):
+        """ call work() on successive batches of items for as long as the
+            budget allows, returns the items that weren't dealt with.
+            between() is called before each batch but the first, e.g. to
+            wait for the btrfs cleaner to catch up, unless the budget is
+            spent already. It should give up once time_left() is.
+        """
+        items = list(items)
+        done = 0
+        while done < len(items):
+            if done > 0 and between is not None:
+                left = self.time_left()
+                if left is not None and left <= 0:
+                    break
+                between()
+            if not self.wait():
+                break
+            batch = items[done:done + self.batch_size]
+            work(batch)
+            done += len(batch)
+        return items[done:]
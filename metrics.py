@@ -0,0 +1,270 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import json
+import os
+import time
+
+from precheck import apt_config
+from storage import DiskStorage
+
+
+# where prometheus-node-exporter's textfile collector looks by default,
+# APT::Snapshots::MetricsDir says otherwise
+METRICS_DIR = "/var/lib/prometheus/node-exporter"
+METRICS_FILE = "apt_btrfs_snapshot.prom"
+CONFIG_KEY = "APT::Snapshots::MetricsDir"
+# how long the commands took, at the top level of the volume
+HISTORY_FILE = ".apt-btrfs-metrics"
+PREFIX = "apt_btrfs_snapshot_"
+TIMED_COMMANDS = ("create", "delete", "delete-older-than", "maintain",
+                  "reclaim")
+AGE_BUCKETS = (3600, 86400, 7 * 86400, 30 * 86400, 90 * 86400, 365 * 86400)
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def read_metrics_dir(config=None):
+    """ return the directory of the textfile collector, config is what
+        precheck.apt_config returned, asked for if None
+    """
+    if config is None:
+        config = apt_config()
+    return dict(config).get(CONFIG_KEY) or METRICS_DIR
+
+
+def timestamp(date):
+    return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+
+class Histogram(object):
+    """ counts of observations at most as large as each bucket, plus their
+        sum and count
+    """
+
+    def __init__(self, buckets, counts=None, total=0.0, count=0):
+        self.buckets = tuple(buckets)
+        if counts is None:
+            counts = [0] * len(self.buckets)
+        self.counts = list(counts)
+        self.total = total
+        self.count = count
+
+    def __repr__(self):
+        return "<Histogram %d observations>" % self.count
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def as_dict(self):
+        return {"buckets": self.buckets, "counts": self.counts,
+                "sum": self.total, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data, buckets):
+        if tuple(data.get("buckets", ())) != tuple(buckets):
+            # the buckets changed, start afresh
+            return cls(buckets)
+        return cls(buckets, data["counts"], data["sum"], data["count"])
+
+    def lines(self, name, labels=""):
+        bucket_labels = labels + "," if labels else ""
+        out = []
+        for bound, count in zip(self.buckets, self.counts):
+            out.append('%s_bucket{%sle="%s"} %d' % (
+                name, bucket_labels, _number(bound), count))
+        out.append('%s_bucket{%sle="+Inf"} %d' % (name, bucket_labels,
+                                                  self.count))
+        braces = "{%s}" % labels if labels else ""
+        out.append("%s_sum%s %s" % (name, braces, _number(self.total)))
+        out.append("%s_count%s %d" % (name, braces, self.count))
+        return out
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return "%d" % value
+
+
+class RunHistory(object):
+    """ when the timed commands last ran, how long they took and how often
+        they failed, kept in HISTORY_FILE so that the histograms add up
+        across runs
+    """
+
+    def __init__(self, path, storage=None):
+        self.path = path
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+        self.commands = {}
+        try:
+            self.commands = json.loads(storage.read(path).decode("utf-8"))
+        except (IOError, ValueError):
+            pass
+
+    def __repr__(self):
+        return "<RunHistory %s>" % self.path
+
+    def observe(self, command, seconds, ok, when=None):
+        if when is None:
+            when = time.time()
+        entry = self.commands.setdefault(command, {})
+        entry["last"] = when
+        entry["duration"] = seconds
+        entry["ok"] = bool(ok)
+        result = "success" if ok else "failure"
+        entry[result] = entry.get(result, 0) + 1
+        histogram = Histogram.from_dict(entry.get("histogram", {}),
+                                        DURATION_BUCKETS)
+        histogram.observe(seconds)
+        entry["histogram"] = histogram.as_dict()
+
+    def save(self):
+        self.storage.write(self.path, json.dumps(self.commands,
+                                                 sort_keys=True))
+
+
+class Metrics(object):
+    """ the lines of a node_exporter textfile """
+
+    def __init__(self):
+        self.out = []
+
+    def add(self, name, kind, help, samples):
+        """ samples are (labels, value) pairs, labels as in 'a="b"' """
+        self.out.append("# HELP %s%s %s" % (PREFIX, name, help))
+        self.out.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+        for labels, value in samples:
+            if labels:
+                labels = "{%s}" % labels
+            self.out.append("%s%s%s %s" % (PREFIX, name, labels,
+                                           _number(value)))
+
+    def add_histogram(self, name, help, histograms):
+        """ histograms are (labels, Histogram) pairs """
+        self.out.append("# HELP %s%s %s" % (PREFIX, name, help))
+        self.out.append("# TYPE %s%s histogram" % (PREFIX, name))
+        for labels, histogram in histograms:
+            self.out.extend(histogram.lines(PREFIX + name, labels))
+
+    def text(self):
+        return "\n".join(self.out) + "\n"
+
+
+def collect(snapshot_list, root_parent, now=None, history=None, trash=0,
+            sizes=None, space=None):
+    """ work out the metrics from the snapshots and their graph, root_parent
+        being the parent of @, the RunHistory, how many subvolumes wait in
+        the trash, the sizes known by name and the Space of the volume
+    """
+    if now is None:
+        now = time.time()
+    metrics = Metrics()
+    tagged = len([s for s in snapshot_list if s.tag != ""])
+    metrics.add("snapshots", "gauge", "Number of snapshots.",
+                [('tagged="false"', len(snapshot_list) - tagged),
+                 ('tagged="true"', tagged)])
+    if len(snapshot_list) > 0:
+        stamps = [timestamp(s.date) for s in snapshot_list]
+        metrics.add("oldest_snapshot_timestamp_seconds", "gauge",
+                    "When the oldest snapshot was taken.",
+                    [("", min(stamps))])
+        metrics.add("newest_snapshot_timestamp_seconds", "gauge",
+                    "When the newest snapshot was taken.",
+                    [("", max(stamps))])
+        ages = Histogram(AGE_BUCKETS)
+        for stamp in stamps:
+            ages.observe(max(0, int(now - stamp)))
+        metrics.add_histogram("snapshot_age_seconds", "Age of the snapshots.",
+                              [("", ages)])
+    ancestors = 0
+    snapshot = root_parent
+    while snapshot is not None:
+        ancestors += 1
+        snapshot = snapshot.parent
+    metrics.add("root_ancestors", "gauge",
+                "Number of snapshots @ descends from.", [("", ancestors)])
+    branches = len([s for s in snapshot_list if len(s.children) == 0])
+    metrics.add("branches", "gauge",
+                "Number of snapshots without children.", [("", branches)])
+    metrics.add("trash_subvolumes", "gauge",
+                "Number of deleted subvolumes waiting to be reclaimed.",
+                [("", trash)])
+    if sizes is not None:
+        known = [sizes[s.name] for s in snapshot_list if s.name in sizes]
+        metrics.add("sized_snapshots", "gauge",
+                    "Number of snapshots whose size is known.",
+                    [("", len(known))])
+        metrics.add("exclusive_bytes", "gauge",
+                    "Space only the snapshots of known size hold.",
+                    [("", sum(k[0] for k in known))])
+    if space is not None:
+        metrics.add("volume_size_bytes", "gauge",
+                    "Size of the volume holding the snapshots.",
+                    [("", space.total)])
+        metrics.add("volume_free_bytes", "gauge",
+                    "Free space of the volume holding the snapshots.",
+                    [("", space.free)])
+    if history is not None and len(history.commands) > 0:
+        commands = sorted(history.commands.items())
+        metrics.add("last_run_timestamp_seconds", "gauge",
+                    "When the command last ran.",
+                    [('command="%s"' % c, e["last"]) for c, e in commands])
+        metrics.add("last_run_duration_seconds", "gauge",
+                    "How long the command took when it last ran.",
+                    [('command="%s"' % c, e["duration"])
+                     for c, e in commands])
+        metrics.add("last_run_success", "gauge",
+                    "Whether the command succeeded when it last ran.",
+                    [('command="%s"' % c, int(e["ok"]))
+                     for c, e in commands])
+        runs = []
+        for command, entry in commands:
+            for result in ("success", "failure"):
+                runs.append(('command="%s",result="%s"' % (command, result),
+                             entry.get(result, 0)))
+        metrics.add("runs_total", "counter", "Number of runs of the command.",
+                    runs)
+        metrics.add_histogram("run_duration_seconds",
+                              "How long the command took.",
+                              [('command="%s"' % c, Histogram.from_dict(
+                                  e["histogram"], DURATION_BUCKETS))
+                               for c, e in commands])
+    return metrics
+
+
+def write_textfile(directory, text, name=METRICS_FILE):
+    """ replace directory/name with text at once, so that the collector
+        never reads half a file. The temporary file doesn't end in .prom,
+        the collector leaves it alone.
+    """
+    path = os.path.join(directory, name)
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, "w") as textfile:
+        textfile.write(text)
+        textfile.flush()
+        os.fsync(textfile.fileno())
+    os.rename(tmp, path)
+    return path
@@ -0,0 +1,98 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+import os
+import re
+
+from btrfs_ioctl import resolve_fs_spec
+
+
+MOUNTINFO = "/proc/self/mountinfo"
+# where the top level volume is kept mounted between runs
+RUN_DIR = "/run/apt-btrfs-snapshot"
+TOP_LEVEL_OPTIONS = "subvolid=5"
+
+_escaped = re.compile(r"\\([0-7]{3})")
+
+
+def _unescape(field):
+    """ mountinfo writes spaces and the like as \\040 """
+    return _escaped.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+class MountInfo(object):
+    """ a line of /proc/self/mountinfo """
+
+    def __init__(self, root, mountpoint, fstype, source, super_options):
+        self.root = root
+        self.mountpoint = mountpoint
+        self.fstype = fstype
+        self.source = source
+        self.super_options = super_options
+
+    @classmethod
+    def from_line(cls, line):
+        bits = line.split()
+        # optional fields come before the separator
+        sep = bits.index("-", 6)
+        return cls(_unescape(bits[3]), _unescape(bits[4]), bits[sep + 1],
+                   _unescape(bits[sep + 2]), bits[sep + 3].split(","))
+
+    def __repr__(self):
+        return "<MountInfo %s on %s>" % (self.root, self.mountpoint)
+
+    @property
+    def subvolid(self):
+        for option in self.super_options:
+            if option.startswith("subvolid="):
+                return option[len("subvolid="):]
+        return None
+
+
+def read_mountinfo(path=MOUNTINFO):
+    mounts = []
+    try:
+        with open(path) as mountinfo:
+            for line in mountinfo:
+                try:
+                    mounts.append(MountInfo.from_line(line))
+                except (ValueError, IndexError):
+                    continue
+    except IOError:
+        pass
+    return mounts
+
+
+def find_top_level_mount(fs_spec, path=MOUNTINFO):
+    """ return where the top level volume of the btrfs filesystem fs_spec is
+        already mounted, or None
+    """
+    device = os.path.realpath(resolve_fs_spec(fs_spec))
+    for mount in read_mountinfo(path):
+        if mount.fstype != "btrfs" or mount.root != "/":
+            continue
+        if mount.subvolid not in (None, "5"):
+            continue
+        if os.path.realpath(mount.source) != device:
+            continue
+        if os.path.isdir(mount.mountpoint):
+            return mount.mountpoint
+    return None
@@ -0,0 +1,242 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+
+from __future__ import print_function, unicode_literals
+
+# The checks apt's pre-invoke hook makes before anything else. Keep this
+# free of heavy imports, they should be over in a few milliseconds.
+
+import os
+import time
+
+
+# remembers the verdict of supported() until fstab changes
+SUPPORTED_CACHE = "/run/apt-btrfs-snapshot.supported"
+LAST_SNAPSHOT_FILE = "/run/apt_last_snapshot"
+# no new untagged snapshot within this many seconds of the last one, unless
+# APT::Snapshots::Coalesce says otherwise
+DEBOUNCE = 60
+COALESCE_CACHE = "/run/apt-btrfs-snapshot.coalesce"
+# remembers apt's settings for us until apt's configuration changes
+CONFIG_CACHE = "/run/apt-btrfs-snapshot.config"
+CONFIG_TREE = "APT::Snapshots"
+APT_CONF = ("/etc/apt/apt.conf", "/etc/apt/apt.conf.d")
+
+
+def _check_fstab(fstab):
+    from fstab import Fstab
+    entry = Fstab(fstab).get_supported_btrfs_root_fstab_entry()
+    return entry is not None
+
+
+def _read_cache(cache, key):
+    """ return what was stored in cache under key, or None """
+    try:
+        with open(cache) as cached:
+            stored_key, sep, value = cached.read().strip().rpartition(" ")
+            if stored_key == key:
+                return value
+    except IOError:
+        pass
+    return None
+
+
+def _write_cache(cache, key, value):
+    try:
+        with open(cache + ".tmp", "w") as cached:
+            cached.write("%s %s\n" % (key, value))
+        os.rename(cache + ".tmp", cache)
+    except (IOError, OSError):
+        # e.g. not root, the cache is only an optimisation
+        pass
+
+
+def supported(fstab="/etc/fstab", cache=None):
+    """ verify that the system supports apt btrfs snapshots
+        by checking if the right fs layout is used etc. If a cache file is
+        given the verdict is kept there until fstab is modified.
+    """
+    # check for the helper binary
+    if not os.path.exists("/sbin/btrfs"):
+        return False
+    if cache is None:
+        return _check_fstab(fstab)
+    try:
+        key = "%s %r" % (os.path.abspath(fstab), os.stat(fstab).st_mtime)
+    except OSError:
+        return False
+    verdict = _read_cache(cache, key)
+    if verdict is not None:
+        return verdict == "1"
+    verdict = _check_fstab(fstab)
+    _write_cache(cache, key, "%d" % verdict)
+    return verdict
+
+
+def _apt_conf_key():
+    """ the latest modification of apt's configuration """
+    latest = 0
+    for path in APT_CONF:
+        try:
+            latest = max(latest, os.stat(path).st_mtime)
+            entries = os.listdir(path)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                latest = max(latest,
+                             os.stat(os.path.join(path, entry)).st_mtime)
+            except OSError:
+                pass
+    return "%r" % latest
+
+
+def _read_coalesce():
+    import subprocess
+    try:
+        output = subprocess.check_output(
+            ["apt-config", "shell", "Coalesce", "APT::Snapshots::Coalesce"])
+    except (OSError, subprocess.CalledProcessError):
+        return DEBOUNCE
+    name, sep, value = output.strip().partition("=")
+    try:
+        return max(0, int(value.strip("'")))
+    except ValueError:
+        return DEBOUNCE
+
+
+def coalesce_window(cache=None):
+    """ return how many seconds after the last snapshot a new untagged one
+        is skipped: $APT_SNAPSHOTS_COALESCE, else APT::Snapshots::Coalesce,
+        else DEBOUNCE. If a cache file is given apt-config is only asked
+        again once apt's configuration changes.
+    """
+    value = os.environ.get("APT_SNAPSHOTS_COALESCE")
+    if value is not None:
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+    if cache is None:
+        return _read_coalesce()
+    key = _apt_conf_key()
+    window = _read_cache(cache, key)
+    if window is not None and window.isdigit():
+        return int(window)
+    window = _read_coalesce()
+    _write_cache(cache, key, "%d" % window)
+    return window
+
+
+def last_snapshot_time(path=LAST_SNAPSHOT_FILE):
+    """ return when the last snapshot was made, as a timestamp """
+    try:
+        with open(path) as last:
+            return float(last.readline())
+    except (IOError, ValueError):
+        # If we fail to read the timestamp for some reason, just return
+        # the default value silently
+        return 0.0
+
+
+def save_last_snapshot_time(when, path=LAST_SNAPSHOT_FILE):
+    """ record when the last snapshot was made, replacing the file at once
+        so that readers never see it half written
+    """
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, "w") as last:
+        last.write("%r\n" % when)
+    os.rename(tmp, path)
+
+
+def recent_snapshot(path=LAST_SNAPSHOT_FILE, now=None, window=None):
+    """ return the time of the last snapshot if it was made too recently
+        for an untagged snapshot to be worth making, otherwise None
+    """
+    if now is None:
+        now = time.time()
+    if window is None:
+        window = coalesce_window()
+    last = last_snapshot_time(path)
+    if window > 0 and last > now - window:
+        return last
+    return None
+
+
+def skip_create(fstab="/etc/fstab", cache=SUPPORTED_CACHE,
+                last_snapshot_file=LAST_SNAPSHOT_FILE,
+                coalesce_cache=COALESCE_CACHE):
+    """ return why the hook needn't create an untagged snapshot, or None if
+        it should. The reason is empty when there is nothing worth saying.
+    """
+    if "APT_NO_SNAPSHOTS" in os.environ:
+        return "Shell variable APT_NO_SNAPSHOTS found, skipping creation"
+    if not supported(fstab, cache):
+        return ""
+    last = recent_snapshot(last_snapshot_file,
+                           window=coalesce_window(coalesce_cache))
+    if last is not None:
+        import datetime
+        return "A recent snapshot already exists: %s" % (
+            datetime.datetime.fromtimestamp(last))
+    return None
+
+
+def _dump_config():
+    import subprocess
+    try:
+        output = subprocess.check_output(["apt-config", "dump", CONFIG_TREE])
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    config = []
+    for line in output.decode("utf-8").splitlines():
+        key, sep, value = line.partition(" ")
+        if key.startswith(CONFIG_TREE + "::"):
+            config.append((key, value.strip().rstrip(";").strip('"')))
+    return config
+
+
+def apt_config(cache=None):
+    """ return the (key, value) pairs of apt's configuration under
+        APT::Snapshots in order, the items of a list are keyed by its name
+        followed by "::". If a cache file is given apt-config is only asked
+        again once apt's configuration changes.
+    """
+    if cache is None:
+        return _dump_config()
+    key = _apt_conf_key()
+    try:
+        with open(cache) as cached:
+            lines = cached.read().decode("utf-8").splitlines()
+        config = [tuple(line.split("\t", 1)) for line in lines[1:]]
+        if lines and lines[0] == key and all(len(c) == 2 for c in config):
+            return config
+    except (IOError, UnicodeDecodeError):
+        pass
+    config = _dump_config()
+    lines = [key] + ["%s\t%s" % item for item in config]
+    try:
+        with open(cache + ".tmp", "w") as cached:
+            cached.write("".join("%s\n" % line
+                                 for line in lines).encode("utf-8"))
+        os.rename(cache + ".tmp", cache)
+    except (IOError, OSError):
+        # as for the other caches
+        pass
+    return config
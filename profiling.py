@@ -0,0 +1,202 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import types
+from contextlib import contextmanager
+
+
+# for hooks, set to "-" to print a breakdown on stderr or to the path of a
+# log to append a line of json to
+PROFILE_ENV = "APT_SNAPSHOTS_PROFILE"
+# the path to dump cProfile's statistics to, see pstats
+CPROFILE_ENV = "APT_SNAPSHOTS_CPROFILE"
+
+
+def cpu_time():
+    """ the cpu time used by this process so far, user and system """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class Phase(object):
+    """ the calls to one function: how many, their wall and cpu time and
+        how much of the wall time was spent outside other phases
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.own = 0.0
+
+    def __repr__(self):
+        return "<Phase %s %d calls %.3fs>" % (self.name, self.calls,
+                                              self.wall)
+
+    def as_dict(self):
+        return {"name": self.name, "calls": self.calls, "wall": self.wall,
+                "cpu": self.cpu, "self": self.own}
+
+
+class Profiler(object):
+    """ times every call to the functions instrumented, as phases named
+        after them. Phases called from within others are counted in both,
+        the self time of a phase leaves out the time spent in the others.
+    """
+
+    def __init__(self, command, started=None, clock=time.time,
+                 cpu=cpu_time):
+        self.command = command
+        self.clock = clock
+        self.cpu = cpu
+        self.phases = {}
+        self.started_cpu = cpu()
+        if started is None:
+            started = clock()
+        else:
+            # the time it took to get here, imports and all, cpu time is
+            # then counted from the start of the process
+            startup = self.phases["startup"] = Phase("startup")
+            startup.calls = 1
+            startup.wall = startup.own = clock() - started
+            startup.cpu = self.started_cpu
+            self.started_cpu = 0.0
+        self.started = started
+        self.patched = []
+        self.cprofile = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Profiler %s %d phases>" % (self.command, len(self.phases))
+
+    def instrument(self, owner, names=None):
+        """ time the functions of owner, a class or a module, or only those
+            named. Special methods are left alone but for __init__.
+        """
+        if names is None:
+            names = [n for n in vars(owner)
+                     if not n.startswith("__") or n == "__init__"]
+        for name in names:
+            func = vars(owner).get(name)
+            if not isinstance(func, types.FunctionType):
+                continue
+            label = "%s.%s" % (owner.__name__.split(".")[-1], name)
+            self.patched.append((owner, name, func))
+            setattr(owner, name, self._wrap(label, func))
+
+    def restore(self):
+        """ undo instrument() """
+        for owner, name, func in reversed(self.patched):
+            setattr(owner, name, func)
+        self.patched = []
+
+    def _wrap(self, label, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.phase(label):
+                return func(*args, **kwargs)
+        return timed
+
+    @contextmanager
+    def phase(self, label):
+        """ time the block as the phase label """
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        # the time spent in the phases nested in this one
+        stack.append(0.0)
+        start, start_cpu = self.clock(), self.cpu()
+        try:
+            yield
+        finally:
+            wall = self.clock() - start
+            cpu = self.cpu() - start_cpu
+            nested = stack.pop()
+            if len(stack) > 0:
+                stack[-1] += wall
+            with self.lock:
+                phase = self.phases.get(label)
+                if phase is None:
+                    phase = self.phases[label] = Phase(label)
+                phase.calls += 1
+                phase.wall += wall
+                phase.cpu += cpu
+                phase.own += wall - nested
+
+    def start_cprofile(self):
+        import cProfile
+        self.cprofile = cProfile.Profile()
+        self.cprofile.enable()
+
+    def dump_cprofile(self, path):
+        self.cprofile.disable()
+        self.cprofile.dump_stats(path)
+
+    def sorted_phases(self):
+        return sorted(self.phases.values(), key=lambda p: (-p.wall, p.name))
+
+    def report(self, out=None):
+        """ print a breakdown of the time spent, slowest phases first """
+        if out is None:
+            out = sys.stderr
+        print("Profile of %s: %.3fs wall, %.3fs cpu" % (
+            self.command, self.clock() - self.started,
+            self.cpu() - self.started_cpu), file=out)
+        print("%8s %9s %9s %9s  %s" % ("calls", "wall", "cpu", "self",
+                                       "phase"), file=out)
+        for phase in self.sorted_phases():
+            print("%8d %8.3fs %8.3fs %8.3fs  %s" % (
+                phase.calls, phase.wall, phase.cpu, phase.own, phase.name),
+                file=out)
+
+    def record(self, path):
+        """ append the profile to the log at path as a line of json """
+        entry = {
+            "time": self.started,
+            "command": self.command,
+            "pid": os.getpid(),
+            "wall": self.clock() - self.started,
+            "cpu": self.cpu() - self.started_cpu,
+            "phases": [p.as_dict() for p in self.sorted_phases()],
+        }
+        with open(path, "a") as log:
+            log.write(json.dumps(entry, sort_keys=True) + "\n")
+
+    def finish(self, profile=None, cprofile=None):
+        """ write out the results where profile and cprofile say, see
+            PROFILE_ENV and CPROFILE_ENV
+        """
+        if cprofile and self.cprofile is not None:
+            self.dump_cprofile(cprofile)
+        if profile == "-":
+            self.report()
+        elif profile:
+            try:
+                self.record(profile)
+            except IOError as e:
+                print("Could not write the profile: %s" % e, file=sys.stderr)
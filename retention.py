@@ -0,0 +1,112 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import datetime
+
+
+# grandfather-father-son periods, newest snapshot of each period is kept
+PERIODS = (
+    ("hourly", lambda d: (d.year, d.month, d.day, d.hour)),
+    ("daily", lambda d: (d.year, d.month, d.day)),
+    ("weekly", lambda d: tuple(d.isocalendar()[:2])),
+    ("monthly", lambda d: (d.year, d.month)),
+)
+
+
+def parse_days(timefmt):
+    """ turn "10d" into a timedelta of 10 days """
+    if isinstance(timefmt, datetime.timedelta):
+        return timefmt
+    if not timefmt.endswith("d"):
+        raise Exception("Please specify time in days (e.g. 10d)")
+    return datetime.timedelta(int(timefmt[:-1]))
+
+
+class RetentionPolicy(object):
+    """ decides which snapshots to keep.
+        Untagged snapshots younger than max_age are kept, older ones only if
+        they are the newest of one of the last N hours, days, weeks or
+        months. On top of that no more than max_count untagged snapshots are
+        kept. Tagged snapshots are kept, unless their tag has a rule in tags
+        saying to keep only the newest N with that tag.
+    """
+
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0,
+                 max_age=None, max_count=None, tags=None):
+        self.keep = {"hourly": hourly, "daily": daily, "weekly": weekly,
+                     "monthly": monthly}
+        if max_age is not None:
+            max_age = parse_days(max_age)
+        self.max_age = max_age
+        self.max_count = max_count
+        if tags is None:
+            tags = {}
+        self.tags = tags
+
+    def __repr__(self):
+        rules = ["%s=%d" % (p, self.keep[p]) for p, key in PERIODS
+                 if self.keep[p] > 0]
+        if self.max_age is not None:
+            rules.append("max_age=%dd" % self.max_age.days)
+        if self.max_count is not None:
+            rules.append("max_count=%d" % self.max_count)
+        for tag in sorted(self.tags):
+            rules.append("tag:%s=%d" % (tag, self.tags[tag]))
+        return "<RetentionPolicy %s>" % " ".join(rules)
+
+    def plan(self, snapshot_list, protect=(), now=None):
+        """ return the lists of snapshots to keep and to delete, evaluating
+            every rule in a single pass from the newest snapshot to the
+            oldest. Snapshots in protect are always kept.
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        seen = dict((period, set()) for period, key in PERIODS)
+        tagged = {}
+        untagged = 0
+        keep, delete = [], []
+        for snapshot in sorted(snapshot_list, key=lambda x: x.date,
+                               reverse=True):
+            if snapshot in protect:
+                keep.append(snapshot)
+                continue
+            tag = snapshot.tag
+            if tag != "":
+                tagged[tag] = tagged.get(tag, 0) + 1
+                if tag not in self.tags or tagged[tag] <= self.tags[tag]:
+                    keep.append(snapshot)
+                else:
+                    delete.append(snapshot)
+                continue
+            wanted = (self.max_age is None or
+                      now - snapshot.date <= self.max_age)
+            for period, key in PERIODS:
+                buckets = seen[period]
+                bucket = key(snapshot.date)
+                if bucket not in buckets and len(buckets) < self.keep[period]:
+                    buckets.add(bucket)
+                    wanted = True
+            if wanted and (self.max_count is None or
+                           untagged < self.max_count):
+                untagged += 1
+                keep.append(snapshot)
+            else:
+                delete.append(snapshot)
+        return keep, delete
@@ -0,0 +1,106 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import time
+
+from extents import estimate_tree
+from storage import DiskStorage
+
+
+# the sizes the extent walk found, at the top level of the volume
+SIZES_FILE = ".apt-btrfs-sizes"
+# how long a walk may go on for
+WALK_BUDGET = 300
+
+
+class SizeCache(object):
+    """ the exclusive and referenced bytes of the snapshots walked, each
+        valid for as long as the uuid and generation of its snapshot, its
+        key, stay the same and no snapshot that was on the volume when they
+        were saved has gone. Deleting one can leave data that was shared
+        with it to another alone, while a new snapshot changes nothing for
+        the older ones.
+    """
+
+    def __init__(self, path, names, storage=None):
+        self.path = path
+        self.names = set(names)
+        if storage is None:
+            storage = DiskStorage()
+        self.storage = storage
+        self.entries = {}
+        self.load()
+
+    def __repr__(self):
+        return "<SizeCache %s %d entries>" % (self.path, len(self.entries))
+
+    def load(self):
+        self.entries = {}
+        try:
+            lines = self.storage.read(self.path).decode("utf-8").splitlines()
+            # the snapshots there were, "/" can't be in their names
+            saved = lines[0].strip() if lines else ""
+            if saved and not set(saved.split("/")) <= self.names:
+                return
+            for line in lines[1:]:
+                name, key, exclusive, referenced = line.split()
+                self.entries[name] = (key, int(exclusive), int(referenced))
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, name, key):
+        entry = self.entries.get(name)
+        if key is None or entry is None or entry[0] != key:
+            return None
+        return entry[1:]
+
+    def known(self):
+        """ return the sizes saved by name, without checking that their
+            snapshots are unchanged since
+        """
+        return dict((name, entry[1:]) for name, entry in self.entries.items())
+
+    def put(self, name, key, sizes):
+        if key is not None:
+            self.entries[name] = (key,) + tuple(sizes)
+
+    def save(self):
+        lines = ["%s\n" % "/".join(sorted(self.names))]
+        lines.extend("%s %s %d %d\n" % ((name,) + self.entries[name])
+                     for name in sorted(self.entries))
+        self.storage.write(self.path, "".join(lines))
+
+
+def walk(cache, jobs, budget=WALK_BUDGET, clock=time.time):
+    """ measure the snapshots of jobs, (name, path, key) tuples, with the
+        extent walk of estimate_tree until the budget runs out, saving them
+        into cache as it goes. Returns the sizes found by name.
+    """
+    deadline = clock() + budget
+    found = {}
+    for name, path, key in jobs:
+        if clock() >= deadline:
+            break
+        estimate = estimate_tree(path)
+        found[name] = (estimate.freed, estimate.bytes)
+        cache.put(name, key, found[name])
+        if key is not None:
+            cache.save()
+    return found
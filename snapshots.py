@@ -20,19 +20,41 @@ from __future__ import print_function, unicode_literals
 
 import datetime
 import os
-import cPickle as pickle
 
-from dpkg_history import DpkgHistory
+from precheck import apt_config
+from storage import DiskStorage
 
 
 SNAP_PREFIX = "@apt-snapshot-"
+# a snapshot is named SNAP_PREFIX + stamp + "-" + tag, where the stamp is
+# the date to the second, followed by the microseconds when another
+# snapshot was made in the same second
+STAMP_FORMAT = "%Y-%m-%d_%H:%M:%S"
+STAMP_LENGTH = 19
 CHANGES_FILE = "etc/apt-btrfs-changes"
+# present while the changes are yet to be worked out from the dpkg logs
+PENDING_FILE = "etc/apt-btrfs-changes.pending"
 PARENT_LINK = "etc/apt-btrfs-parent"
+# the uuid and generation of @ just after the snapshot was made of it
+GENERATION_FILE = "etc/apt-btrfs-generation"
 PARENT_DOTS = "../../"
+# deleted snapshots wait here until they are reclaimed
+TRASH_DIR = "@apt-btrfs-trash"
+# read-only snapshots keep the files above in META_DIR/<snapshot name>/
+META_DIR = "@apt-btrfs-meta"
+SIDECAR_NAMES = {
+    PARENT_LINK: "parent",
+    CHANGES_FILE: "changes",
+    PENDING_FILE: "changes.pending",
+    GENERATION_FILE: "generation",
+}
+READ_ONLY_KEY = "APT::Snapshots::ReadOnly"
 
 # mp is the mountpoint of the btrfs volume root. It will be set by 
 # the setup function called from AptBtrfsSnapshot.__init__
 mp = None
+# everything below is read and written through it, see storage
+storage = None
 
 list_of = None
 parents, children, orphans = {}, {}, []
@@ -42,12 +64,106 @@ class BadSnapshotError(Exception):
     pass
 
 
-def setup(mountpoint):
-    global mp, list_of
+def setup(mountpoint, store=None):
+    global mp, list_of, storage
     mp = mountpoint
+    if store is None:
+        store = DiskStorage()
+    storage = store
     _make_list()
     _parse_tree()
 
+def parse_name(name):
+    """ split the name of a snapshot into its date, stamp and tag, raises
+        ValueError if it isn't one
+    """
+    if not name.startswith(SNAP_PREFIX):
+        raise ValueError("Not a snapshot: %s" % name)
+    rest = name[len(SNAP_PREFIX):]
+    stamp = rest[:STAMP_LENGTH]
+    date = datetime.datetime.strptime(stamp, STAMP_FORMAT)
+    rest = rest[STAMP_LENGTH:]
+    if rest.startswith("."):
+        fraction = rest[1:7]
+        if len(fraction) != 6 or not fraction.isdigit():
+            raise ValueError("Bad stamp in %s" % name)
+        date = date.replace(microsecond=int(fraction))
+        stamp += rest[:7]
+        rest = rest[7:]
+    return date, stamp, rest[1:]
+
+
+def make_stamp(date, taken=()):
+    """ return the stamp for a snapshot made at date, precise to the second
+        unless that one is taken, in which case the microseconds are added,
+        so that the stamps still sort by date
+    """
+    stamp = date.strftime(STAMP_FORMAT)
+    while stamp in taken:
+        stamp = "%s.%06d" % (date.strftime(STAMP_FORMAT), date.microsecond)
+        date += datetime.timedelta(microseconds=1)
+    return stamp
+
+
+def new_name(tag="", date=None):
+    """ return a name for a snapshot made now that no snapshot on the volume
+        has, whatever their tags. tag is either empty or starts with "-"
+    """
+    if date is None:
+        date = datetime.datetime.now()
+    taken = set()
+    for e in storage.listdir(mp):
+        try:
+            taken.add(parse_name(e)[1])
+        except ValueError:
+            continue
+    return SNAP_PREFIX + make_stamp(date, taken) + tag
+
+
+def read_only_config(config=None):
+    """ whether APT::Snapshots::ReadOnly asks for read-only snapshots,
+        config is what precheck.apt_config returned, asked for if None
+    """
+    if config is None:
+        config = apt_config()
+    value = dict(config).get(READ_ONLY_KEY, "")
+    # as apt-config reads a boolean
+    return value.lower() in ("1", "yes", "true", "with", "on", "enable")
+
+
+def meta_path(name, item):
+    """ return where the snapshot called name keeps item, e.g. CHANGES_FILE:
+        in META_DIR if it has a directory there, in itself otherwise
+    """
+    sidecar = os.path.join(mp, META_DIR, name)
+    if storage.isdir(sidecar):
+        return os.path.join(sidecar, SIDECAR_NAMES[item])
+    return os.path.join(mp, name, item)
+
+
+def make_sidecar(name):
+    """ keep the metadata of snapshot name outside of it from now on """
+    storage.makedirs(os.path.join(mp, META_DIR, name))
+
+
+def has_sidecar(name):
+    return storage.isdir(os.path.join(mp, META_DIR, name))
+
+
+def rename_sidecar(old, new):
+    if has_sidecar(old):
+        storage.rename(os.path.join(mp, META_DIR, old),
+                       os.path.join(mp, META_DIR, new))
+
+
+def remove_sidecar(name):
+    sidecar = os.path.join(mp, META_DIR, name)
+    if storage.isdir(sidecar):
+        for entry in storage.listdir(sidecar):
+            storage.remove(os.path.join(sidecar, entry))
+        storage.rmdir(sidecar)
+
+
 def get_list(older_than=False):
     """ return the list of available snapshots
         If "older_than" is given (as a datetime) it will only include
@@ -71,15 +187,89 @@ def first_common_ancestor(one, another):
         younger = younger.parent
         if younger == None or younger == older:
             return younger
-            
+
+
+class Ancestry(object):
+    """ the ancestors of every snapshot, worked out once from the parents
+        found by _parse_tree, so that first_common_ancestor takes O(log n)
+        rather than a walk up the tree for every question
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.snapshots = []
+        for snapshot in list_of + [Snapshot("@")] + parents.values():
+            if snapshot is not None:
+                self._add(snapshot)
+        count = len(self.snapshots)
+        # roots hang from an extra node standing for "no ancestor"
+        parent = [count] * (count + 1)
+        self.monotonic = True
+        for i, snapshot in enumerate(self.snapshots):
+            above = parents.get(snapshot.name)
+            if above is not None:
+                parent[i] = self.index[above.name]
+                if not above.date < snapshot.date:
+                    self.monotonic = False
+        if not self.monotonic:
+            # walking up by date, as first_common_ancestor does, won't
+            # find the common ancestor, so only it can say what it finds
+            return
+        # when dates grow from parent to child, parents come first by date
+        order = sorted(range(count), key=lambda i: self.snapshots[i].date)
+        self.depth = [0] * (count + 1)
+        for i in order:
+            if parent[i] != count:
+                self.depth[i] = self.depth[parent[i]] + 1
+        self.up = [parent]
+        while (1 << len(self.up)) <= count:
+            half = self.up[-1]
+            self.up.append([half[half[i]] for i in range(count + 1)])
+
+    def _add(self, snapshot):
+        if snapshot.name not in self.index:
+            self.index[snapshot.name] = len(self.snapshots)
+            self.snapshots.append(snapshot)
+
+    def first_common_ancestor(self, one, another):
+        """ the same as first_common_ancestor(one, another) """
+        if (not self.monotonic or one.name not in self.index or
+                another.name not in self.index):
+            return first_common_ancestor(one, another)
+        a = self.index[one.name]
+        b = self.index[another.name]
+        if a == b:
+            # first_common_ancestor steps up once before comparing
+            a = self.up[0][a]
+        else:
+            if self.depth[a] < self.depth[b]:
+                a, b = b, a
+            climb = self.depth[a] - self.depth[b]
+            level = 0
+            while climb:
+                if climb & 1:
+                    a = self.up[level][a]
+                climb >>= 1
+                level += 1
+            if a != b:
+                for level in reversed(range(len(self.up))):
+                    if self.up[level][a] != self.up[level][b]:
+                        a = self.up[level][a]
+                        b = self.up[level][b]
+                a = self.up[0][a]
+        if a == len(self.snapshots):
+            return None
+        return self.snapshots[a]
+
+
 
 def _make_list():
     """ make the list of available snapshots """
     global list_of
     list_of = []
-    for e in os.listdir(mp):
+    for e in storage.listdir(mp):
         pos = len(SNAP_PREFIX)
-        if e.startswith(SNAP_PREFIX) and len(e) >= pos + 19:
+        if e.startswith(SNAP_PREFIX) and len(e) >= pos + STAMP_LENGTH:
             try:
                 list_of.append(Snapshot(e))
             except BadSnapshotError:
@@ -97,15 +287,15 @@ def _parse_tree():
     snapshots.append(Snapshot("@"))
     for snapshot in snapshots:
         name = str(snapshot)
-        parent_file = os.path.join(mp, name, PARENT_LINK)
+        parent_file = meta_path(name, PARENT_LINK)
         try:
-            link_to = os.readlink(parent_file)
+            link_to = storage.readlink(parent_file)
         except OSError:
             orphans.append(snapshot)
             continue
         path, parent = os.path.split(link_to)
         parents[name] = Snapshot(parent)
-        if parent in children.keys():
+        if parent in children:
             children[parent].append(snapshot)
         else:
             children[parent] = [snapshot]
@@ -124,10 +314,8 @@ class Snapshot(object):
         self.name = name
         
         # date
-        pos = len(SNAP_PREFIX)
-        date = name[pos:pos + 19]
         try:
-            self.date = datetime.datetime.strptime(date, "%Y-%m-%d_%H:%M:%S")
+            self.date = parse_name(name)[0]
         except ValueError:
             if self.name != "@":
                 raise BadSnapshotError
@@ -158,23 +346,88 @@ class Snapshot(object):
         return False
     
     def _get_changes(self):
-        changes_file = os.path.join(mp, self.name, CHANGES_FILE)
+        import cPickle as pickle
+        self.finalise_changes()
+        changes_file = meta_path(self.name, CHANGES_FILE)
         try:
-            history = pickle.load(open(changes_file, "rb"))
+            history = pickle.loads(storage.read(changes_file))
             return history
         except IOError:
             return None
     
     def _set_changes(self, changes):
-        changes_file = os.path.join(mp, self.name, CHANGES_FILE)
+        changes_file = meta_path(self.name, CHANGES_FILE)
         if changes is None:
-            if os.path.exists(changes_file):
-                os.remove(changes_file)
+            if storage.lexists(changes_file):
+                storage.remove(changes_file)
         else:
-            pickle.dump(changes, open(changes_file, "wb"))
+            import cPickle as pickle
+            storage.write(changes_file, pickle.dumps(changes))
+        # whatever was pending is superseded
+        pending_file = meta_path(self.name, PENDING_FILE)
+        if storage.lexists(pending_file):
+            storage.remove(pending_file)
+
+    def _get_changes_pending(self):
+        return storage.lexists(meta_path(self.name, PENDING_FILE))
+
+    def mark_changes_pending(self, since, until, var_location="/var/"):
+        """ note that the changes of this snapshot are those found in the
+            dpkg logs in var_location between since and until, to be worked
+            out later by finalise_changes()
+        """
+        pending_file = meta_path(self.name, PENDING_FILE)
+        note = ""
+        for key, value in (("since", since), ("until", until)):
+            if value is not None:
+                note += "%s=%s\n" % (key, value.strftime("%Y-%m-%d_%H:%M:%S"))
+        note += "var=%s\n" % var_location
+        storage.write(pending_file, note)
+
+    def finalise_changes(self):
+        """ work out the changes noted as pending, if any. It is safe to
+            call this again, or from several processes at once, the changes
+            file is replaced atomically.
+        """
+        pending_file = meta_path(self.name, PENDING_FILE)
+        try:
+            pending = storage.read(pending_file).decode("utf-8")
+        except IOError:
+            return
+        note = dict(line.split("=", 1) for line in pending.splitlines()
+                    if "=" in line)
+        changes_file = meta_path(self.name, CHANGES_FILE)
+        if not storage.lexists(changes_file):
+            import cPickle as pickle
+            from dpkg_history import DpkgHistory
+            history = DpkgHistory(since=note.get("since"),
+                                  until=note.get("until"),
+                                  var_location=note.get("var", "/var/"))
+            storage.write(changes_file, pickle.dumps(history))
+        try:
+            storage.remove(pending_file)
+        except OSError:
+            # somebody else finished first
+            pass
     
+    def _get_generation(self):
+        generation_file = meta_path(self.name, GENERATION_FILE)
+        try:
+            uuid, generation = storage.read(generation_file).split()
+            return uuid.decode("utf-8"), int(generation)
+        except (IOError, ValueError):
+            return None
+
+    def _set_generation(self, generation):
+        generation_file = meta_path(self.name, GENERATION_FILE)
+        if generation is None:
+            if storage.lexists(generation_file):
+                storage.remove(generation_file)
+        else:
+            storage.write(generation_file, "%s %d\n" % generation)
+
     def _get_parent(self):
-        if self.name in parents.keys():
+        if self.name in parents:
             return parents[self.name]
         return None
 
@@ -183,25 +436,28 @@ class Snapshot(object):
             or deletes it if parent == None 
         """
         old_parent = self.parent
-        parent_file = os.path.join(mp, self.name, PARENT_LINK)
+        parent_file = meta_path(self.name, PARENT_LINK)
         # remove parent link from self
-        if os.path.lexists(parent_file):
-            os.remove(parent_file)
+        if storage.lexists(parent_file):
+            storage.remove(parent_file)
         # link to parent
         if parent is not None:
             parent_path = os.path.join(PARENT_DOTS, str(parent))
-            os.symlink(parent_path, parent_file)
+            storage.symlink(parent_path, parent_file)
 
     def _get_children(self):
-        if self.name in children.keys():
+        if self.name in children:
             return children[self.name]
         return []
     
+    def _get_stamp(self):
+        return parse_name(self.name)[1]
+
     def _get_tag(self):
-        pos = len(SNAP_PREFIX)
-        if len(self.name) > pos + 19:
-            return self.name[pos + 20:]
-        return ""
+        try:
+            return parse_name(self.name)[2]
+        except ValueError:
+            return ""
 
     def will_delete(self):
         """ correct parent links and change info for a snapshot about to be
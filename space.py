@@ -0,0 +1,173 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import os
+import time
+
+from cleaner import format_size
+from precheck import apt_config
+
+
+# create wants at least this much free space on the volume, in bytes (with
+# an optional K, M, G or T suffix) or as a percentage of its size
+MIN_FREE = "1G"
+# what to do when there is less: "prune" deletes the oldest untagged
+# snapshots for up to BUDGET seconds, "refuse" only takes no snapshot
+ON_LOW_SPACE = "prune"
+ACTIONS = ("prune", "refuse")
+BUDGET = 20
+# making a snapshot needs some metadata space, whatever the data says
+MIN_METADATA = 64 * 1024 * 1024
+CONFIG_KEYS = (
+    ("MinFree", "APT::Snapshots::MinFree"),
+    ("OnLowSpace", "APT::Snapshots::OnLowSpace"),
+    ("PruneBudget", "APT::Snapshots::PruneBudget"),
+)
+UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_threshold(text):
+    """ turn "500M", "1G" or "5%" into (bytes, percent) """
+    text = text.strip().upper()
+    if text.endswith("%"):
+        return 0, float(text[:-1])
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]]), 0
+    return int(text), 0
+
+
+class Space(object):
+    """ the size and free space of a volume, unallocated and metadata are
+        None when btrfs won't say
+    """
+
+    def __init__(self, total, free, unallocated=None, metadata=None):
+        self.total = total
+        self.free = free
+        self.unallocated = unallocated
+        self.metadata = metadata
+
+    def __repr__(self):
+        return "<Space %d of %d free>" % (self.free, self.total)
+
+
+def measure(path, commands=None):
+    """ return the Space of the volume mounted at path """
+    st = os.statvfs(path)
+    unallocated = metadata = None
+    if commands is not None:
+        res = commands.btrfs_space(path)
+        if res is not None:
+            unallocated, metadata = res
+    return Space(st.f_blocks * st.f_frsize, st.f_bavail * st.f_frsize,
+                 unallocated, metadata)
+
+
+def read_space_config(config=None):
+    """ return the settings for SpaceGuard found in apt's configuration,
+        config is what precheck.apt_config returned, asked for if None
+    """
+    if config is None:
+        config = apt_config()
+    found = dict(config)
+    values = dict((name, found.get(key)) for name, key in CONFIG_KEYS)
+    settings = {}
+    for name, arg in (("MinFree", "min_free"), ("OnLowSpace", "action"),
+                      ("PruneBudget", "budget")):
+        if values.get(name):
+            settings[arg] = values[name]
+    return settings
+
+
+class SpaceGuard(object):
+    """ keeps snapshots from filling the volume halfway through an upgrade.
+        When there is less free space than min_free, or too little room for
+        metadata, the oldest untagged snapshots are deleted until there is
+        enough, or with action "refuse" no snapshot is taken. Either way it
+        gives up after budget seconds so as not to hold apt up.
+    """
+
+    def __init__(self, min_free=MIN_FREE, action=ON_LOW_SPACE, budget=BUDGET,
+                 min_metadata=MIN_METADATA, settle=2, interval=0.5,
+                 clock=time.time, sleep=time.sleep):
+        try:
+            self.min_bytes, self.min_percent = parse_threshold(min_free)
+        except ValueError:
+            raise Exception("Invalid free space threshold '%s'" % min_free)
+        if action not in ACTIONS:
+            raise Exception("Unknown action on low space '%s', choose "
+                            "from: %s" % (action, ", ".join(ACTIONS)))
+        self.min_free = min_free
+        self.action = action
+        self.budget = float(budget)
+        self.min_metadata = min_metadata
+        self.settle = settle
+        self.interval = interval
+        self.clock = clock
+        self.sleep = sleep
+
+    def __repr__(self):
+        return "<SpaceGuard min_free=%s action=%s budget=%s>" % (
+            self.min_free, self.action, self.budget)
+
+    def threshold(self, space):
+        return max(self.min_bytes, int(space.total * self.min_percent / 100))
+
+    def shortfall(self, space):
+        """ say what space lacks, or return None if it will do """
+        if space.free < self.threshold(space):
+            return "%s free, %s wanted" % (format_size(space.free),
+                                           format_size(self.threshold(space)))
+        if space.metadata is not None and space.metadata < self.min_metadata:
+            return "%s left for metadata" % format_size(space.metadata)
+        return None
+
+    def admit(self, measure, candidates, prune):
+        """ return whether there is room for a snapshot. measure() returns
+            the Space of the volume, prune(snapshot, timeout) deletes one of
+            candidates, which are taken oldest first, and waits up to
+            timeout seconds for its space to be freed.
+        """
+        deadline = self.clock() + self.budget
+        why = self.shortfall(measure())
+        if why is None:
+            return True
+        print("Low on space: %s" % why)
+        if self.action == "refuse":
+            return False
+        for snapshot in sorted(candidates, key=lambda s: s.date):
+            # a prune is only worth it with time left to see the space back
+            if deadline - self.clock() < self.settle:
+                break
+            print("Deleting %s to make room" % snapshot.name)
+            # measuring before the btrfs cleaner is done would see too
+            # little come back and have more snapshots deleted than need be
+            prune(snapshot, deadline - self.clock())
+            # and the free space may lag behind a little more
+            settled = min(deadline, self.clock() + self.settle)
+            while True:
+                why = self.shortfall(measure())
+                if why is None:
+                    return True
+                if self.clock() + self.interval > settled:
+                    break
+                self.sleep(self.interval)
+        print("Still low on space: %s" % why)
+        return False
@@ -0,0 +1,357 @@
+# Copyright (C) 2013 jpeg729
+#
+# Author:
+#  jpeg729
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from __future__ import print_function, unicode_literals
+
+import errno
+import os
+from collections import Counter
+
+
+class Storage(object):
+    """ how the snapshots and their metadata are read and written, paths
+        being absolute as on the mounted volume. Each operation is counted
+        in ops, and charged what costs says it costs, in seconds, which add
+        up in charged.
+    """
+
+    # whether the volume only exists in memory
+    simulated = False
+
+    def __init__(self, costs=None):
+        self.costs = dict(costs or {})
+        self.ops = Counter()
+        self.charged = 0.0
+
+    def _charge(self, op):
+        self.ops[op] += 1
+        self.charged += self.costs.get(op, 0.0)
+
+    def reset(self):
+        """ start counting again """
+        self.ops = Counter()
+        self.charged = 0.0
+
+
+class DiskStorage(Storage):
+    """ the files as they are on disk """
+
+    def __repr__(self):
+        return "<DiskStorage>"
+
+    def listdir(self, path):
+        self._charge("listdir")
+        return os.listdir(path)
+
+    def isdir(self, path):
+        self._charge("stat")
+        return os.path.isdir(path)
+
+    def lexists(self, path):
+        self._charge("stat")
+        return os.path.lexists(path)
+
+    def makedirs(self, path):
+        self._charge("mkdir")
+        os.makedirs(path)
+
+    def mkdir(self, path):
+        self._charge("mkdir")
+        os.mkdir(path)
+
+    def rename(self, old, new):
+        self._charge("rename")
+        os.rename(old, new)
+
+    def remove(self, path):
+        self._charge("remove")
+        os.remove(path)
+
+    def rmdir(self, path):
+        self._charge("rmdir")
+        os.rmdir(path)
+
+    def readlink(self, path):
+        self._charge("readlink")
+        return os.readlink(path)
+
+    def symlink(self, target, path):
+        self._charge("symlink")
+        os.symlink(target, path)
+
+    def read(self, path):
+        self._charge("read")
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write(self, path, data):
+        """ replace the file at path with data at once """
+        self._charge("write")
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def append(self, path, data):
+        """ add data to the end of the file at path, making it if need be """
+        self._charge("append")
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        with open(path, "ab") as f:
+            f.write(data)
+
+
+class Link(object):
+
+    def __init__(self, target):
+        self.target = target
+
+
+class Directory(dict):
+
+    def __init__(self, readonly=False):
+        super(Directory, self).__init__()
+        self.readonly = readonly
+
+
+def _error(code, path, cls=OSError):
+    return cls(code, os.strerror(code), path)
+
+
+def _copy(node, readonly=False):
+    if not isinstance(node, Directory):
+        return node
+    copy = Directory(readonly)
+    for name, child in node.items():
+        copy[name] = _copy(child)
+    return copy
+
+
+class MemoryStorage(Storage):
+    """ a volume simulated in memory, mounted nowhere but said to be at mp.
+        Directories are dicts of their entries, files are their data and
+        symlinks Links, subvolumes are directories, read-only if made so.
+    """
+
+    simulated = True
+
+    def __init__(self, mp="/simulated", costs=None):
+        super(MemoryStorage, self).__init__(costs)
+        self.mp = mp
+        self.root = Directory()
+
+    def __repr__(self):
+        return "<MemoryStorage %s>" % self.mp
+
+    def _parts(self, path):
+        relative = os.path.relpath(os.path.normpath(path), self.mp)
+        if relative == ".":
+            return []
+        if relative.startswith(".."):
+            raise _error(errno.ENOENT, path)
+        return relative.split(os.sep)
+
+    def _lookup(self, path, cls=OSError):
+        node = self.root
+        for part in self._parts(path):
+            if not isinstance(node, Directory) or part not in node:
+                raise _error(errno.ENOENT, path, cls)
+            node = node[part]
+        return node
+
+    def _parent(self, path, cls=OSError):
+        """ return the directory holding path and the name in it, refusing
+            to change read-only subvolumes
+        """
+        parts = self._parts(path)
+        if len(parts) == 0:
+            raise _error(errno.EBUSY, path, cls)
+        node = self.root
+        readonly = False
+        for part in parts[:-1]:
+            if not isinstance(node, Directory) or part not in node:
+                raise _error(errno.ENOENT, path, cls)
+            node = node[part]
+            readonly = readonly or getattr(node, "readonly", False)
+        if not isinstance(node, Directory):
+            raise _error(errno.ENOTDIR, path, cls)
+        if readonly:
+            raise _error(errno.EROFS, path, cls)
+        return node, parts[-1]
+
+    def listdir(self, path):
+        self._charge("listdir")
+        node = self._lookup(path)
+        if not isinstance(node, Directory):
+            raise _error(errno.ENOTDIR, path)
+        return list(node)
+
+    def isdir(self, path):
+        self._charge("stat")
+        try:
+            return isinstance(self._lookup(path), Directory)
+        except OSError:
+            return False
+
+    def lexists(self, path):
+        self._charge("stat")
+        try:
+            self._lookup(path)
+        except OSError:
+            return False
+        return True
+
+    def makedirs(self, path):
+        self._charge("mkdir")
+        parts = self._parts(path)
+        node = self.root
+        for i, part in enumerate(parts):
+            if part not in node:
+                self._parent(os.path.join(self.mp, *parts[:i + 1]))
+                node[part] = Directory()
+            elif i == len(parts) - 1:
+                raise _error(errno.EEXIST, path)
+            node = node[part]
+            if not isinstance(node, Directory):
+                raise _error(errno.ENOTDIR, path)
+
+    def mkdir(self, path):
+        self._charge("mkdir")
+        parent, name = self._parent(path)
+        if name in parent:
+            raise _error(errno.EEXIST, path)
+        parent[name] = Directory()
+
+    def rename(self, old, new):
+        self._charge("rename")
+        old_parent, old_name = self._parent(old)
+        if old_name not in old_parent:
+            raise _error(errno.ENOENT, old)
+        new_parent, new_name = self._parent(new)
+        replaced = new_parent.get(new_name)
+        if isinstance(replaced, Directory) and len(replaced) > 0:
+            raise _error(errno.ENOTEMPTY, new)
+        new_parent[new_name] = old_parent.pop(old_name)
+
+    def remove(self, path):
+        self._charge("remove")
+        parent, name = self._parent(path)
+        if name not in parent:
+            raise _error(errno.ENOENT, path)
+        if isinstance(parent[name], Directory):
+            raise _error(errno.EISDIR, path)
+        del parent[name]
+
+    def rmdir(self, path):
+        self._charge("rmdir")
+        parent, name = self._parent(path)
+        if not isinstance(parent.get(name), Directory):
+            raise _error(errno.ENOENT if name not in parent
+                         else errno.ENOTDIR, path)
+        if len(parent[name]) > 0:
+            raise _error(errno.ENOTEMPTY, path)
+        del parent[name]
+
+    def readlink(self, path):
+        self._charge("readlink")
+        node = self._lookup(path)
+        if not isinstance(node, Link):
+            raise _error(errno.EINVAL, path)
+        return node.target
+
+    def symlink(self, target, path):
+        self._charge("symlink")
+        parent, name = self._parent(path)
+        if name in parent:
+            raise _error(errno.EEXIST, path)
+        parent[name] = Link(target)
+
+    def read(self, path):
+        self._charge("read")
+        node = self._lookup(path, IOError)
+        if isinstance(node, Directory):
+            raise _error(errno.EISDIR, path, IOError)
+        if isinstance(node, Link):
+            return self.read(os.path.join(os.path.dirname(path),
+                                          node.target))
+        return node
+
+    def write(self, path, data):
+        self._charge("write")
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        parent, name = self._parent(path, IOError)
+        if isinstance(parent.get(name), Directory):
+            raise _error(errno.EISDIR, path, IOError)
+        parent[name] = bytes(data)
+
+    def append(self, path, data):
+        self._charge("append")
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        parent, name = self._parent(path, IOError)
+        if isinstance(parent.get(name), (Directory, Link)):
+            raise _error(errno.EISDIR, path, IOError)
+        parent[name] = parent.get(name, b"") + bytes(data)
+
+    def snapshot(self, source, dest, readonly=False):
+        """ make dest a copy of the subvolume source, returns success as
+            btrfs subvolume snapshot does
+        """
+        self._charge("snapshot")
+        try:
+            node = self._lookup(source)
+            parent, name = self._parent(dest)
+        except OSError:
+            return False
+        if not isinstance(node, Directory) or name in parent:
+            return False
+        parent[name] = _copy(node, readonly)
+        return True
+
+    def delete(self, path):
+        """ delete the subvolume at path, whatever it holds """
+        self._charge("delete")
+        try:
+            parent, name = self._parent(path)
+        except OSError:
+            return False
+        if not isinstance(parent.get(name), Directory):
+            return False
+        del parent[name]
+        return True
+
+    def load(self, directory, path=None):
+        """ copy the files, directories and symlinks in directory on disk
+            to path, the top level by default, e.g. test/data/model_root
+        """
+        if path is None:
+            path = self.mp
+        for entry in sorted(os.listdir(directory)):
+            source = os.path.join(directory, entry)
+            dest = os.path.join(path, entry)
+            if os.path.islink(source):
+                self.symlink(os.readlink(source), dest)
+            elif os.path.isdir(source):
+                self.mkdir(dest)
+                self.load(source, dest)
+            else:
+                with open(source, "rb") as f:
+                    self.write(dest, f.read())
@@ -14,6 +14,7 @@ import sys
 import unittest
 import datetime
 import shutil
+import subprocess
 import time
 import cPickle as pickle
 import types
@@ -21,17 +22,28 @@ import types
 sys.path.insert(0, "..")
 sys.path.insert(0, ".")
 import snapshots
+from exporter import EXPORT_DIR
+from journal import Journal
+from retention import RetentionPolicy
 from apt_btrfs_snapshot import (
     Fstab,
     AptBtrfsSnapshot,
     LowLevelCommands,
+    NO_HISTORY,
     supported, 
 )
+from sizes import SIZES_FILE
+from space import (
+    Space,
+    SpaceGuard,
+)
 from snapshots import (
     PARENT_LINK, 
     CHANGES_FILE, 
     SNAP_PREFIX, 
     PARENT_DOTS, 
+    TRASH_DIR,
+    META_DIR,
     Snapshot, 
 )
 
@@ -88,6 +100,49 @@ class TestMounting(unittest.TestCase):
         self.assertTrue(mock_mount.called)
         self.assertFalse(mock_umount.called)
     
+    @mock.patch('apt_btrfs_snapshot.find_top_level_mount')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.mount')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.umount')
+    def test_reuse_mounted_root_volume(self, mock_umount, mock_mount,
+                                       mock_find):
+        mock_find.return_value = self.sandbox
+        with AptBtrfsSnapshot(fstab=os.path.join(self.testdir, "data",
+                                                 "fstab")) as apt_btrfs:
+            self.assertEqual(apt_btrfs.mp, self.sandbox)
+        self.assertFalse(mock_mount.called)
+        self.assertFalse(mock_umount.called)
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.make_private')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.mount')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.umount')
+    def test_persistent_mount(self, mock_umount, mock_mount,
+                              mock_private):
+        mock_mount.return_value = True
+        run_dir = os.path.join(self.sandbox, "run", "apt-btrfs-snapshot")
+        with mock.patch('apt_btrfs_snapshot.RUN_DIR', run_dir):
+            apt_btrfs = AptBtrfsSnapshot(
+                fstab=os.path.join(self.testdir, "data", "fstab"),
+                persistent_mount=True)
+        self.assertEqual(apt_btrfs.mp, run_dir)
+        self.assertEqual(mock_mount.call_args[0][1:], (run_dir, "subvolid=5"))
+        mock_private.assert_called_with(run_dir)
+        apt_btrfs.close()
+        self.assertFalse(mock_umount.called)
+        self.assertTrue(os.path.isdir(run_dir))
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.mount')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.umount')
+    def test_temporary_mount_closed(self, mock_umount, mock_mount):
+        mock_mount.return_value = True
+        with AptBtrfsSnapshot(fstab=os.path.join(self.testdir, "data",
+                                                 "fstab")) as apt_btrfs:
+            mp = apt_btrfs.mp
+            self.assertFalse(mock_umount.called)
+        mock_umount.assert_called_once_with(mp)
+        self.assertFalse(os.path.exists(mp))
+        apt_btrfs.close()
+        self.assertEqual(mock_umount.call_count, 1)
+
     def test_parser_older_than_to_datetime(self):
         apt_btrfs = AptBtrfsSnapshot(
             fstab=os.path.join(self.testdir, "data", "fstab"),
@@ -98,8 +153,53 @@ class TestMounting(unittest.TestCase):
         self.assertTrue(e - t < datetime.timedelta(0, 1))
     
 
+class TestLowLevelCommands(unittest.TestCase):
+
+    @mock.patch('os.path.lexists')
+    @mock.patch('subprocess.call')
+    def test_btrfs_delete_snapshots(self, mock_call, mock_lexists):
+        mock_call.return_value = 0
+        commands = LowLevelCommands()
+        paths = ["/mp/@apt-snapshot-%d" % i for i in range(150)]
+        self.assertEqual(commands.btrfs_delete_snapshots(paths), [])
+        self.assertEqual(mock_call.call_count, 2)
+        args = mock_call.call_args_list[0][0][0]
+        self.assertEqual(args[:3], ["btrfs", "subvolume", "delete"])
+        self.assertEqual(args[3:], paths[:100])
+        
+        mock_call.reset_mock()
+        mock_call.return_value = 1
+        mock_lexists.side_effect = lambda p: p == paths[1]
+        failed = commands.btrfs_delete_snapshots(paths[:3], commit="after")
+        self.assertEqual(failed, [paths[1]])
+        args = mock_call.call_args[0][0]
+        self.assertEqual(args, ["btrfs", "subvolume", "delete",
+            "--commit-after"] + paths[:3])
+
+    @mock.patch('subprocess.check_output')
+    def test_btrfs_sizes(self, mock_output):
+        commands = LowLevelCommands()
+        mock_output.return_value = (
+            b"ID 256 gen 120 top level 5 uuid 1111 path @\n"
+            b"ID 257 gen 100 top level 5 uuid 2222 path "
+            b"@apt-snapshot-2013-08-06_13:26:30\n")
+        self.assertEqual(commands.btrfs_subvolume_list("/mp"), {
+            "@": (256, 120, "1111"),
+            SNAP_PREFIX + "2013-08-06_13:26:30": (257, 100, "2222")})
+        mock_output.return_value = (
+            b"qgroupid         rfer         excl \n"
+            b"--------         ----         ---- \n"
+            b"0/256      4294967296     16384 \n"
+            b"0/257      4294901760   1048576 \n")
+        self.assertEqual(commands.btrfs_qgroup_show("/mp"), {
+            256: (16384, 4294967296), 257: (1048576, 4294901760)})
+        # quotas are not enabled
+        mock_output.side_effect = subprocess.CalledProcessError(1, "btrfs")
+        self.assertEqual(commands.btrfs_qgroup_show("/mp"), None)
+
+
 # fake low level snapshot
-def mock_snapshot_fn(source, dest):
+def mock_snapshot_fn(source, dest, readonly=False):
     shutil.copytree(source, dest, symlinks=True)
     return True
 mock_snapshot = mock.Mock(side_effect=mock_snapshot_fn)
@@ -110,6 +210,15 @@ def mock_delete_fn(which):
     return True
 mock_delete = mock.Mock(side_effect=mock_delete_fn)
 
+# fake low level batched delete
+def mock_delete_many_fn(which, commit=None):
+    for i in which:
+        shutil.rmtree(i)
+    return []
+mock_delete_many = mock.Mock(side_effect=mock_delete_many_fn)
+
+@mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_delete_snapshots',
+    new=mock_delete_many)
 @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_delete_snapshot',
     new=mock_delete)
 @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_snapshot',
@@ -153,6 +262,11 @@ class TestSnapshotting(unittest.TestCase):
                 newdir = i
         return res, newdir
     
+    def create_and_find_new(self, *args, **kwargs):
+        # as a new run would, starting with the snapshots as they are now
+        self.apt_btrfs.reload()
+        return self.do_and_find_new(self.apt_btrfs.create, *args, **kwargs)
+
     def assert_child_parent_linked(self, child, parent):
         # check parent has been fixed in children
         parent_file = os.path.join(self.sandbox, 
@@ -223,11 +337,217 @@ class TestSnapshotting(unittest.TestCase):
         self.assertTrue(output.startswith(expected))
         del os.environ['APT_NO_SNAPSHOTS']
 
+    @mock.patch('sys.stdout')
+    def test_create_without_coalescing(self, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            res, first = self.do_and_find_new(self.apt_btrfs.create)
+            res, second = self.do_and_find_new(self.apt_btrfs.create)
+        self.assertTrue(res)
+        self.assertNotEqual(second, None)
+        self.assertTrue(Snapshot(first).date < Snapshot(second).date)
+        self.assertTrue(first < second)
+        self.assert_child_parent_linked(second, first)
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_generation')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_filesystem_sync')
+    @mock.patch('sys.stdout')
+    def test_create_skips_unchanged(self, mock_stdout, mock_sync,
+                                    mock_generation):
+        mock_stdout.side_effect = StringIO()
+        mock_sync.return_value = True
+        mock_generation.return_value = ("uuid", 1234)
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            res, first = self.create_and_find_new()
+            self.assertEqual(Snapshot(first).generation, ("uuid", 1234))
+            res, newdir = self.create_and_find_new()
+            self.assertTrue(res)
+            self.assertEqual(newdir, None)
+            output = extract_stdout(mock_stdout, last_line_only=True)
+            self.assertEqual(output, "Nothing has changed since %s, "
+                             "skipping creation" % first)
+            # unless forced, or tagged
+            res, newdir = self.create_and_find_new(force=True)
+            self.assertNotEqual(newdir, None)
+            res, newdir = self.create_and_find_new("-tag")
+            self.assertNotEqual(newdir, None)
+            # something was written
+            mock_generation.return_value = ("uuid", 1240)
+            res, newdir = self.create_and_find_new()
+            self.assertNotEqual(newdir, None)
+            # if btrfs can't tell nothing is recorded
+            mock_generation.return_value = ("uuid", 1250)
+            mock_sync.return_value = False
+            res, newdir = self.create_and_find_new()
+            self.assertEqual(Snapshot(newdir).generation, None)
+            res, newdir = self.create_and_find_new()
+            self.assertNotEqual(newdir, None)
+
+    @mock.patch('sys.stdout')
+    def test_create_read_only(self, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        os.mkdir(os.path.join(self.sandbox, META_DIR))
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            res, newdir = self.create_and_find_new(read_only=True)
+        self.assertTrue(res)
+        self.assertTrue(
+            LowLevelCommands.btrfs_subvolume_snapshot.call_args[1]["readonly"])
+        # the metadata is beside the snapshot, not in it
+        sidecar = os.path.join(self.sandbox, META_DIR, newdir)
+        self.assertEqual(os.readlink(os.path.join(sidecar, "parent")),
+            os.path.join(PARENT_DOTS, SNAP_PREFIX + "2013-08-06_13:26:30"))
+        history = pickle.load(open(os.path.join(sidecar, "changes"), "rb"))
+        self.assertEqual(len(history['install']), 10)
+        self.assert_child_parent_linked("@", newdir)
+        self.apt_btrfs.reload()
+        self.assertEqual(Snapshot(newdir).parent.name,
+                         SNAP_PREFIX + "2013-08-06_13:26:30")
+
+        # it is left alone by clean
+        self.apt_btrfs.clean(dry_run=True)
+        output = extract_stdout(mock_stdout)
+        self.assertIn("Skipping read-only snapshot %s" % newdir, output)
+
+        # its metadata follows it when tagged and goes when it is deleted
+        self.apt_btrfs.tag(newdir, "-tag")
+        self.assertFalse(os.path.exists(sidecar))
+        tagged = newdir + "-tag"
+        self.assertTrue(os.path.isdir(
+            os.path.join(self.sandbox, META_DIR, tagged)))
+        self.assert_child_parent_linked("@", tagged)
+        self.apt_btrfs.reload()
+        self.apt_btrfs.delete(tagged)
+        self.assertEqual(os.listdir(os.path.join(self.sandbox, META_DIR)), [])
+        self.assert_child_parent_linked("@",
+            SNAP_PREFIX + "2013-08-06_13:26:30")
+
+    @mock.patch('apt_btrfs_snapshot.measure')
+    @mock.patch('sys.stdout')
+    def test_create_makes_room(self, mock_stdout, mock_measure):
+        mock_stdout.side_effect = StringIO()
+        low, enough = Space(10 << 30, 1 << 20), Space(10 << 30, 2 << 30)
+        mock_measure.side_effect = [low, enough]
+        self.apt_btrfs.space_guard = SpaceGuard()
+        oldest = SNAP_PREFIX + "2013-07-26_14:50:53"
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            res, newdir = self.create_and_find_new()
+        self.assertTrue(res)
+        self.assertNotEqual(newdir, None)
+        self.assertFalse(os.path.exists(os.path.join(self.sandbox, oldest)))
+        output = extract_stdout(mock_stdout)
+        self.assertIn("Deleting %s to make room" % oldest, output)
+
+        # or refuses, without failing apt
+        mock_measure.side_effect = None
+        mock_measure.return_value = low
+        self.apt_btrfs.space_guard = SpaceGuard(action="refuse")
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            res, newdir = self.create_and_find_new()
+        self.assertTrue(res)
+        self.assertEqual(newdir, None)
+        output = extract_stdout(mock_stdout, last_line_only=True)
+        self.assertEqual(output,
+                         "WARNING: not enough free space, no snapshot was taken")
+
+    @mock.patch('apt_btrfs_snapshot.measure')
+    @mock.patch('sys.stdout')
+    def test_make_room_prunes_alone(self, mock_stdout, mock_measure):
+        mock_stdout.side_effect = StringIO()
+        low, enough = Space(10 << 30, 1 << 20), Space(10 << 30, 2 << 30)
+        mock_measure.side_effect = [low, low, enough]
+        self.apt_btrfs.space_guard = SpaceGuard(settle=0)
+        # left there by an earlier delete
+        waiting = os.path.join(self.sandbox, TRASH_DIR, "waiting")
+        os.makedirs(waiting)
+        mock_delete_many.reset_mock()
+        commands = self.apt_btrfs.commands
+        with mock.patch.object(commands, "btrfs_subvolume_sync") as mock_sync, \
+                mock.patch.object(commands, "btrfs_filesystem_sync") as \
+                mock_commit:
+            self.assertTrue(self.apt_btrfs._make_room(None))
+        oldest = SNAP_PREFIX + "2013-07-26_14:50:53"
+        # the branch points and the tagged one are skipped
+        pruned = SNAP_PREFIX + "2013-08-05_04:30:58"
+        self.assertEqual(mock_delete_many.call_args_list, [
+            mock.call([os.path.join(self.sandbox, TRASH_DIR, name)],
+                      commit="after") for name in (oldest, pruned)])
+        # each time the cleaner is waited for, within the budget
+        self.assertEqual(mock_sync.call_count, 2)
+        self.assertTrue(0 < mock_sync.call_args[1]["timeout"] <= 20)
+        self.assertEqual(mock_commit.call_count, 2)
+        self.assertTrue(os.path.exists(waiting))
+        for name in ("2013-07-31_00:00:04", "2013-08-01_19:53:16",
+                     "2013-08-02_00:24:00"):
+            self.assertTrue(os.path.exists(os.path.join(
+                self.sandbox, SNAP_PREFIX + name)))
+
+    @mock.patch('os.fork')
+    @mock.patch('apt_btrfs_snapshot.AptBtrfsSnapshot._save_last_snapshot_time')
+    @mock.patch('apt_btrfs_snapshot.AptBtrfsSnapshot._get_var_location')
+    def test_create_changes_in_background(self, mock_var, mock_save,
+                                          mock_fork):
+        mock_var.return_value = os.path.join(self.testdir, "data", "var")
+        # pretend to be the parent of the worker
+        mock_fork.return_value = 1234
+        self.apt_btrfs.test = False
+        res, newdir = self.do_and_find_new(self.apt_btrfs.create, "-tag")
+        self.apt_btrfs.test = True
+        self.assertTrue(res)
+        self.assertTrue(mock_fork.called)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sandbox, newdir, CHANGES_FILE)))
+        # the worker never came, the changes are worked out when read
+        self.assertTrue(Snapshot(newdir).changes_pending)
+        self.assertEqual(len(Snapshot(newdir).changes['install']), 10)
+        self.assertFalse(Snapshot(newdir).changes_pending)
+
+    def test_create_changes_from_journal(self):
+        journal = Journal(os.path.join(self.sandbox, "@"))
+        journal.record([("install", "zsh", "<none>", "4.3.17-1ubuntu1")])
+        journal.mark(SNAP_PREFIX + "2013-08-06_13:26:30")
+        journal.record([("upgrade", "bash", "4.2-2", "4.2-3")])
+        parent, history = self.apt_btrfs._get_status()
+        self.assertEqual(history['upgrade'], [("bash", "4.2-2, 4.2-3")])
+        
+        res, newdir = self.do_and_find_new(self.apt_btrfs.create, "-tag")
+        self.assertTrue(res)
+        self.assertFalse(Snapshot(newdir).changes_pending)
+        history = self.load_changes(newdir)
+        self.assertEqual(history['upgrade'], [("bash", "4.2-2, 4.2-3")])
+        self.assertEqual(history['install'], [])
+        # the journal of @ starts afresh
+        self.assertEqual(journal.actions(), [])
+        parent, history = self.apt_btrfs._get_status()
+        self.assertEqual(history, NO_HISTORY)
+
+    @mock.patch('sys.stdout')
+    def test_btrfs_delete_snapshot_dry_run(self, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        which = SNAP_PREFIX + "2013-07-31_00:00:04"
+        with mock.patch('extents.file_usage') as mock_usage:
+            mock_usage.return_value = (4096, 0)
+            self.assertTrue(self.apt_btrfs.delete(which, dry_run=True))
+        output = extract_stdout(mock_stdout)
+        self.assertEqual(output, "Deleting %s would free about 0 bytes of "
+                         "its 347 bytes\n" % which)
+        self.assertTrue(os.path.exists(os.path.join(self.sandbox, which)))
+
     def test_btrfs_delete_snapshot(self):
         which = SNAP_PREFIX + "2013-07-31_00:00:04"
+        clone = os.path.join(self.sandbox, EXPORT_DIR, which)
+        os.makedirs(clone)
         res = self.apt_btrfs.delete(which)
         self.assertTrue(res)
         self.assertFalse(os.path.exists(os.path.join(self.sandbox, which)))
+        # the snapshot is kept in the trash until it is reclaimed, so is
+        # its export clone
+        trash = os.path.join(self.sandbox, TRASH_DIR)
+        self.assertTrue(os.path.isdir(os.path.join(trash, which)))
+        self.assertFalse(os.path.exists(clone))
+        self.assertTrue(os.path.isdir(os.path.join(trash, which + ".export")))
+        self.assertNotIn(which, [s.name for s in snapshots.get_list()])
+        snapshots.setup(self.sandbox)
+        self.assertNotIn(which, [s.name for s in snapshots.get_list()])
         # check parent has been fixed in children
         self.assert_child_parent_linked(SNAP_PREFIX + "2013-08-01_19:53:16",
             SNAP_PREFIX + "2013-07-26_14:50:53")
@@ -407,6 +727,66 @@ class TestSnapshotting(unittest.TestCase):
 """
         self.assertEqual(output, expected)
 
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_qgroup_show')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_list')
+    @mock.patch('sys.stdout')
+    def test_sizes_from_qgroups(self, mock_stdout, mock_list, mock_qgroups):
+        mock_stdout.side_effect = StringIO()
+        newest = SNAP_PREFIX + "2013-08-09_21:09:40"
+        mock_list.return_value = {"@": (256, 120, "1111"),
+                                  newest: (257, 100, "2222")}
+        mock_qgroups.return_value = {256: (16384, 4 << 30),
+                                     257: (1 << 20, 3 << 30)}
+        self.apt_btrfs.list(sizes=True)
+        output = extract_stdout(mock_stdout)
+        self.assertIn("%s  (1.0 MiB exclusive, 3.0 GiB referenced)\n" %
+                      newest, output)
+        self.assertIn("%s  (size not known yet)\n" %
+                      (SNAP_PREFIX + "2013-08-09_21:08:01"), output)
+        self.assertFalse(os.path.exists(os.path.join(self.sandbox,
+                                                     SIZES_FILE)))
+        self.apt_btrfs.show(newest, sizes=True)
+        output = extract_stdout(mock_stdout)
+        self.assertIn("Size: 1.0 MiB exclusive, 3.0 GiB referenced\n",
+                      output)
+        self.apt_btrfs.tree(sizes=True)
+        output = extract_stdout(mock_stdout)
+        self.assertIn("@ (+17)\n", output)
+        self.assertIn("%s (unknown) [1.0 MiB]\n" % newest, output)
+        self.assertIn("%s (unknown) [?]\n" %
+                      (SNAP_PREFIX + "2013-08-09_21:08:01"), output)
+
+    @mock.patch('sizes.estimate_tree')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_qgroup_show')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_list')
+    @mock.patch('sys.stdout')
+    def test_sizes_walked_and_cached(self, mock_stdout, mock_list,
+                                     mock_qgroups, mock_estimate):
+        mock_stdout.side_effect = StringIO()
+        mock_list.return_value = dict(
+            (s.name, (300 + i, 100 + i, "uuid%d" % i))
+            for i, s in enumerate(snapshots.get_list()))
+        mock_qgroups.return_value = None
+        mock_estimate.return_value = mock.Mock(freed=2048, bytes=4096)
+        self.apt_btrfs.list(sizes=True)
+        count = len(snapshots.get_list())
+        self.assertEqual(mock_estimate.call_count, count)
+        output = extract_stdout(mock_stdout)
+        self.assertEqual(output.count("(2.0 KiB exclusive, 4.0 KiB "
+                                      "referenced)"), count)
+        self.assertTrue(os.path.exists(os.path.join(self.sandbox,
+                                                    SIZES_FILE)))
+        # the next listings cost nothing
+        self.apt_btrfs.list(sizes=True)
+        self.assertEqual(mock_estimate.call_count, count)
+        # until a snapshot is written to
+        which = SNAP_PREFIX + "2013-08-06_13:26:30"
+        mock_list.return_value[which] = (400, 500, "uuid")
+        self.apt_btrfs.list(sizes=True)
+        self.assertEqual(mock_estimate.call_count, count + 1)
+        self.assertEqual(mock_estimate.call_args[0][0],
+                         os.path.join(self.sandbox, which))
+
     def test_tag(self):
         self.apt_btrfs.tag(SNAP_PREFIX + "2013-07-31_00:00:04", "-tag")
         dirlist = os.listdir(self.sandbox)
@@ -425,7 +805,18 @@ class TestSnapshotting(unittest.TestCase):
         self.assert_child_parent_linked(SNAP_PREFIX + "2013-07-31_12:53:16-tag",
             SNAP_PREFIX + "2013-07-31_00:00:04-tag")
 
-    def test_clean_apt_cache(self):
+    @mock.patch('sys.stdout')
+    def test_clean_apt_cache(self, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        self.apt_btrfs.clean(dry_run=True)
+        output = extract_stdout(mock_stdout)
+        self.assertEqual(output, "Would remove 2 files (0 bytes) from "
+            "@apt-snapshot-2013-08-07_18:00:42\n"
+            "Would remove 2 files (0 bytes) in total\n")
+        path = os.path.join(self.sandbox, 
+            SNAP_PREFIX + "2013-08-07_18:00:42", "var/cache/apt/archives")
+        self.assertTrue(os.path.exists(os.path.join(path, "a.deb")))
+        
         self.apt_btrfs.clean()
         path = os.path.join(self.sandbox, "@/var/cache/apt/archives")
         self.assertTrue(os.path.exists(os.path.join(path, "a.deb")))
@@ -435,10 +826,83 @@ class TestSnapshotting(unittest.TestCase):
         self.assertFalse(os.path.exists(os.path.join(path, "b.deb")))
         self.assertTrue(os.path.exists(os.path.join(path, "other_file")))
 
+    def test_reclaim(self):
+        trash = os.path.join(self.sandbox, TRASH_DIR)
+        self.assertTrue(self.apt_btrfs.reclaim())
+        self.assertFalse(os.path.exists(trash))
+        
+        which = SNAP_PREFIX + "2013-08-09_21:09:40"
+        self.apt_btrfs.delete(which)
+        # a left over from an earlier deletion of a snapshot of the same name
+        os.mkdir(os.path.join(self.sandbox, which))
+        snapshots.setup(self.sandbox)
+        self.apt_btrfs.delete(which)
+        self.assertItemsEqual(os.listdir(trash), [which, which + ".1"])
+        
+        mock_delete_many.reset_mock()
+        self.assertTrue(self.apt_btrfs.reclaim(commit="after"))
+        self.assertEqual(mock_delete_many.call_args[1]["commit"], "after")
+        self.assertFalse(os.path.exists(trash))
+
+    @mock.patch('sys.stdout')
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_sync')
+    def test_reclaim_throttled(self, mock_sync, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        throttle = mock.Mock()
+        throttle.run.side_effect = lambda items, work, between: (
+            work(items[:2]), between(), items[2:])[-1]
+        self.apt_btrfs.delete_older_than(
+            datetime.datetime(2013, 8, 7, 18, 0, 42), throttle=throttle)
+        self.assertTrue(mock_sync.called)
+        # the ones that didn't fit in the budget are left for next time
+        trash = os.path.join(self.sandbox, TRASH_DIR)
+        self.assertEqual(len(os.listdir(trash)), 2)
+        output = extract_stdout(mock_stdout)
+        self.assertEqual(output,
+            "Time is up, 2 snapshots left in the trash\n")
+        mock_delete_many.reset_mock()
+        self.assertTrue(self.apt_btrfs.reclaim())
+        self.assertEqual(len(mock_delete_many.call_args[0][0]), 2)
+
+    @mock.patch('sys.stdout')
+    def test_maintain(self, mock_stdout):
+        mock_stdout.side_effect = StringIO()
+        old_dirlist = os.listdir(self.sandbox)
+        policy = RetentionPolicy(max_count=3, tags={"raring-to-go": 0})
+        self.assertTrue(self.apt_btrfs.maintain(policy, dry_run=True))
+        self.assertItemsEqual(old_dirlist, os.listdir(self.sandbox))
+        output = extract_stdout(mock_stdout)
+        self.assertTrue(output.startswith("Keeping 8 snapshots, deleting 8"))
+        
+        mock_delete_many.reset_mock()
+        self.assertTrue(self.apt_btrfs.maintain(policy))
+        self.assertEqual(mock_delete_many.call_count, 1)
+        dirlist = os.listdir(self.sandbox)
+        self.assertEqual(len(dirlist), len(old_dirlist) - 8)
+        # @'s parent is always kept
+        self.assertIn(SNAP_PREFIX + "2013-08-06_13:26:30", dirlist)
+        self.assertIn(SNAP_PREFIX + "2013-08-09_21:09:40", dirlist)
+        self.assertNotIn(SNAP_PREFIX + "2013-07-31_12:53:16-raring-to-go",
+            dirlist)
+        # and so are the branch points
+        for junction in ("2013-07-31_00:00:04", "2013-08-01_19:53:16",
+                         "2013-08-02_00:24:00", "2013-08-09_21:04:37"):
+            self.assertIn(SNAP_PREFIX + junction, dirlist)
+        self.assert_child_parent_linked("@",
+            SNAP_PREFIX + "2013-08-06_13:26:30")
+        self.assert_child_parent_linked(SNAP_PREFIX + "2013-08-09_21:08:01",
+            SNAP_PREFIX + "2013-08-09_21:04:37")
+        self.assert_child_parent_linked(SNAP_PREFIX + "2013-08-09_21:04:37",
+            SNAP_PREFIX + "2013-08-06_13:26:30")
+
     def test_delete_older_than(self):
         old_dirlist = os.listdir(self.sandbox)
+        mock_delete_many.reset_mock()
         self.apt_btrfs.delete_older_than(
             datetime.datetime(2013, 8, 7, 18, 0, 42))
+        self.assertFalse(mock_delete_many.called)
+        self.apt_btrfs.reclaim()
+        self.assertEqual(mock_delete_many.call_count, 1)
         dirlist = os.listdir(self.sandbox)
         self.assertEqual(len(dirlist), len(old_dirlist) - 4)
         self.assertNotIn(SNAP_PREFIX + "2013-07-26_14:50:53", dirlist)
@@ -449,6 +913,7 @@ class TestSnapshotting(unittest.TestCase):
         old_dirlist = os.listdir(self.sandbox)
         self.apt_btrfs.delete_older_than(
             datetime.datetime(2013, 8, 9, 21, 9, 40))
+        self.apt_btrfs.reclaim()
         dirlist = os.listdir(self.sandbox)
         self.assertEqual(len(dirlist), len(old_dirlist) - 8)
         self.assertNotIn(SNAP_PREFIX + "2013-08-09_21:08:01", dirlist)
@@ -539,6 +1004,7 @@ dpkg history for @apt-snapshot-2013-07-26_14:50:53
         
         res = self.apt_btrfs.prune("@apt-snapshot-2013-08-09_21:09:40")
         self.assertTrue(res)
+        self.assertTrue(self.apt_btrfs.reclaim())
         new_dirlist = os.listdir(self.sandbox)
         self.assertEqual(len(old_dirlist), len(new_dirlist) + 2)
         self.assertNotIn(SNAP_PREFIX + "2013-08-09_21:09:40", new_dirlist)
@@ -546,6 +1012,7 @@ dpkg history for @apt-snapshot-2013-07-26_14:50:53
         
         res = self.apt_btrfs.prune("@apt-snapshot-2013-08-09_21:05:56")
         self.assertTrue(res)
+        self.assertTrue(self.apt_btrfs.reclaim())
         new_dirlist = os.listdir(self.sandbox)
         self.assertEqual(len(old_dirlist), len(new_dirlist) + 5)
         self.assertNotIn("@apt-snapshot-2013-08-09_21:05:56", new_dirlist)
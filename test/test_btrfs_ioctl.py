@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import ctypes
+import errno
+import mock
+import sys
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import btrfs_ioctl
+from apt_btrfs_snapshot import (
+    IoctlCommands,
+    LowLevelCommands,
+    get_commands,
+)
+
+
+class TestBtrfsIoctl(unittest.TestCase):
+
+    def test_struct_sizes(self):
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.VolArgs), 4096)
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.VolArgsV2), 4096)
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.SubvolInfo), 504)
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.SpaceInfo), 24)
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.FsInfo), 1024)
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.DevInfo), 4096)
+
+    def test_ioctl_numbers(self):
+        # values as found in linux/btrfs.h
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_SNAP_CREATE_V2, 0x50009417)
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_SNAP_DESTROY, 0x5000940f)
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_GET_SUBVOL_INFO, 0x81f8943c)
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_SPACE_INFO, 0xc0109414)
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_FS_INFO, 0x8400941f)
+        self.assertEqual(btrfs_ioctl.BTRFS_IOC_DEV_INFO, 0xd000941e)
+
+    @mock.patch('os.path.realpath')
+    def test_resolve_fs_spec(self, mock_realpath):
+        mock_realpath.side_effect = lambda p: p
+        self.assertEqual(btrfs_ioctl.resolve_fs_spec("UUID=1234"),
+                         "/dev/disk/by-uuid/1234")
+        self.assertEqual(btrfs_ioctl.resolve_fs_spec("LABEL=root"),
+                         "/dev/disk/by-label/root")
+        self.assertEqual(btrfs_ioctl.resolve_fs_spec("/dev/sda1"),
+                         "/dev/sda1")
+
+
+class TestIoctlCommands(unittest.TestCase):
+
+    def test_get_commands(self):
+        self.assertIsInstance(get_commands("subprocess"), LowLevelCommands)
+        self.assertNotIsInstance(get_commands("subprocess"), IoctlCommands)
+        self.assertIsInstance(get_commands("ioctl"), IoctlCommands)
+        with mock.patch('btrfs_ioctl.is_available') as mock_available:
+            mock_available.return_value = False
+            self.assertNotIsInstance(get_commands("auto"), IoctlCommands)
+            mock_available.return_value = True
+            self.assertIsInstance(get_commands("auto"), IoctlCommands)
+        with self.assertRaisesRegexp(Exception, "Unknown backend 'foo'"):
+            get_commands("foo")
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_snapshot')
+    @mock.patch('btrfs_ioctl.snapshot')
+    def test_snapshot_uses_ioctl(self, mock_ioctl, mock_subprocess):
+        self.assertTrue(IoctlCommands().btrfs_subvolume_snapshot("@", "@x"))
+        mock_ioctl.assert_called_with("@", "@x", False)
+        self.assertTrue(IoctlCommands().btrfs_subvolume_snapshot(
+            "@", "@x", readonly=True))
+        mock_ioctl.assert_called_with("@", "@x", True)
+        self.assertFalse(mock_subprocess.called)
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_delete_snapshot')
+    @mock.patch('btrfs_ioctl.destroy')
+    def test_delete_falls_back(self, mock_ioctl, mock_subprocess):
+        mock_ioctl.side_effect = OSError(errno.ENOTTY, "ioctl")
+        mock_subprocess.return_value = True
+        self.assertTrue(IoctlCommands().btrfs_delete_snapshot("@x"))
+        mock_subprocess.assert_called_with("@x")
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch('btrfs_ioctl.subvol_info')
+    def test_generation(self, mock_info, mock_output):
+        info = btrfs_ioctl.SubvolInfo()
+        info.uuid[:] = range(16)
+        info.generation = 1234
+        mock_info.return_value = info
+        self.assertEqual(
+            IoctlCommands().btrfs_subvolume_generation("/mp/@"),
+            ("00010203-0405-0607-0809-0a0b0c0d0e0f", 1234))
+        # btrfs subvolume show, when the kernel predates the ioctl
+        mock_info.side_effect = OSError(errno.ENOTTY, "ioctl")
+        mock_output.return_value = (
+            b"@\n\tName: \t\t\t@\n"
+            b"\tUUID: \t\t\t00010203-0405-0607-0809-0a0b0c0d0e0f\n"
+            b"\tParent UUID: \t\t-\n"
+            b"\tGeneration: \t\t1235\n")
+        self.assertEqual(
+            IoctlCommands().btrfs_subvolume_generation("/mp/@"),
+            ("00010203-0405-0607-0809-0a0b0c0d0e0f", 1235))
+        mock_output.side_effect = OSError(errno.ENOENT, "btrfs")
+        self.assertEqual(
+            LowLevelCommands().btrfs_subvolume_generation("/mp/@"), None)
+
+    @mock.patch('subprocess.check_output')
+    @mock.patch('btrfs_ioctl.space_info')
+    @mock.patch('btrfs_ioctl.unallocated')
+    def test_space(self, mock_unallocated, mock_info, mock_output):
+        G = 1 << 30
+        mock_unallocated.return_value = 4 * G
+        data = btrfs_ioctl.SpaceInfo(btrfs_ioctl.BTRFS_BLOCK_GROUP_DATA,
+                                     8 * G, 7 * G)
+        metadata = btrfs_ioctl.SpaceInfo(
+            btrfs_ioctl.BTRFS_BLOCK_GROUP_METADATA |
+            btrfs_ioctl.BTRFS_BLOCK_GROUP_DUP, G, G // 2)
+        mock_info.return_value = [data, metadata]
+        # metadata is kept twice, so it gets half of what is unallocated
+        self.assertEqual(IoctlCommands().btrfs_space("/mp"),
+                         (4 * G, G // 2 + 2 * G))
+        # btrfs filesystem usage, when the ioctls can't be used
+        mock_info.side_effect = OSError(errno.EPERM, "ioctl")
+        mock_output.return_value = (
+            b"Overall:\n"
+            b"    Device size:\t\t  21474836480\n"
+            b"    Device unallocated:\t\t  4294967296\n"
+            b"    Data ratio:\t\t\t         1.00\n"
+            b"    Metadata ratio:\t\t         2.00\n"
+            b"\n"
+            b"Data,single: Size:8589934592, Used:7516192768 (87.50%)\n"
+            b"   /dev/vda\t8589934592\n"
+            b"\n"
+            b"Metadata,DUP: Size:1073741824, Used:536870912 (50.00%)\n"
+            b"   /dev/vda\t2147483648\n")
+        self.assertEqual(IoctlCommands().btrfs_space("/mp"),
+                         (4 * G, G // 2 + 2 * G))
+        mock_output.side_effect = OSError(errno.ENOENT, "btrfs")
+        self.assertEqual(LowLevelCommands().btrfs_space("/mp"), None)
+
+    @mock.patch('time.sleep')
+    @mock.patch('subprocess.Popen')
+    def test_subvolume_sync_timeout(self, mock_popen, mock_sleep):
+        sync = mock_popen.return_value
+        sync.wait.return_value = 0
+        self.assertTrue(LowLevelCommands().btrfs_subvolume_sync("/mp"))
+        # the cleaner takes longer than we have
+        sync.poll.return_value = None
+        self.assertFalse(LowLevelCommands().btrfs_subvolume_sync(
+            "/mp", timeout=0))
+        self.assertTrue(sync.kill.called)
+        sync.poll.return_value = 0
+        sync.returncode = 0
+        self.assertTrue(LowLevelCommands().btrfs_subvolume_sync(
+            "/mp", timeout=10))
+
+    @mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_delete_snapshots')
+    @mock.patch('btrfs_ioctl.sync')
+    @mock.patch('btrfs_ioctl.destroy')
+    def test_delete_many(self, mock_ioctl, mock_sync, mock_subprocess):
+        paths = ["/mp/@a", "/mp/@b", "/mp/@c"]
+        commands = IoctlCommands()
+        self.assertEqual(commands.btrfs_delete_snapshots(paths), [])
+        self.assertEqual(mock_ioctl.call_count, 3)
+        self.assertFalse(mock_sync.called)
+        self.assertFalse(mock_subprocess.called)
+
+        commands.btrfs_delete_snapshots(paths, commit="each")
+        self.assertEqual(mock_sync.call_count, 3)
+        mock_sync.reset_mock()
+        commands.btrfs_delete_snapshots(paths, commit="after")
+        mock_sync.assert_called_once_with("/mp")
+
+        # the ones the kernel refuses are retried with the btrfs tool
+        def destroy(p):
+            if p == "/mp/@b":
+                raise OSError(errno.EPERM, "ioctl")
+        mock_ioctl.side_effect = destroy
+        mock_subprocess.return_value = ["/mp/@b"]
+        failed = commands.btrfs_delete_snapshots(paths, commit="after")
+        mock_subprocess.assert_called_with(["/mp/@b"], "after")
+        self.assertEqual(failed, ["/mp/@b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
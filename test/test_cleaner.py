@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from cleaner import (
+    Cleaner,
+    TARGETS,
+    format_size,
+    get_targets,
+)
+
+
+class TestCleaner(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.snapshots = []
+        for name in ("@one", "@two", "@three"):
+            path = os.path.join(self.root, name)
+            self.snapshots.append((name, path))
+            self.make_file(path, "var/cache/apt/archives/a.deb", 100)
+            self.make_file(path, "var/cache/apt/archives/lock", 0)
+            self.make_file(path, "var/log/syslog", 10)
+            self.make_file(path, "var/log/syslog.1", 20)
+            self.make_file(path, "var/log/apt/history.log.2.gz", 30)
+            self.make_file(path, "var/tmp/junk/file", 40)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def make_file(self, root, path, size):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("x" * size)
+
+    def exists(self, snapshot, path):
+        return os.path.exists(os.path.join(self.root, snapshot, path))
+
+    def test_get_targets(self):
+        self.assertEqual(get_targets("apt-cache"), [TARGETS["apt-cache"]])
+        self.assertEqual(get_targets("apt-cache,var-tmp"),
+                         [TARGETS["apt-cache"], TARGETS["var-tmp"]])
+        with self.assertRaisesRegexp(Exception, "Unknown clean target 'x'"):
+            get_targets(["x"])
+
+    def test_format_size(self):
+        self.assertEqual(format_size(100), "100 bytes")
+        self.assertEqual(format_size(1536), "1.5 KiB")
+        self.assertEqual(format_size(3 * 1024 ** 3), "3.0 GiB")
+
+    def test_clean_apt_cache(self):
+        reports = Cleaner(get_targets("apt-cache")).clean(self.snapshots)
+        self.assertEqual([r.name for r in reports], ["@one", "@two", "@three"])
+        for report in reports:
+            self.assertEqual((report.files, report.bytes), (1, 100))
+            self.assertFalse(self.exists(report.name,
+                                         "var/cache/apt/archives/a.deb"))
+            self.assertTrue(self.exists(report.name,
+                                        "var/cache/apt/archives/lock"))
+
+    def test_clean_several_targets(self):
+        cleaner = Cleaner(get_targets("rotated-logs,var-tmp"), workers=1)
+        report = cleaner.clean_snapshot("@one", self.snapshots[0][1])
+        self.assertEqual((report.files, report.bytes), (3, 90))
+        self.assertTrue(self.exists("@one", "var/log/syslog"))
+        self.assertFalse(self.exists("@one", "var/log/syslog.1"))
+        self.assertFalse(self.exists("@one", "var/log/apt/history.log.2.gz"))
+        self.assertFalse(self.exists("@one", "var/tmp/junk/file"))
+        self.assertTrue(self.exists("@one", "var/tmp/junk"))
+
+    def test_dry_run(self):
+        cleaner = Cleaner(get_targets("apt-cache"), dry_run=True)
+        reports = cleaner.clean(self.snapshots)
+        self.assertEqual(sum(r.bytes for r in reports), 300)
+        self.assertTrue(self.exists("@one", "var/cache/apt/archives/a.deb"))
+
+    @mock.patch('os.remove')
+    def test_batches(self, mock_remove):
+        for i in range(4):
+            self.make_file(self.snapshots[0][1],
+                           "var/cache/apt/archives/%d.deb" % i, 1)
+        walked = []
+        listdir = os.listdir
+
+        def record(path):
+            walked.append(mock_remove.call_count)
+            return listdir(path)
+
+        with mock.patch('os.listdir', side_effect=record):
+            cleaner = Cleaner(get_targets("apt-cache,var-tmp"), batch=2)
+            report = cleaner.clean_snapshot("@one", self.snapshots[0][1])
+        self.assertEqual(report.files, 6)
+        self.assertEqual(mock_remove.call_count, 6)
+        # the debs went before var/tmp was looked at
+        self.assertEqual(walked[1], 4)
+        removed = [c[0][0] for c in mock_remove.call_args_list[:4]]
+        inodes = [os.lstat(path).st_ino for path in removed]
+        self.assertEqual(inodes[:2], sorted(inodes[:2]))
+        self.assertEqual(inodes[2:], sorted(inodes[2:]))
+
+    @mock.patch('cleaner.shares_data')
+    @mock.patch('cleaner.file_usage')
+    def test_estimate_skips_shared_files(self, mock_usage, mock_shares):
+        # @one and @two share all of their deb, @one with @, @three half of
+        # it, @four can't tell
+        self.snapshots.append(("@four", os.path.join(self.root, "@four")))
+        for name, path in self.snapshots:
+            self.make_file(path, "var/cache/apt/archives/a.deb", 100)
+        usage = {"@one": (4096, 0), "@two": (4096, 0), "@three": (4096, 2048),
+                 "@four": None}
+        mock_usage.side_effect = lambda p: usage[p.split(os.sep)[-6]]
+        mock_shares.side_effect = lambda p, live: p.split(os.sep)[-6] == "@one"
+        live = os.path.join(self.root, "@")
+        cleaner = Cleaner(get_targets("apt-cache"), workers=1, estimate=True,
+                          live=live)
+        reports = cleaner.clean(self.snapshots)
+        self.assertEqual([(r.files, r.skipped, r.freed) for r in reports],
+                         [(0, 1, 0), (1, 0, 0), (1, 0, 50), (1, 0, 100)])
+        mock_shares.assert_called_with(
+            os.path.join(self.root, "@two", "var/cache/apt/archives/a.deb"),
+            os.path.join(live, "var/cache/apt/archives/a.deb"))
+        self.assertTrue(self.exists("@one", "var/cache/apt/archives/a.deb"))
+        self.assertFalse(self.exists("@two", "var/cache/apt/archives/a.deb"))
+        # without @ to compare with nothing is skipped
+        cleaner = Cleaner(get_targets("apt-cache"), workers=1, estimate=True,
+                          dry_run=True)
+        self.assertEqual(cleaner.clean_snapshot("@one",
+                                                self.snapshots[0][1]).files, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
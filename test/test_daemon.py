@@ -0,0 +1,225 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import daemon
+from daemon import (
+    CachingAptBtrfsSnapshot,
+    Daemon,
+)
+from inotify import (
+    IN_CREATE,
+    Inotify,
+    parse_events,
+)
+from snapshots import SNAP_PREFIX
+
+
+class TestInotify(unittest.TestCase):
+
+    def test_parse_events(self):
+        data = struct.pack(str("iIII"), 1, IN_CREATE, 0, 8) + b"abc\0\0\0\0\0"
+        data += struct.pack(str("iIII"), 2, IN_CREATE, 0, 0)
+        self.assertEqual(parse_events(data),
+                         [(1, IN_CREATE, "abc"), (2, IN_CREATE, "")])
+
+    def test_watch(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            inotify = Inotify()
+            inotify.add_watch(tmpdir, IN_CREATE)
+            self.assertEqual(inotify.read(), [])
+            os.mkdir(os.path.join(tmpdir, "new"))
+            events = inotify.read()
+            self.assertEqual(len(events), 1)
+            self.assertEqual(events[0][0], tmpdir)
+            self.assertEqual(events[0][2], "new")
+            inotify.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        model_root = os.path.join(self.testdir, "data", "model_root")
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(model_root, self.sandbox, symlinks=True)
+        self.apt_btrfs = CachingAptBtrfsSnapshot(
+            fstab=os.path.join(self.testdir, "data", "fstab"),
+            sandbox=self.sandbox)
+        self.tmpdir = tempfile.mkdtemp()
+        self.daemon = Daemon(self.apt_btrfs,
+                             os.path.join(self.tmpdir, "socket"),
+                             os.path.join(self.testdir, "data", "var"))
+
+    def tearDown(self):
+        self.daemon.close()
+        shutil.rmtree(self.sandbox)
+        shutil.rmtree(self.tmpdir)
+
+    def test_handle(self):
+        response = self.daemon.handle({"command": "list"})
+        self.assertTrue(response["result"])
+        self.assertIn(SNAP_PREFIX + "2013-08-06_13:26:30", response["output"])
+        response = self.daemon.handle({"command": "delete", "args": ["@"]})
+        self.assertEqual(response, {"error": "Unknown command 'delete'"})
+        response = self.daemon.handle({"command": "create"}, uid=1000)
+        self.assertEqual(response, {"error": "Only root may create"})
+
+    @mock.patch('daemon.CachingAptBtrfsSnapshot.record_run')
+    @mock.patch('daemon.VolumeLock.acquire')
+    def test_lock_timeout(self, mock_acquire, mock_record):
+        mock_acquire.side_effect = daemon.LockTimeout("held the lock")
+        response = self.daemon.handle({"command": "create"})
+        self.assertEqual(response, {"error": "held the lock",
+                                    "lock_timeout": True})
+        self.assertFalse(mock_record.call_args[0][2])
+
+    @mock.patch('daemon.CachingAptBtrfsSnapshot.show')
+    def test_unprivileged_show(self, mock_show):
+        mock_show.return_value = True
+        name = SNAP_PREFIX + "2013-08-06_13:26:30"
+        for args in ([name + "/../../../../home/user/x"], ["../@"],
+                     [SNAP_PREFIX + "2020-01-01_00:00:00"], [name, True],
+                     [name, False, True], [], [["@"]], "@"):
+            response = self.daemon.handle({"command": "show", "args": args},
+                                          uid=1000)
+            self.assertIn("error", response)
+        response = self.daemon.handle({"command": "list", "args": [True]},
+                                      uid=1000)
+        self.assertIn("error", response)
+        self.assertFalse(mock_show.called)
+        for args in ([name], ["@"]):
+            response = self.daemon.handle({"command": "show", "args": args},
+                                          uid=1000)
+            self.assertTrue(response["result"])
+            mock_show.assert_called_with(*args)
+        # root is trusted with the rest
+        self.daemon.handle({"command": "show", "args": [name, True]})
+        mock_show.assert_called_with(name, True)
+
+    @mock.patch('daemon.CachingAptBtrfsSnapshot.metrics')
+    @mock.patch('daemon.CachingAptBtrfsSnapshot.record_run')
+    @mock.patch('daemon.CachingAptBtrfsSnapshot.create')
+    def test_create_recorded(self, mock_create, mock_record, mock_metrics):
+        mock_create.return_value = True
+        self.daemon.handle({"command": "create", "args": ["-x"]})
+        self.assertEqual(mock_record.call_args[0][0], "create")
+        self.assertTrue(mock_record.call_args[0][2])
+        mock_metrics.assert_called_with(auto=True, quick=True)
+        mock_record.reset_mock()
+        self.daemon.handle({"command": "list"})
+        self.assertFalse(mock_record.called)
+        # failures that raise too
+        mock_create.side_effect = Exception("no mount")
+        self.assertEqual(self.daemon.handle({"command": "create"}),
+                         {"error": "no mount"})
+        self.assertEqual(mock_record.call_args[0][0], "create")
+        self.assertFalse(mock_record.call_args[0][2])
+
+    def test_cache(self):
+        status = self.apt_btrfs._get_status()
+        self.assertIs(self.apt_btrfs._get_status(), status)
+        # dpkg wrote to its log
+        self.daemon.on_events([("/var/log", IN_CREATE, "dpkg.log")])
+        self.assertIsNot(self.apt_btrfs._get_status(), status)
+        # a snapshot appeared
+        name = SNAP_PREFIX + "2020-01-01_00:00:00"
+        os.mkdir(os.path.join(self.sandbox, name))
+        self.daemon.on_events([(self.sandbox, IN_CREATE, name)])
+        response = self.daemon.handle({"command": "list"})
+        self.assertIn(name, response["output"])
+
+    def test_socket(self):
+        server = threading.Thread(target=self.daemon.serve,
+                                  kwargs={"once": True})
+        server.start()
+        socket_path = os.path.join(self.tmpdir, "socket")
+        try:
+            while server.is_alive() and not os.path.exists(socket_path):
+                pass
+            res, output = daemon.call("show", [SNAP_PREFIX +
+                                      "2013-08-06_13:26:30"], socket_path)
+        finally:
+            server.join()
+        self.assertTrue(res)
+        self.assertIn("Snapshot %s2013-08-06_13:26:30" % SNAP_PREFIX, output)
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertEqual(daemon.call("list", [], socket_path), None)
+
+    def test_silent_client(self):
+        client, connection = socket.socketpair()
+        try:
+            # half a request, and nothing more
+            client.sendall(b'{"command": ')
+            started = time.time()
+            self.assertRaises(socket.timeout, self.daemon._read_request,
+                              connection, 0.2)
+            self.assertTrue(time.time() - started < 2)
+            client.sendall(b'"list"}\n')
+            self.assertEqual(self.daemon._read_request(connection, 0.2),
+                             b'"list"}\n')
+        finally:
+            client.close()
+            connection.close()
+
+    def test_call_errors(self):
+        socket_path = os.path.join(self.tmpdir, "socket")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        server.listen(1)
+
+        def answer(reply):
+            connection, address = server.accept()
+            connection.recv(4096)
+            if reply is not None:
+                connection.sendall(reply)
+            else:
+                # keep quiet until the client gives up
+                connection.recv(4096)
+            connection.close()
+
+        try:
+            thread = threading.Thread(target=answer, args=(
+                b'{"error": "held the lock", "lock_timeout": true}',))
+            thread.start()
+            try:
+                self.assertRaises(daemon.LockTimeout, daemon.call,
+                                  "create", [], socket_path, 0.2)
+            finally:
+                thread.join()
+            for reply in (b'{"error": "oops"}', b"garbage", None):
+                thread = threading.Thread(target=answer, args=(reply,))
+                thread.start()
+                try:
+                    self.assertRaises(daemon.DaemonError, daemon.call,
+                                      "list", [], socket_path, 0.2)
+                finally:
+                    thread.join()
+        finally:
+            server.close()
+        # long enough for the lock, short enough for apt's hook to go on
+        self.assertTrue(daemon.TIMEOUT < daemon.CALL_TIMEOUT <
+                        daemon.TIMEOUT + 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -114,6 +114,17 @@ class TestDpkgHistory(unittest.TestCase):
         self.assertEqual(len(log['purge']), 0)
         self.lists_are_sorted()
 
+    def test_history_log_until(self):
+        log = DpkgHistory(var_location="data/var/", 
+                since = datetime(2013, 8, 01, 19, 53, 46),
+                until = datetime(2013, 8, 6, 12, 20, 00))
+        self.no_repeats(log)
+        # those of test_history_log less those of test_history_log_shorter
+        total_installs = len(log['install']) + len(log['auto-install'])
+        self.assertEqual(total_installs, 294)
+        self.assertEqual(len(log['upgrade']), 47)
+        self.lists_are_sorted()
+
     def test_auto_installed_list(self):
         log = DpkgHistory(var_location="data/var/", 
                 since = datetime(2013, 8, 6, 12, 20, 00))
@@ -130,6 +141,40 @@ class TestDpkgHistory(unittest.TestCase):
         expected = [(u'lib32asound2', u'1.0.25-1ubuntu10.2'), (u'lib32z1', u'1:1.2.3.4.dfsg-3ubuntu4'), (u'libc6-i386', u'2.15-0ubuntu10.4'), (u'linux-headers-3.8.0-27', u'3.8.0-27.40~precise3'), (u'linux-headers-3.8.0-27-generic', u'3.8.0-27.40~precise3'), (u'lynx-cur', u'2.8.8dev.9-2ubuntu0.12.04.1'), (u'python-gpgme', u'0.2-1')]
         self.assertEqual(log['auto-install'], expected)
 
+    def test_from_actions(self):
+        log = DpkgHistory.from_actions([
+            ("install", "lynx-cur", "<none>", "2.8.8dev.9-2ubuntu0.12.04.1"),
+            ("install", "zsh", "<none>", "4.3.17-1ubuntu1"),
+            ("upgrade", "bash", "4.2-2ubuntu2", "4.2-2ubuntu2.1"),
+            ("upgrade", "bash", "4.2-2ubuntu2.1", "4.2-2ubuntu2.2"),
+            ("remove", "nano", "2.2.6-1", "<none>"),
+            ], var_location="data/var/")
+        self.assertEqual(log['install'], [("zsh", "4.3.17-1ubuntu1")])
+        self.assertEqual(log['auto-install'],
+                         [("lynx-cur", "2.8.8dev.9-2ubuntu0.12.04.1")])
+        self.assertEqual(log['upgrade'],
+                         [("bash", "4.2-2ubuntu2, 4.2-2ubuntu2.2")])
+        self.assertEqual(log['remove'], [("nano", "2.2.6-1")])
+
+    def test_qualified_names(self):
+        import dpkg_history
+        native = dpkg_history._arch
+        lines = ["2013-08-09 21:08:01 upgrade bash:%s 4.2-2ubuntu2 "
+                 "4.2-2ubuntu2.1" % native,
+                 "2013-08-09 21:08:02 install tzdata:all <none> 2013d-1",
+                 "2013-08-09 21:08:03 install libc6:foreign <none> 2.15-1"]
+        log = DpkgHistory(since=datetime(2013, 8, 1), do_parse=False)
+        ops, versions = log._parse_by_package([lines])
+        self.assertItemsEqual(ops.keys(), ["bash", "tzdata", "libc6:foreign"])
+        log._distill_ops(ops, versions)
+        # the same package from the journal merges with it
+        journal = DpkgHistory.from_actions([
+            ("upgrade", "bash", "4.2-2ubuntu2.1", "4.2-2ubuntu2.2"),
+            ], var_location="data/var/", since=datetime(2013, 8, 10))
+        both = log + journal
+        self.assertEqual(both['upgrade'],
+                         [("bash", "4.2-2ubuntu2, 4.2-2ubuntu2.2")])
+
     def test_add(self):
         log1 = DpkgHistory(do_parse=False)
         log2 = DpkgHistory(do_parse=False)
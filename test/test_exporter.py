@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import gzip
+import io
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import snapshots
+from exporter import (
+    EXPORT_DIR,
+    EXPORT_LOCK,
+    STATE_FILE,
+    Exporter,
+    FileSink,
+    topological_order,
+)
+from apt_btrfs_snapshot import SimulatedCommands
+from locking import VolumeLock
+from snapshots import (
+    SNAP_PREFIX,
+    Snapshot,
+)
+from storage import MemoryStorage
+
+
+class FakeCommands(object):
+
+    def btrfs_subvolume_snapshot(self, source, dest, readonly=False):
+        shutil.copytree(source, dest, symlinks=True)
+        return True
+
+    def btrfs_delete_snapshots(self, paths, commit=None):
+        for path in paths:
+            shutil.rmtree(path)
+        return []
+
+
+class FakeSend(object):
+    """ a btrfs send whose stream says what it was asked for """
+
+    sent = []
+    fail = False
+
+    def __init__(self, cmd, stdout=None):
+        FakeSend.sent.append(cmd[2:])
+        self.stdout = io.BytesIO(" ".join(cmd[2:]).encode("utf-8"))
+
+    def wait(self):
+        return 1 if FakeSend.fail else 0
+
+
+@mock.patch('subprocess.Popen', new=FakeSend)
+@mock.patch('sys.stdout', new=mock.Mock())
+class TestExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        model_root = os.path.join(self.testdir, "data", "model_root")
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(model_root, self.sandbox, symlinks=True)
+        snapshots.setup(self.sandbox)
+        self.destination = tempfile.mkdtemp()
+        FakeSend.sent = []
+        FakeSend.fail = False
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+        shutil.rmtree(self.destination)
+
+    def exporter(self):
+        return Exporter(self.sandbox, FakeCommands(),
+                        FileSink(self.destination))
+
+    def read_stream(self, name):
+        with gzip.open(os.path.join(self.destination,
+                                    name + ".btrfs.gz")) as stream:
+            return stream.read().decode("utf-8")
+
+    def test_topological_order(self):
+        order = topological_order(snapshots.get_list())
+        self.assertEqual(len(order), len(snapshots.get_list()))
+        for i, snapshot in enumerate(order):
+            parent = snapshot.parent
+            if parent is not None:
+                self.assertIn(parent, order[:i])
+
+    def test_export(self):
+        parent = Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")
+        child = Snapshot(SNAP_PREFIX + "2013-08-06_13:26:30")
+        self.assertEqual(child.parent, parent)
+        self.assertTrue(self.exporter().export([child, parent],
+                                               snapshots.get_list()))
+        clones = os.path.join(self.sandbox, EXPORT_DIR)
+        # the parent in full, then the child from it
+        self.assertEqual(FakeSend.sent, [
+            [os.path.join(clones, parent.name)],
+            ["-p", os.path.join(clones, parent.name),
+             os.path.join(clones, child.name)]])
+        self.assertEqual(self.read_stream(child.name), "-p %s %s" % (
+            os.path.join(clones, parent.name),
+            os.path.join(clones, child.name)))
+        with open(os.path.join(self.destination, STATE_FILE)) as state:
+            self.assertEqual(state.read().split(), [parent.name, child.name])
+
+        # carries on from there, the nearest exported ancestor is the base
+        FakeSend.sent = []
+        grandchild = Snapshot(SNAP_PREFIX + "2013-08-09_21:04:37")
+        self.assertEqual(grandchild.parent.parent, child)
+        self.assertTrue(self.exporter().export([grandchild, child],
+                                               snapshots.get_list()))
+        self.assertEqual(FakeSend.sent, [
+            ["-p", os.path.join(clones, child.name),
+             os.path.join(clones, grandchild.name)]])
+
+    def test_read_only_sent_as_is(self):
+        parent = Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")
+        child = Snapshot(SNAP_PREFIX + "2013-08-06_13:26:30")
+        snapshots.make_sidecar(parent.name)
+        self.assertTrue(self.exporter().export([child, parent],
+                                               snapshots.get_list()))
+        clones = os.path.join(self.sandbox, EXPORT_DIR)
+        self.assertEqual(FakeSend.sent, [
+            [os.path.join(self.sandbox, parent.name)],
+            ["-p", os.path.join(self.sandbox, parent.name),
+             os.path.join(clones, child.name)]])
+        self.assertEqual(os.listdir(clones), [child.name])
+
+    def test_export_fails(self):
+        FakeSend.fail = True
+        snapshot = Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")
+        self.assertFalse(self.exporter().export([snapshot],
+                                                snapshots.get_list()))
+        self.assertEqual(os.listdir(self.destination), [])
+
+    def test_locking(self):
+        snapshot = Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")
+        free = []
+        sandbox = self.sandbox
+
+        class CheckingSend(FakeSend):
+            def __init__(self, cmd, stdout=None):
+                # apt could snapshot meanwhile
+                with VolumeLock(sandbox, timeout=0):
+                    free.append(cmd[-1])
+                FakeSend.__init__(self, cmd, stdout)
+
+        with mock.patch('subprocess.Popen', new=CheckingSend):
+            self.assertTrue(self.exporter().export([snapshot],
+                                                   snapshots.get_list()))
+        self.assertEqual(free, [os.path.join(self.sandbox, EXPORT_DIR,
+                                             snapshot.name)])
+        # one export at a time
+        exporter = Exporter(self.sandbox, FakeCommands(),
+                            FileSink(self.destination), lock_timeout=0)
+        with VolumeLock(os.path.join(self.sandbox, EXPORT_LOCK)):
+            self.assertFalse(exporter.export([], snapshots.get_list()))
+        # nor while the volume is locked for clones to be made
+        with VolumeLock(self.sandbox):
+            self.assertFalse(exporter.export([], snapshots.get_list()))
+
+    def test_stale_clones_dropped(self):
+        clones = os.path.join(self.sandbox, EXPORT_DIR)
+        os.makedirs(os.path.join(clones, SNAP_PREFIX + "2000-01-01_00:00:00"))
+        self.assertTrue(self.exporter().export([], snapshots.get_list()))
+        self.assertEqual(os.listdir(clones), [])
+
+    def test_clones_in_memory(self):
+        memory = MemoryStorage()
+        memory.load(os.path.join(self.testdir, "data", "model_root"))
+        snapshots.setup(memory.mp, memory)
+        parent = Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")
+        child = Snapshot(SNAP_PREFIX + "2013-08-06_13:26:30")
+        exporter = Exporter(memory.mp, SimulatedCommands(memory),
+                            FileSink(self.destination), storage=memory)
+        self.assertTrue(exporter.export([child, parent],
+                                        snapshots.get_list()))
+        clones = os.path.join(memory.mp, EXPORT_DIR)
+        self.assertEqual(sorted(memory.listdir(clones)),
+                         [parent.name, child.name])
+        self.assertFalse(os.path.exists(memory.mp))
+        # the clones of snapshots gone are dropped from memory too
+        memory.delete(os.path.join(memory.mp, parent.name))
+        snapshots.setup(memory.mp, memory)
+        self.assertTrue(exporter.export([], snapshots.get_list()))
+        self.assertEqual(memory.listdir(clones), [child.name])
+
+
+if __name__ == "__main__":
+    unittest.main()
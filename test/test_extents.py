@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import ctypes
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import btrfs_ioctl
+from btrfs_ioctl import (
+    FIEMAP_EXTENT_LAST,
+    FIEMAP_EXTENT_SHARED,
+    FiemapExtent,
+)
+from extents import (
+    estimate_files,
+    estimate_tree,
+    file_usage,
+    freed_by,
+    shares_data,
+)
+
+
+def extent(logical, length, flags=0, physical=0):
+    return FiemapExtent(logical=logical, length=length, flags=flags,
+                        physical=physical)
+
+
+class TestExtents(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "file")
+        with open(self.path, "w") as f:
+            f.write("x" * 10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_struct_sizes(self):
+        # values as found in linux/fiemap.h
+        self.assertEqual(ctypes.sizeof(btrfs_ioctl.Fiemap), 32)
+        self.assertEqual(ctypes.sizeof(FiemapExtent), 56)
+        self.assertEqual(btrfs_ioctl.FS_IOC_FIEMAP, 0xC020660B)
+
+    @mock.patch('btrfs_ioctl.fiemap')
+    def test_file_usage(self, mock_fiemap):
+        extents = [extent(0, 4096, FIEMAP_EXTENT_SHARED), extent(4096, 4096),
+                   extent(8192, 4096, FIEMAP_EXTENT_LAST)]
+        def fiemap(fd, start=0, length=0, count=32, flags=0):
+            if count == 0:
+                return len(extents), []
+            return len(extents), extents
+        mock_fiemap.side_effect = fiemap
+        self.assertEqual(file_usage(self.path), (12288, 8192))
+
+    @mock.patch('btrfs_ioctl.fiemap')
+    def test_file_usage_sampled(self, mock_fiemap):
+        def fiemap(fd, start=0, length=0, count=32, flags=0):
+            if count == 0:
+                return 5000, []
+            # every other window is shared
+            flags = FIEMAP_EXTENT_LAST
+            if start // 625 % 2 == 0:
+                flags |= FIEMAP_EXTENT_SHARED
+            return 1, [extent(start, 4096, flags)]
+        mock_fiemap.side_effect = fiemap
+        self.assertEqual(file_usage(self.path, max_extents=100, samples=16),
+                         (10000, 5000))
+        self.assertEqual(mock_fiemap.call_count, 17)
+
+    @mock.patch('btrfs_ioctl.fiemap')
+    def test_shares_data(self, mock_fiemap):
+        other = os.path.join(self.root, "other")
+        shutil.copy(self.path, other)
+        ino = os.stat(self.path).st_ino
+        shared = [extent(0, 4096, FIEMAP_EXTENT_SHARED, 1 << 20),
+                  extent(4096, 4096, FIEMAP_EXTENT_SHARED | FIEMAP_EXTENT_LAST,
+                         2 << 20)]
+        mapped = {ino: shared}
+
+        def fiemap(fd, start=0, length=0, count=32, flags=0):
+            extents = mapped.get(os.fstat(fd).st_ino, shared[:1])
+            if count == 0:
+                return len(extents), []
+            return len(extents), extents
+        mock_fiemap.side_effect = fiemap
+        # other only has the first extent
+        self.assertFalse(shares_data(self.path, other))
+        self.assertTrue(shares_data(other, self.path))
+        self.assertFalse(shares_data(other, self.path, max_extents=0))
+        self.assertFalse(shares_data(self.path, os.path.join(self.root, "x")))
+        mock_fiemap.side_effect = OSError(95, "Operation not supported")
+        self.assertFalse(shares_data(other, self.path))
+
+    @mock.patch('btrfs_ioctl.fiemap')
+    def test_file_usage_unsupported(self, mock_fiemap):
+        mock_fiemap.side_effect = OSError(95, "Operation not supported")
+        self.assertEqual(file_usage(self.path), None)
+        self.assertEqual(file_usage(os.path.join(self.root, "none")), None)
+
+    def test_freed_by(self):
+        self.assertEqual(freed_by((4096, 1024), 100), 25)
+        self.assertEqual(freed_by((0, 0), 100), 100)
+        self.assertEqual(freed_by(None, 100), 100)
+
+    def test_estimate(self):
+        os.mkdir(os.path.join(self.root, "dir"))
+        with open(os.path.join(self.root, "dir", "other"), "w") as f:
+            f.write("x" * 100)
+        os.symlink("file", os.path.join(self.root, "link"))
+        estimate = estimate_tree(self.root)
+        self.assertEqual((estimate.files, estimate.bytes), (2, 10100))
+        # nothing is shared outside of btrfs
+        self.assertEqual(estimate.freed, estimate.bytes)
+        estimate = estimate_files([self.path, os.path.join(self.root, "link")])
+        self.assertEqual((estimate.files, estimate.bytes), (1, 10000))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from groups import (
+    GROUP_DIR,
+    read_group_config,
+)
+from snapshots import (
+    SNAP_PREFIX,
+    TRASH_DIR,
+    Snapshot,
+)
+
+
+def snapshot(source, dest, readonly=False):
+    shutil.copytree(source, dest, symlinks=True)
+    return True
+
+
+def delete_many(which, commit=None):
+    for i in which:
+        shutil.rmtree(i)
+    return []
+
+
+@mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_delete_snapshots',
+    new=mock.Mock(side_effect=delete_many))
+@mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_snapshot',
+    new=mock.Mock(side_effect=snapshot))
+@mock.patch('sys.stdout', new=mock.Mock())
+class TestGroups(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        model_root = os.path.join(self.testdir, "data", "model_root")
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(model_root, self.sandbox, symlinks=True)
+        for member in ("@home", "@var"):
+            os.mkdir(os.path.join(self.sandbox, member))
+            self.write(member, "state", "live")
+        self.apt_btrfs = AptBtrfsSnapshot(
+            fstab=os.path.join(self.testdir, "data", "fstab"),
+            sandbox=self.sandbox, group=["@home", "@var"])
+
+    def tearDown(self):
+        del self.apt_btrfs
+        shutil.rmtree(self.sandbox)
+
+    def write(self, path, name, content):
+        with open(os.path.join(self.sandbox, path, name), "w") as f:
+            f.write(content)
+
+    def read(self, path, name):
+        with open(os.path.join(self.sandbox, path, name)) as f:
+            return f.read()
+
+    def create(self, tag=""):
+        before = set(os.listdir(self.sandbox))
+        self.apt_btrfs.create(tag, force=True)
+        self.apt_btrfs.reload()
+        return (set(os.listdir(self.sandbox)) - before - set([GROUP_DIR])).pop()
+
+    def test_create_and_tag(self):
+        name = self.create()
+        group = os.path.join(self.sandbox, GROUP_DIR, name)
+        self.assertEqual(sorted(os.listdir(group)), ["@home", "@var"])
+        self.assertEqual(self.apt_btrfs.group.members_of(name),
+                         ["@home", "@var"])
+        # one parent link for the lot
+        self.assertEqual(Snapshot("@").parent, Snapshot(name))
+        self.assertEqual(os.listdir(os.path.join(group, "@home")), ["state"])
+        self.apt_btrfs.tag(name, "-tag")
+        self.assertFalse(os.path.exists(group))
+        self.assertEqual(self.apt_btrfs.group.members_of(name + "-tag"),
+                         ["@home", "@var"])
+
+    def test_set_default(self):
+        name = self.create()
+        self.write("@home", "state", "changed")
+        self.apt_btrfs.set_default(name, "-backup")
+        self.assertEqual(self.read("@home", "state"), "live")
+        backup = [e for e in os.listdir(self.sandbox)
+                  if e.endswith("-backup")][0]
+        self.assertEqual(
+            self.read(os.path.join(GROUP_DIR, backup, "@home"), "state"),
+            "changed")
+        self.assertFalse(os.path.exists(
+            os.path.join(self.sandbox, "@apt-btrfs-staging@home")))
+        # snapshots from before the group leave the members alone
+        self.apt_btrfs.set_default(SNAP_PREFIX + "2013-08-06_13:26:30",
+                                   "-old")
+        self.assertEqual(self.read("@home", "state"), "live")
+
+    def assert_untouched(self, name):
+        self.assertEqual(Snapshot("@").parent, Snapshot(name))
+        self.assertEqual(self.read("@home", "state"), "changed")
+        self.assertEqual(self.read("@var", "state"), "live")
+        self.assertEqual([e for e in os.listdir(self.sandbox)
+                          if "staging" in e or e.endswith("-backup")], [])
+        self.assertEqual(os.listdir(os.path.join(self.sandbox, GROUP_DIR)),
+                         [name])
+
+    def test_set_default_member_fails(self):
+        name = self.create()
+        self.write("@home", "state", "changed")
+        self.write("@", "state", "live")
+
+        def fail_var(source, dest, readonly=False):
+            if dest.endswith("@var"):
+                return False
+            return snapshot(source, dest)
+
+        with mock.patch(
+                'apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_snapshot',
+                side_effect=fail_var):
+            with self.assertRaisesRegexp(Exception, "snapshot of @var"):
+                self.apt_btrfs.set_default(name, "-backup")
+        # all is as it was
+        self.assertEqual(self.read("@", "state"), "live")
+        self.assert_untouched(name)
+
+    def test_set_default_rename_fails(self):
+        name = self.create()
+        self.write("@home", "state", "changed")
+        self.write("@", "state", "live")
+        rename = self.apt_btrfs.storage.rename
+
+        def fail_var(old, new):
+            # the last of the moves, those before it are undone
+            if old.endswith("staging@var"):
+                raise OSError(16, "Device or resource busy")
+            rename(old, new)
+
+        with mock.patch.object(self.apt_btrfs.storage, "rename",
+                               side_effect=fail_var):
+            with self.assertRaisesRegexp(Exception, "nothing was changed"):
+                self.apt_btrfs.set_default(name, "-backup")
+        self.assertEqual(self.read("@", "state"), "live")
+        self.assert_untouched(name)
+
+    def test_delete(self):
+        name = self.create()
+        self.apt_btrfs.delete(name)
+        trash = os.path.join(self.sandbox, TRASH_DIR)
+        self.assertEqual(sorted(os.listdir(trash)),
+                         [name, name + ".@home", name + ".@var"])
+        self.assertFalse(os.path.exists(os.path.join(self.sandbox, GROUP_DIR)))
+        self.apt_btrfs.reclaim()
+        self.assertFalse(os.path.exists(trash))
+        self.assertEqual(self.read("@var", "state"), "live")
+
+    @mock.patch('subprocess.check_output')
+    def test_read_group_config(self, mock_output):
+        mock_output.return_value = (
+            b'APT::Snapshots::Group "";\n'
+            b'APT::Snapshots::Group:: "@var";\n'
+            b'APT::Snapshots::Group:: "@home";\n')
+        self.assertEqual(read_group_config(), ["@var", "@home"])
+        with self.assertRaisesRegexp(Exception, "Bad group member"):
+            AptBtrfsSnapshot(
+                fstab=os.path.join(self.testdir, "data", "fstab"),
+                sandbox=self.sandbox, group=["var"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+try:
+    from StringIO import StringIO
+    StringIO  # pyflakes
+except ImportError:
+    from io import StringIO
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from journal import (
+    JOURNAL,
+    Journal,
+    parse_hook_input,
+    record_hook_input,
+)
+
+
+HOOK_INPUT = """\
+VERSION 3
+APT::Architecture=amd64
+DPkg::Tools::Options::/usr/bin/apt-btrfs-snapshot::Version=3
+
+lynx - - none < 2.8.8-1 amd64 foreign /var/cache/apt/archives/lynx.deb
+libc6 2.15-0 i386 same < 2.15-1 i386 same /var/cache/apt/archives/libc6.deb
+nano 2.2.6-1 amd64 foreign > - - none **REMOVE**
+vim 7.3-1 amd64 foreign = 7.3-1 amd64 foreign **CONFIGURE**
+"""
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.journal = Journal(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_parse_hook_input(self):
+        self.assertEqual(parse_hook_input(HOOK_INPUT.splitlines()), [
+            ("install", "lynx", "<none>", "2.8.8-1"),
+            ("upgrade", "libc6:i386", "2.15-0", "2.15-1"),
+            ("remove", "nano", "2.2.6-1", "<none>"),
+        ])
+        with self.assertRaisesRegexp(ValueError, "Unsupported hook protocol"):
+            parse_hook_input(["VERSION 2"])
+
+    def test_segments(self):
+        self.assertFalse(self.journal.exists())
+        self.assertFalse(self.journal.mark("@one"))
+        self.assertEqual(self.journal.actions(), None)
+        self.journal.record([("install", "a", "<none>", "1")])
+        # the journal doesn't go back to a snapshot yet
+        self.assertEqual(self.journal.actions(), None)
+        self.assertTrue(self.journal.mark("@one"))
+        self.assertEqual(self.journal.actions(), [])
+        self.assertEqual(self.journal.actions(closed=True), None)
+        self.journal.record([("upgrade", "b", "1", "2")])
+        self.journal.record([("remove", "a", "1", "<none>")])
+        self.journal.mark("@two")
+        self.assertEqual(self.journal.actions(closed=True),
+            [("upgrade", "b", "1", "2"), ("remove", "a", "1", "<none>")])
+        self.journal.compact()
+        with open(os.path.join(self.root, JOURNAL)) as journal:
+            self.assertEqual(journal.read(), "@ @two\n")
+        self.assertEqual(self.journal.actions(), [])
+
+    @mock.patch('sys.stderr')
+    def test_record_hook_input(self, mock_stderr):
+        self.assertEqual(record_hook_input(StringIO(HOOK_INPUT), self.root), 0)
+        self.journal.mark("@one")
+        self.journal.mark("@two")
+        self.assertEqual(self.journal.actions(closed=True), [])
+        self.assertEqual(len(self.journal._read()[1][0]), 3)
+        # garbage is reported, apt carries on regardless
+        self.assertEqual(record_hook_input(StringIO("junk\n"), self.root), 0)
+        self.assertTrue(mock_stderr.write.called)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from locking import (
+    LockTimeout,
+    VolumeLock,
+    is_read_only,
+)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestVolumeLock(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def lock(self, shared, path=None):
+        if path is None:
+            path = self.tmpdir
+        return VolumeLock(path, shared=shared, timeout=5,
+                          clock=self.clock, sleep=self.clock.sleep)
+
+    def test_readers_share(self):
+        with self.lock(True):
+            with self.lock(True) as other:
+                self.assertFalse(other.waited)
+        self.assertEqual(self.clock.now, 0)
+
+    def test_writer_waits(self):
+        with self.lock(True):
+            with self.assertRaises(LockTimeout):
+                self.lock(False).acquire()
+        self.assertEqual(self.clock.now, 5)
+        with self.lock(False):
+            with self.assertRaises(LockTimeout):
+                self.lock(True).acquire()
+        # released, so free again
+        with self.lock(False) as writer:
+            self.assertFalse(writer.waited)
+
+    def test_lock_file(self):
+        path = os.path.join(self.tmpdir, "lock")
+        with self.lock(False, path):
+            self.assertTrue(os.path.exists(path))
+            with self.assertRaises(LockTimeout):
+                self.lock(False, path).acquire()
+
+    def test_is_read_only(self):
+        self.assertTrue(is_read_only("tree"))
+        self.assertTrue(is_read_only("delete", dry_run=True))
+        self.assertFalse(is_read_only("create"))
+        # it makes and deletes clones
+        self.assertFalse(is_read_only("export"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from maintenance import (
+    Throttle,
+    read_io_pressure,
+    read_load,
+)
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestPressure(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, contents):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+    def test_read_io_pressure(self):
+        path = self.write("io",
+            "some avg10=12.50 avg60=3.00 avg300=1.00 total=1234\n"
+            "full avg10=2.00 avg60=1.00 avg300=0.50 total=123\n")
+        self.assertEqual(read_io_pressure(path), 12.5)
+        self.assertEqual(read_io_pressure(os.path.join(self.tmpdir, "no")),
+                         None)
+
+    def test_read_load(self):
+        path = self.write("loadavg", "0.52 0.58 0.59 1/467 12345\n")
+        self.assertEqual(read_load(path), 0.52)
+        self.assertEqual(read_load(self.write("empty", "")), None)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def make_throttle(self, **kwargs):
+        return Throttle(clock=self.clock.time, sleep=self.clock.sleep,
+                        **kwargs)
+
+    @mock.patch('maintenance.read_load')
+    @mock.patch('maintenance.read_io_pressure')
+    def test_run_in_batches(self, mock_pressure, mock_load):
+        mock_pressure.return_value = 0.0
+        mock_load.return_value = 0.0
+        throttle = self.make_throttle(batch_size=3, max_load=1)
+        batches, syncs = [], []
+        left = throttle.run(range(8), batches.append,
+                            between=lambda: syncs.append(True))
+        self.assertEqual(left, [])
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6, 7]])
+        self.assertEqual(len(syncs), 2)
+
+    @mock.patch('maintenance.read_load')
+    @mock.patch('maintenance.read_io_pressure')
+    def test_no_wait_once_spent(self, mock_pressure, mock_load):
+        mock_pressure.return_value = 0.0
+        mock_load.return_value = 0.0
+        throttle = self.make_throttle(budget=10, batch_size=2, max_load=1)
+        syncs = []
+
+        def work(batch):
+            self.clock.now += 6
+
+        # the second batch spends the budget, so the cleaner isn't waited for
+        self.assertEqual(throttle.run(range(6), work,
+                                      between=lambda: syncs.append(True)),
+                         [4, 5])
+        self.assertEqual(len(syncs), 1)
+
+    @mock.patch('maintenance.read_load')
+    @mock.patch('maintenance.read_io_pressure')
+    def test_back_off_under_pressure(self, mock_pressure, mock_load):
+        mock_load.return_value = None
+        # busy for the first three checks
+        pressures = [50.0, 50.0, 50.0]
+        mock_pressure.side_effect = lambda: pressures and pressures.pop() or 0
+        throttle = self.make_throttle(batch_size=5, backoff=5)
+        batches = []
+        self.assertEqual(throttle.run(range(5), batches.append), [])
+        self.assertEqual(batches, [[0, 1, 2, 3, 4]])
+        self.assertEqual(self.clock.now, 5 + 10 + 20)
+
+    @mock.patch('maintenance.read_load')
+    @mock.patch('maintenance.read_io_pressure')
+    def test_budget(self, mock_pressure, mock_load):
+        mock_pressure.return_value = 0.0
+        mock_load.return_value = 0.0
+        throttle = self.make_throttle(budget=10, batch_size=2, max_load=1)
+        def work(batch):
+            self.clock.now += 4
+        self.assertEqual(throttle.run(range(10), work), [6, 7, 8, 9])
+        # permanently busy, gives up when the budget is spent
+        mock_pressure.return_value = 90.0
+        throttle = self.make_throttle(budget=30, batch_size=2)
+        start = self.clock.now
+        self.assertEqual(throttle.run(range(2), work), [0, 1])
+        self.assertEqual(self.clock.now - start, 30)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import datetime
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import snapshots
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from metrics import (
+    Histogram,
+    METRICS_FILE,
+    RunHistory,
+    collect,
+    read_metrics_dir,
+    timestamp,
+    write_textfile,
+)
+from sizes import (
+    SIZES_FILE,
+    SizeCache,
+)
+from snapshots import SNAP_PREFIX
+from space import Space
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, name, day, tag="", parent=None):
+        self.name = name
+        self.date = datetime.datetime(2013, 8, day)
+        self.tag = tag
+        self.parent = parent
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 2, 20):
+            histogram.observe(value)
+        self.assertEqual(histogram.lines("x", 'command="create"'), [
+            'x_bucket{command="create",le="1"} 1',
+            'x_bucket{command="create",le="10"} 2',
+            'x_bucket{command="create",le="+Inf"} 3',
+            'x_sum{command="create"} 22.5',
+            'x_count{command="create"} 3'])
+
+    def test_round_trip(self):
+        histogram = Histogram((1, 10))
+        histogram.observe(5)
+        again = Histogram.from_dict(histogram.as_dict(), (1, 10))
+        self.assertEqual((again.counts, again.count), ([0, 1], 1))
+        # other buckets, the counts can't be carried over
+        self.assertEqual(Histogram.from_dict(histogram.as_dict(),
+                                             (1, 5)).count, 0)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_history(self):
+        path = os.path.join(self.tmpdir, "history")
+        history = RunHistory(path)
+        history.observe("create", 0.3, True, when=100)
+        history.save()
+        history = RunHistory(path)
+        history.observe("create", 2.0, False, when=200)
+        entry = history.commands["create"]
+        self.assertEqual((entry["last"], entry["duration"], entry["ok"]),
+                         (200, 2.0, False))
+        self.assertEqual((entry["success"], entry["failure"]), (1, 1))
+        self.assertEqual(entry["histogram"]["count"], 2)
+        with open(path, "w") as corrupt:
+            corrupt.write("{")
+        self.assertEqual(RunHistory(path).commands, {})
+
+    def test_collect(self):
+        a = FakeSnapshot("@a", 1)
+        b = FakeSnapshot("@b", 2, "-tagged", parent=a)
+        c = FakeSnapshot("@c", 3, parent=a)
+        history = RunHistory(os.path.join(self.tmpdir, "history"))
+        history.observe("create", 0.3, True, when=100)
+        now = timestamp(c.date) + 7200
+        lines = collect([a, b, c], c, now=now, history=history, trash=2,
+                        sizes={"@a": (10, 20), "@c": (5, 20)},
+                        space=Space(1000, 400)).text().splitlines()
+        for expected in [
+                '# TYPE apt_btrfs_snapshot_snapshots gauge',
+                'apt_btrfs_snapshot_snapshots{tagged="false"} 2',
+                'apt_btrfs_snapshot_snapshots{tagged="true"} 1',
+                'apt_btrfs_snapshot_oldest_snapshot_timestamp_seconds %r' %
+                timestamp(a.date),
+                'apt_btrfs_snapshot_snapshot_age_seconds_bucket{le="3600"} 0',
+                'apt_btrfs_snapshot_snapshot_age_seconds_bucket{le="86400"} 1',
+                'apt_btrfs_snapshot_snapshot_age_seconds_count 3',
+                'apt_btrfs_snapshot_root_ancestors 2',
+                'apt_btrfs_snapshot_branches 2',
+                'apt_btrfs_snapshot_trash_subvolumes 2',
+                'apt_btrfs_snapshot_sized_snapshots 2',
+                'apt_btrfs_snapshot_exclusive_bytes 15',
+                'apt_btrfs_snapshot_volume_free_bytes 400',
+                'apt_btrfs_snapshot_last_run_duration_seconds'
+                '{command="create"} 0.3',
+                'apt_btrfs_snapshot_runs_total'
+                '{command="create",result="failure"} 0',
+                '# TYPE apt_btrfs_snapshot_run_duration_seconds histogram',
+                'apt_btrfs_snapshot_run_duration_seconds_bucket'
+                '{command="create",le="+Inf"} 1']:
+            self.assertIn(expected, lines)
+
+    def test_collect_nothing(self):
+        text = collect([], None).text()
+        self.assertIn('apt_btrfs_snapshot_snapshots{tagged="false"} 0', text)
+        self.assertNotIn("oldest", text)
+        self.assertNotIn("last_run", text)
+
+    def test_write_textfile(self):
+        path = write_textfile(self.tmpdir, "a 1\n")
+        self.assertEqual(path, os.path.join(self.tmpdir, METRICS_FILE))
+        write_textfile(self.tmpdir, "a 2\n")
+        with open(path) as textfile:
+            self.assertEqual(textfile.read(), "a 2\n")
+        self.assertEqual(os.listdir(self.tmpdir), [METRICS_FILE])
+
+    @mock.patch('subprocess.check_output')
+    def test_read_metrics_dir(self, mock_output):
+        mock_output.return_value = (
+            b'APT::Snapshots::MetricsDir "/srv/prom/";\n')
+        self.assertEqual(read_metrics_dir(), "/srv/prom/")
+        mock_output.return_value = b""
+        self.assertEqual(read_metrics_dir(),
+                         "/var/lib/prometheus/node-exporter")
+        mock_output.side_effect = OSError(2, "apt-config")
+        self.assertEqual(read_metrics_dir(),
+                         "/var/lib/prometheus/node-exporter")
+
+
+@mock.patch('sys.stdout', new=mock.Mock())
+@mock.patch('apt_btrfs_snapshot.LowLevelCommands.btrfs_subvolume_list',
+            new=mock.Mock(return_value=None))
+class TestMetricsCommand(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(os.path.join(self.testdir, "data", "model_root"),
+                        self.sandbox, symlinks=True)
+        self.apt_btrfs = AptBtrfsSnapshot(
+            fstab=os.path.join(self.testdir, "data", "fstab"),
+            sandbox=self.sandbox)
+        self.prom = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+        shutil.rmtree(self.prom)
+
+    def test_metrics(self):
+        self.apt_btrfs.record_run("create", 1.5, True)
+        self.assertTrue(self.apt_btrfs.metrics(self.prom))
+        with open(os.path.join(self.prom, METRICS_FILE)) as textfile:
+            text = textfile.read()
+        self.assertIn("apt_btrfs_snapshot_snapshots{", text)
+        self.assertIn('apt_btrfs_snapshot_last_run_duration_seconds'
+                      '{command="create"} 1.5', text)
+        self.assertIn("apt_btrfs_snapshot_sized_snapshots 0", text)
+
+    def test_sizes_after_create(self):
+        names = [s.name for s in snapshots.get_list()]
+        cache = SizeCache(os.path.join(self.sandbox, SIZES_FILE), names)
+        for name in names:
+            cache.put(name, "u:1", (1, 2))
+        cache.save()
+        # a snapshot was just made
+        new = SNAP_PREFIX + "2020-01-01_00:00:00"
+        os.mkdir(os.path.join(self.sandbox, new))
+        self.apt_btrfs.reload()
+        subvolumes = dict((name, (i, 1, "u"))
+                          for i, name in enumerate(names + [new]))
+        with mock.patch('apt_btrfs_snapshot.LowLevelCommands.'
+                        'btrfs_subvolume_list', return_value=subvolumes):
+            self.assertTrue(self.apt_btrfs.metrics(self.prom, auto=True))
+        with open(os.path.join(self.prom, METRICS_FILE)) as textfile:
+            text = textfile.read()
+        self.assertIn("apt_btrfs_snapshot_sized_snapshots %d" % len(names),
+                      text)
+
+    def test_quick(self):
+        names = [s.name for s in snapshots.get_list()]
+        cache = SizeCache(os.path.join(self.sandbox, SIZES_FILE), names)
+        cache.put(names[0], "u:1", (1, 2))
+        cache.save()
+        with mock.patch('apt_btrfs_snapshot.LowLevelCommands.'
+                        'btrfs_subvolume_list') as mock_list:
+            self.assertTrue(self.apt_btrfs.metrics(self.prom, auto=True,
+                                                   quick=True))
+            self.assertFalse(mock_list.called)
+        with open(os.path.join(self.prom, METRICS_FILE)) as textfile:
+            self.assertIn("apt_btrfs_snapshot_sized_snapshots 1",
+                          textfile.read())
+
+    def test_auto(self):
+        missing = os.path.join(self.prom, "missing")
+        self.assertTrue(self.apt_btrfs.metrics(missing, auto=True))
+        self.assertFalse(os.path.exists(missing))
+        self.assertFalse(self.apt_btrfs.metrics(missing))
+        os.chmod(self.prom, 0o500)
+        try:
+            if os.access(self.prom, os.W_OK):
+                # root writes anyway
+                return
+            self.assertTrue(self.apt_btrfs.metrics(self.prom, auto=True))
+        finally:
+            os.chmod(self.prom, 0o700)
+
+
+if __name__ == "__main__":
+    unittest.main()
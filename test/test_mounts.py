@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from mounts import (
+    MountInfo,
+    find_top_level_mount,
+    read_mountinfo,
+)
+
+
+MOUNTINFO = """\
+23 28 0:22 / /proc rw,relatime - proc proc rw
+28 1 0:27 /@ / rw,relatime shared:1 - btrfs /dev/sda1 rw,subvolid=257,subvol=/@
+29 28 0:27 /@home /home rw,relatime shared:2 - btrfs /dev/sda1 rw,subvolid=258,subvol=/@home
+30 28 0:27 / %(top)s rw,relatime - btrfs /dev/sda1 rw,subvolid=5,subvol=/
+31 28 0:28 / /srv/no-such-dir rw,relatime shared:3 - btrfs /dev/sdb1 rw,subvolid=5,subvol=/
+"""
+
+
+class TestMounts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmpdir, "top level")
+        os.mkdir(self.top)
+        self.mountinfo = os.path.join(self.tmpdir, "mountinfo")
+        with open(self.mountinfo, "w") as f:
+            f.write(MOUNTINFO % {"top": self.top.replace(" ", "\\040")})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_from_line(self):
+        mount = MountInfo.from_line(MOUNTINFO.splitlines()[1])
+        self.assertEqual((mount.root, mount.mountpoint, mount.fstype,
+                          mount.source, mount.subvolid),
+                         ("/@", "/", "btrfs", "/dev/sda1", "257"))
+        mount = MountInfo.from_line(MOUNTINFO.splitlines()[0])
+        self.assertEqual(mount.subvolid, None)
+
+    def test_read_mountinfo(self):
+        mounts = read_mountinfo(self.mountinfo)
+        self.assertEqual(len(mounts), 5)
+        self.assertEqual(mounts[3].mountpoint, self.top)
+        self.assertEqual(read_mountinfo(os.path.join(self.tmpdir, "no")), [])
+
+    @mock.patch('os.path.realpath')
+    def test_find_top_level_mount(self, mock_realpath):
+        devices = {"/dev/disk/by-uuid/1234": "/dev/sda1"}
+        mock_realpath.side_effect = lambda p: devices.get(p, p)
+        self.assertEqual(find_top_level_mount("UUID=1234", self.mountinfo),
+                         self.top)
+        self.assertEqual(find_top_level_mount("/dev/sdc1", self.mountinfo),
+                         None)
+        # the mountpoint doesn't exist here
+        self.assertEqual(find_top_level_mount("/dev/sdb1", self.mountinfo),
+                         None)
+
+
+if __name__ == "__main__":
+    unittest.main()
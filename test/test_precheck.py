@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import precheck
+from precheck import (
+    apt_config,
+    coalesce_window,
+    last_snapshot_time,
+    recent_snapshot,
+    save_last_snapshot_time,
+    skip_create,
+    supported,
+)
+
+
+class TestPrecheck(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        self.tmpdir = tempfile.mkdtemp()
+        self.fstab = os.path.join(self.tmpdir, "fstab")
+        shutil.copy(os.path.join(self.testdir, "data", "fstab"), self.fstab)
+        self.cache = os.path.join(self.tmpdir, "supported")
+        self.coalesce_cache = os.path.join(self.tmpdir, "coalesce")
+        self.last = os.path.join(self.tmpdir, "last")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('os.path.exists')
+    def test_supported_cached(self, mock_exists):
+        mock_exists.side_effect = lambda f: f == "/sbin/btrfs"
+        with mock.patch('precheck._check_fstab') as mock_check:
+            mock_check.return_value = True
+            self.assertTrue(supported(self.fstab, self.cache))
+            self.assertTrue(supported(self.fstab, self.cache))
+            self.assertEqual(mock_check.call_count, 1)
+            # a modified fstab is looked at again
+            os.utime(self.fstab, (0, 0))
+            mock_check.return_value = False
+            self.assertFalse(supported(self.fstab, self.cache))
+            self.assertEqual(mock_check.call_count, 2)
+        # the binary is always checked for
+        mock_exists.side_effect = lambda f: False
+        self.assertFalse(supported(self.fstab, self.cache))
+
+    def test_recent_snapshot(self):
+        self.assertEqual(recent_snapshot(self.last), None)
+        now = time.time()
+        with open(self.last, "w") as last:
+            last.write(str(now - 10))
+        self.assertAlmostEqual(recent_snapshot(self.last, now), now - 10, 1)
+        self.assertEqual(recent_snapshot(self.last, now + 60), None)
+        self.assertEqual(recent_snapshot(self.last, now, window=5), None)
+
+    def test_save_last_snapshot_time(self):
+        save_last_snapshot_time(1234.5678, self.last)
+        self.assertEqual(last_snapshot_time(self.last), 1234.5678)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["fstab", "last"])
+
+    @mock.patch('subprocess.check_output')
+    def test_coalesce_window(self, mock_output):
+        mock_output.return_value = b"Coalesce='5'\n"
+        self.assertEqual(coalesce_window(), 5)
+        mock_output.return_value = b""
+        self.assertEqual(coalesce_window(), precheck.DEBOUNCE)
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            self.assertEqual(coalesce_window(), 0)
+        # apt-config is asked once, until apt.conf changes
+        apt_conf = os.path.join(self.tmpdir, "apt.conf.d")
+        os.mkdir(apt_conf)
+        mock_output.return_value = b"Coalesce='5'\n"
+        with mock.patch('precheck.APT_CONF', (apt_conf,)):
+            self.assertEqual(coalesce_window(self.coalesce_cache), 5)
+            mock_output.return_value = b"Coalesce='10'\n"
+            self.assertEqual(coalesce_window(self.coalesce_cache), 5)
+            os.utime(apt_conf, (0, 0))
+            self.assertEqual(coalesce_window(self.coalesce_cache), 10)
+        self.assertEqual(mock_output.call_count, 4)
+
+    @mock.patch('subprocess.check_output')
+    def test_apt_config(self, mock_output):
+        mock_output.return_value = (
+            b'APT::Snapshots "";\n'
+            b'APT::Snapshots::MinFree "5%";\n'
+            b'APT::Snapshots::Group "";\n'
+            b'APT::Snapshots::Group:: "@var";\n')
+        config = [("APT::Snapshots::MinFree", "5%"),
+                  ("APT::Snapshots::Group", ""),
+                  ("APT::Snapshots::Group::", "@var")]
+        self.assertEqual(apt_config(), config)
+        self.assertEqual(mock_output.call_args[0][0],
+                         ["apt-config", "dump", "APT::Snapshots"])
+        # apt-config is asked once, until apt.conf changes
+        cache = os.path.join(self.tmpdir, "config")
+        apt_conf = os.path.join(self.tmpdir, "apt.conf.d")
+        os.mkdir(apt_conf)
+        with mock.patch('precheck.APT_CONF', (apt_conf,)):
+            self.assertEqual(apt_config(cache), config)
+            mock_output.return_value = b""
+            self.assertEqual(apt_config(cache), config)
+            os.utime(apt_conf, (0, 0))
+            self.assertEqual(apt_config(cache), [])
+        self.assertEqual(mock_output.call_count, 3)
+        mock_output.side_effect = OSError(2, "apt-config")
+        self.assertEqual(apt_config(), [])
+
+    @mock.patch('precheck.supported')
+    def test_skip_create(self, mock_supported):
+        mock_supported.return_value = True
+        args = (self.fstab, self.cache, self.last, self.coalesce_cache)
+        self.assertEqual(skip_create(*args), None)
+        with open(self.last, "w") as last:
+            last.write(str(time.time()))
+        self.assertTrue(skip_create(*args
+            ).startswith("A recent snapshot already exists"))
+        with mock.patch.dict(os.environ, {"APT_SNAPSHOTS_COALESCE": "0"}):
+            self.assertEqual(skip_create(*args), None)
+        mock_supported.return_value = False
+        self.assertEqual(skip_create(*args), "")
+        with mock.patch.dict(os.environ, {"APT_NO_SNAPSHOTS": "1"}):
+            self.assertTrue("APT_NO_SNAPSHOTS" in skip_create())
+
+
+if __name__ == "__main__":
+    unittest.main()
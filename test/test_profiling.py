@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+try:
+    from StringIO import StringIO
+    StringIO  # pyflakes
+except ImportError:
+    from io import StringIO
+import json
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import snapshots
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from profiling import Profiler
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+
+class Work(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def outer(self):
+        self.clock.now += 1
+        self.inner()
+        self.inner()
+        return "done"
+
+    def inner(self):
+        self.clock.now += 2
+
+    def fail(self):
+        self.clock.now += 4
+        raise ValueError("oops")
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.profiler = Profiler("test", clock=self.clock.time,
+                                 cpu=lambda: 0.0)
+        self.profiler.instrument(Work)
+
+    def tearDown(self):
+        self.profiler.restore()
+
+    def test_phases(self):
+        work = Work(self.clock)
+        self.assertEqual(work.outer(), "done")
+        self.assertEqual(work.outer.__name__, "outer")
+        phases = self.profiler.phases
+        self.assertEqual(sorted(phases),
+                         ["Work.__init__", "Work.inner", "Work.outer"])
+        self.assertEqual(phases["Work.outer"].calls, 1)
+        self.assertEqual(phases["Work.outer"].wall, 5)
+        self.assertEqual(phases["Work.outer"].own, 1)
+        self.assertEqual(phases["Work.inner"].calls, 2)
+        self.assertEqual(phases["Work.inner"].wall, 4)
+        self.assertEqual(phases["Work.inner"].own, 4)
+        # failures are timed too
+        self.assertRaises(ValueError, work.fail)
+        self.assertEqual(phases["Work.fail"].wall, 4)
+
+    def test_restore(self):
+        self.profiler.restore()
+        Work(self.clock).outer()
+        self.assertEqual(self.profiler.phases, {})
+
+    def test_report(self):
+        self.clock.now = 90.0
+        profiler = Profiler("create", started=80.0, clock=self.clock.time,
+                            cpu=lambda: 0.5)
+        with profiler.phase("mount"):
+            self.clock.now += 2
+        out = StringIO()
+        profiler.report(out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "Profile of create: 12.000s wall, 0.500s cpu",
+            "   calls      wall       cpu      self  phase",
+            "       1   10.000s    0.500s   10.000s  startup",
+            "       1    2.000s    0.000s    2.000s  mount"])
+
+    def test_record(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log = os.path.join(tmpdir, "profile.log")
+            Work(self.clock).outer()
+            self.profiler.finish(log)
+            self.profiler.finish(log)
+            with open(log) as lines:
+                entries = [json.loads(line) for line in lines]
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]["command"], "test")
+        self.assertEqual(entries[0]["wall"], 5)
+        self.assertEqual(entries[0]["phases"][0], {
+            "name": "Work.outer", "calls": 1, "wall": 5, "cpu": 0,
+            "self": 1})
+
+
+@mock.patch('sys.stdout', new=mock.Mock())
+class TestProfileCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(os.path.join(self.testdir, "data", "model_root"),
+                        self.sandbox, symlinks=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+
+    def test_instrument_commands(self):
+        original = vars(AptBtrfsSnapshot)["list"]
+        profiler = Profiler("list")
+        profiler.instrument(AptBtrfsSnapshot)
+        profiler.instrument(snapshots, ["setup"])
+        try:
+            apt_btrfs = AptBtrfsSnapshot(
+                fstab=os.path.join(self.testdir, "data", "fstab"),
+                sandbox=self.sandbox)
+            apt_btrfs.list()
+        finally:
+            profiler.restore()
+        self.assertEqual(sorted(profiler.phases), [
+            "AptBtrfsSnapshot.__init__", "AptBtrfsSnapshot.list",
+            "snapshots.setup"])
+        self.assertTrue(profiler.phases["AptBtrfsSnapshot.__init__"].wall >=
+                        profiler.phases["snapshots.setup"].wall)
+        self.assertIs(vars(AptBtrfsSnapshot)["list"], original)
+
+
+if __name__ == "__main__":
+    unittest.main()
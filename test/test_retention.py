@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import datetime
+import sys
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from retention import (
+    RetentionPolicy,
+    parse_days,
+)
+from snapshots import (
+    Snapshot,
+    SNAP_PREFIX,
+)
+
+
+NOW = datetime.datetime(2013, 9, 1, 12, 0, 0)
+
+
+def make_snapshot(hours_ago, tag=""):
+    date = NOW - datetime.timedelta(hours=hours_ago)
+    name = SNAP_PREFIX + date.strftime("%Y-%m-%d_%H:%M:%S")
+    if tag:
+        name += "-" + tag
+    return Snapshot(name)
+
+
+class TestRetentionPolicy(unittest.TestCase):
+
+    def setUp(self):
+        # one snapshot every 6 hours for 60 days
+        self.snapshots = [make_snapshot(h) for h in range(1, 60 * 24, 6)]
+
+    def names(self, snapshot_list):
+        return sorted(s.name for s in snapshot_list)
+
+    def test_parse_days(self):
+        self.assertEqual(parse_days("10d"), datetime.timedelta(10))
+        with self.assertRaisesRegexp(Exception, "Please specify time in"):
+            parse_days("10")
+
+    def test_no_rules_keeps_everything(self):
+        keep, delete = RetentionPolicy().plan(self.snapshots, now=NOW)
+        self.assertEqual(len(keep), len(self.snapshots))
+        self.assertEqual(delete, [])
+
+    def test_max_age(self):
+        policy = RetentionPolicy(max_age="7d")
+        keep, delete = policy.plan(self.snapshots, now=NOW)
+        self.assertEqual(len(keep), 28)
+        for s in keep:
+            self.assertTrue(NOW - s.date <= datetime.timedelta(7))
+        self.assertEqual(len(keep) + len(delete), len(self.snapshots))
+
+    def test_grandfather_father_son(self):
+        policy = RetentionPolicy(max_age="0d", hourly=2, daily=3, weekly=2,
+                                 monthly=2)
+        keep, delete = policy.plan(self.snapshots, now=NOW)
+        expected = [make_snapshot(h) for h in (
+            1, 7,       # hourly
+            13, 37,     # daily, along with the first one
+            157)]       # weekly: 2013-08-25 ends the week before, the
+                        # monthly ones are already kept
+        self.assertEqual(self.names(keep), self.names(expected))
+
+    def test_max_count(self):
+        policy = RetentionPolicy(max_count=5)
+        keep, delete = policy.plan(self.snapshots, now=NOW)
+        self.assertEqual(self.names(keep),
+                         self.names(self.snapshots[:5]))
+
+    def test_tags(self):
+        tagged = [make_snapshot(h, "release") for h in (2, 100, 1000)]
+        tagged.append(make_snapshot(1200, "other"))
+        policy = RetentionPolicy(max_age="0d", tags={"release": 2})
+        keep, delete = policy.plan(self.snapshots + tagged, now=NOW)
+        self.assertEqual(self.names(keep), self.names(
+            [tagged[0], tagged[1], tagged[3]]))
+
+    def test_protect(self):
+        policy = RetentionPolicy(max_age="0d")
+        keep, delete = policy.plan(self.snapshots, now=NOW,
+                                   protect=[self.snapshots[3]])
+        self.assertEqual(keep, [self.snapshots[3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
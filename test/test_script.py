@@ -19,12 +19,18 @@ class TestScript(unittest.TestCase):
         commands_that_work = { 
             "create":                  "Calls: create()",
             "create -t tag":           "Calls: create(-tag)",
+            "create --if-supported":   "Calls: create()",
+            "create --force":          "Calls: create(, force=True)",
+            "create -r":               "Calls: create(, read_only=True)",
             "status":                  "Calls: status()",
             "show @snap":              "Calls: show(@snap)",
+            "show @snap --sizes":      "Calls: show(@snap, sizes=True)",
             "tag @snap name":          "Calls: tag(@snap, -name)",
             "list":                    "Calls: list()",
+            "list --sizes":            "Calls: list(, sizes=True)",
             "clean":                   "Calls: clean()",
             "tree":                    "Calls: tree()",
+            "tree --sizes":            "Calls: tree(, sizes=True)",
             "list-older-than 30d":     "Calls: list_older_than(30d)",
             "set-default snap":        "Calls: set_default(snap, )",
             "set-default snap -t tag": "Calls: set_default(snap, -tag)",
@@ -33,11 +39,19 @@ class TestScript(unittest.TestCase):
             "rollback -t tag":         "Calls: rollback(1, -tag)",
             "rollback -n 5 -t tag":    "Calls: rollback(5, -tag)",
             "delete snap":             "Calls: delete(snap)",
+            "delete snap --dry-run":   "Calls: delete(snap, dry_run=True)",
             "delete-older-than 5d":    "Calls: delete_older_than(5d)",
+            "reclaim":                 "Calls: reclaim(None)",
+            "reclaim --commit each":   "Calls: reclaim(each)",
             "recent":                  "Calls: recent(5, @)",
             "recent -n 3":             "Calls: recent(3, @)",
             "recent -s 3":             "Calls: recent(5, 3)",
             "recent -n 7 -s s":        "Calls: recent(7, s)",
+            "export /backup":          "Calls: export(/backup, [])",
+            "export /backup --receive snap":
+                "Calls: export(/backup, ['snap'], receive=True)",
+            "metrics":                 "Calls: metrics()",
+            "metrics -d /tmp/prom":    "Calls: metrics(/tmp/prom)",
         }
         for cmd, expected in commands_that_work.items():
             args = ["../apt-btrfs-snapshot", "--test"]
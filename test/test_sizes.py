@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from sizes import (
+    SizeCache,
+    walk,
+)
+
+
+class TestSizeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sizes")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        cache = SizeCache(self.path, ["@a", "@b"])
+        self.assertEqual(cache.get("@a", "u:1"), None)
+        cache.put("@a", "u:1", (10, 20))
+        cache.put("@b", None, (30, 40))
+        cache.save()
+        cache = SizeCache(self.path, ["@b", "@a"])
+        self.assertEqual(cache.get("@a", "u:1"), (10, 20))
+        # another generation
+        self.assertEqual(cache.get("@a", "u:2"), None)
+        # nothing is kept without a key
+        self.assertEqual(cache.get("@b", None), None)
+
+    def test_snapshots_come_and_go(self):
+        cache = SizeCache(self.path, ["@a", "@b"])
+        cache.put("@a", "u:1", (10, 20))
+        cache.save()
+        # a new snapshot leaves the others as they were
+        cache = SizeCache(self.path, ["@a", "@b", "@c"])
+        self.assertEqual(cache.get("@a", "u:1"), (10, 20))
+        cache.put("@c", "u:3", (1, 2))
+        cache.save()
+        self.assertEqual(SizeCache(self.path, ["@a", "@b", "@c"]).get(
+            "@c", "u:3"), (1, 2))
+        # a deleted one may have left its data to the others
+        cache = SizeCache(self.path, ["@a", "@c"])
+        self.assertEqual(cache.entries, {})
+        cache.save()
+        self.assertEqual(SizeCache(self.path, ["@a", "@c"]).entries, {})
+
+    def test_corrupt(self):
+        with open(self.path, "w") as cache:
+            cache.write("@a\n@a u:1 ten\n")
+        self.assertEqual(SizeCache(self.path, ["@a"]).entries, {})
+
+    @mock.patch('sizes.estimate_tree')
+    def test_walk_budget(self, mock_estimate):
+        now = [0]
+
+        def estimate(path):
+            now[0] += 10
+            return mock.Mock(freed=1, bytes=2)
+
+        mock_estimate.side_effect = estimate
+        cache = SizeCache(self.path, [])
+        jobs = [("@%d" % i, "/mp/@%d" % i, "u:%d" % i) for i in range(5)]
+        found = walk(cache, jobs, budget=25, clock=lambda: now[0])
+        self.assertEqual(sorted(found), ["@0", "@1", "@2"])
+        self.assertEqual(SizeCache(self.path, []).get("@2", "u:2"), (1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
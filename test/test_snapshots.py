@@ -25,6 +25,7 @@ from snapshots import (
     Snapshot,
     PARENT_LINK, 
     CHANGES_FILE, 
+    PENDING_FILE,
     SNAP_PREFIX, 
     PARENT_DOTS, 
 )
@@ -121,12 +122,85 @@ class TestSnapshot(unittest.TestCase):
         self.assertIn(Snapshot(snapname), d)
         self.assertEqual(d[Snapshot(snapname)], d[snapshot], 3)
     
+    def test_ancestry(self):
+        ancestry = snapshots.Ancestry()
+        self.assertTrue(ancestry.monotonic)
+        everyone = snapshots.get_list() + [Snapshot("@")]
+        for one in everyone:
+            for another in everyone:
+                self.assertEqual(
+                    ancestry.first_common_ancestor(one, another),
+                    snapshots.first_common_ancestor(one, another))
+        self.assertEqual(ancestry.first_common_ancestor(
+            Snapshot(SNAP_PREFIX + "2013-08-02_00:24:00"),
+            Snapshot(SNAP_PREFIX + "2013-08-06_00:29:05")).name,
+            SNAP_PREFIX + "2013-08-01_19:53:16")
+        # a parent younger than its child, the dates can't be relied on
+        child = Snapshot(SNAP_PREFIX + "2013-07-26_14:50:53")
+        child.parent = Snapshot(SNAP_PREFIX + "2013-08-09_21:06:00")
+        snapshots._parse_tree()
+        self.assertFalse(snapshots.Ancestry().monotonic)
+
+    def test_pending_changes(self):
+        snapshot = Snapshot(SNAP_PREFIX + "2013-08-06_13:26:30")
+        var_location = os.path.join(self.testdir, "data", "var")
+        snapshot.mark_changes_pending(datetime.datetime(2013, 8, 6, 12, 20),
+                                      None, var_location)
+        pending_file = os.path.join(self.sandbox, snapshot.name, PENDING_FILE)
+        self.assertTrue(os.path.exists(pending_file))
+        self.assertTrue(snapshot.changes_pending)
+        # the first read works them out
+        self.assertEqual(len(snapshot.changes['install']), 10)
+        self.assertFalse(snapshot.changes_pending)
+        # finalising again changes nothing
+        snapshot.finalise_changes()
+        self.assertEqual(len(snapshot.changes['install']), 10)
+        # setting the changes supersedes pending ones
+        snapshot.mark_changes_pending(None, None, var_location)
+        snapshot.changes = None
+        self.assertFalse(snapshot.changes_pending)
+        self.assertEqual(snapshot.changes, None)
+
     def test_tag(self):
         tagged = Snapshot(SNAP_PREFIX + "2013-07-31_12:53:16-raring-to-go")
         not_tagged = Snapshot(SNAP_PREFIX + "2013-07-26_14:50:53")
         self.assertEqual(tagged.tag, "raring-to-go")
         self.assertEqual(not_tagged.tag, "")
 
+    def test_parse_name(self):
+        date, stamp, tag = snapshots.parse_name(
+            SNAP_PREFIX + "2013-07-31_12:53:16.000250-raring-to-go")
+        self.assertEqual(date, datetime.datetime(2013, 7, 31, 12, 53, 16, 250))
+        self.assertEqual(stamp, "2013-07-31_12:53:16.000250")
+        self.assertEqual(tag, "raring-to-go")
+        self.assertEqual(snapshots.parse_name(
+            SNAP_PREFIX + "2013-07-31_12:53:16")[1:], ("2013-07-31_12:53:16", ""))
+        for bad in ("@", SNAP_PREFIX + "2013-07-31", 
+                    SNAP_PREFIX + "2013-07-31_12:53:16.25"):
+            with self.assertRaises(ValueError):
+                snapshots.parse_name(bad)
+
+    def test_new_name(self):
+        date = datetime.datetime(2013, 8, 6, 13, 26, 30, 250)
+        # the second is taken by the snapshot in the sandbox
+        first = snapshots.new_name("-tag", date)
+        self.assertEqual(first, SNAP_PREFIX + "2013-08-06_13:26:30.000250-tag")
+        os.mkdir(os.path.join(self.sandbox, first))
+        second = snapshots.new_name("", date)
+        self.assertEqual(second, SNAP_PREFIX + "2013-08-06_13:26:30.000251")
+        self.assertEqual(snapshots.new_name("", date.replace(second=31)),
+                         SNAP_PREFIX + "2013-08-06_13:26:31")
+        self.assertEqual(Snapshot(second).date,
+                         datetime.datetime(2013, 8, 6, 13, 26, 30, 251))
+        self.assertTrue(Snapshot(first).date < Snapshot(second).date)
+
+    def test_read_only_config(self):
+        key = snapshots.READ_ONLY_KEY
+        self.assertTrue(snapshots.read_only_config([(key, "true")]))
+        self.assertTrue(snapshots.read_only_config([(key, "Yes")]))
+        self.assertFalse(snapshots.read_only_config([(key, "false")]))
+        self.assertFalse(snapshots.read_only_config([]))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+import datetime
+import mock
+import sys
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+from space import (
+    Space,
+    SpaceGuard,
+    measure,
+    parse_threshold,
+    read_space_config,
+)
+
+GiB = 1 << 30
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, name, day):
+        self.name = name
+        self.date = datetime.datetime(2013, 8, day)
+
+
+class FakeVolume(object):
+    """ whose space comes back a while after each snapshot is pruned,
+        prune waits for it as long as it may
+    """
+
+    def __init__(self, clock, free, freed_by_each, delay=1.0):
+        self.clock = clock
+        self.free = free
+        self.freed_by_each = freed_by_each
+        self.delay = delay
+        self.pruned = []
+
+    def measure(self):
+        free = self.free
+        for when in self.pruned:
+            if self.clock.time() - when >= self.delay:
+                free += self.freed_by_each
+        return Space(10 * GiB, free)
+
+    def prune(self, snapshot, timeout):
+        self.pruned.append(self.clock.time())
+        self.clock.sleep(min(self.delay, timeout))
+
+
+@mock.patch('sys.stdout', new=mock.Mock())
+class TestSpaceGuard(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.candidates = [FakeSnapshot("c", 3), FakeSnapshot("a", 1),
+                           FakeSnapshot("b", 2)]
+
+    def guard(self, **kwargs):
+        return SpaceGuard(clock=self.clock.time, sleep=self.clock.sleep,
+                          **kwargs)
+
+    def test_parse_threshold(self):
+        self.assertEqual(parse_threshold("1G"), (GiB, 0))
+        self.assertEqual(parse_threshold("1.5k"), (1536, 0))
+        self.assertEqual(parse_threshold("4096"), (4096, 0))
+        self.assertEqual(parse_threshold("5%"), (0, 5.0))
+        self.assertRaises(ValueError, parse_threshold, "lots")
+        with self.assertRaisesRegexp(Exception, "Invalid free space"):
+            SpaceGuard(min_free="lots")
+        with self.assertRaisesRegexp(Exception, "Unknown action"):
+            SpaceGuard(action="panic")
+
+    def test_shortfall(self):
+        guard = self.guard(min_free="10%")
+        self.assertEqual(guard.threshold(Space(10 * GiB, 0)), GiB)
+        self.assertEqual(guard.shortfall(Space(10 * GiB, 2 * GiB)), None)
+        self.assertEqual(guard.shortfall(Space(10 * GiB, GiB // 2)),
+                         "512.0 MiB free, 1.0 GiB wanted")
+        self.assertEqual(guard.shortfall(Space(10 * GiB, 2 * GiB, 0, 1024)),
+                         "1.0 KiB left for metadata")
+
+    def test_admit_with_room(self):
+        volume = FakeVolume(self.clock, 2 * GiB, GiB)
+        self.assertTrue(self.guard().admit(volume.measure, self.candidates,
+                                           volume.prune))
+        self.assertEqual(volume.pruned, [])
+
+    def test_prunes_oldest_first(self):
+        volume = FakeVolume(self.clock, 0, GiB // 2)
+        pruned = []
+
+        def prune(snapshot, timeout):
+            pruned.append(snapshot.name)
+            volume.prune(snapshot, timeout)
+
+        self.assertTrue(self.guard().admit(volume.measure, self.candidates,
+                                           prune))
+        self.assertEqual(pruned, ["a", "b"])
+
+    def test_refuse(self):
+        volume = FakeVolume(self.clock, 0, GiB)
+        self.assertFalse(self.guard(action="refuse").admit(
+            volume.measure, self.candidates, volume.prune))
+        self.assertEqual(volume.pruned, [])
+
+    def test_budget(self):
+        # the space never comes back in time
+        volume = FakeVolume(self.clock, 0, GiB, delay=100)
+        self.assertFalse(self.guard(budget=5).admit(
+            volume.measure, self.candidates, volume.prune))
+        # the cleaner is waited for until the time is up, no more is pruned
+        self.assertEqual(volume.pruned, [0])
+        self.assertEqual(self.clock.time(), 5)
+
+    def test_waits_for_the_cleaner(self):
+        # the first snapshot frees enough, though not within the settle time
+        volume = FakeVolume(self.clock, 0, 2 * GiB, delay=3)
+        self.assertTrue(self.guard(budget=20).admit(
+            volume.measure, self.candidates, volume.prune))
+        self.assertEqual(volume.pruned, [0])
+
+
+class TestMeasure(unittest.TestCase):
+
+    @mock.patch('os.statvfs')
+    def test_measure(self, mock_statvfs):
+        mock_statvfs.return_value = mock.Mock(f_blocks=100, f_bavail=40,
+                                              f_frsize=4096)
+        commands = mock.Mock()
+        commands.btrfs_space.return_value = (8192, 1024)
+        space = measure("/mp", commands)
+        self.assertEqual((space.total, space.free), (409600, 163840))
+        self.assertEqual((space.unallocated, space.metadata), (8192, 1024))
+        commands.btrfs_space.return_value = None
+        self.assertEqual(measure("/mp", commands).metadata, None)
+
+    @mock.patch('subprocess.check_output')
+    def test_read_space_config(self, mock_output):
+        mock_output.return_value = (b'APT::Snapshots::MinFree "5%";\n'
+                                    b'APT::Snapshots::PruneBudget "10";\n')
+        self.assertEqual(read_space_config(),
+                         {"min_free": "5%", "budget": "10"})
+        self.assertEqual(read_space_config(
+            [("APT::Snapshots::OnLowSpace", "refuse")]), {"action": "refuse"})
+        mock_output.side_effect = OSError(2, "apt-config")
+        self.assertEqual(read_space_config(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, unicode_literals
+
+try:
+    from StringIO import StringIO
+    StringIO  # pyflakes
+except ImportError:
+    from io import StringIO
+import datetime
+import errno
+import mock
+import os
+import shutil
+import sys
+import unittest
+
+sys.path.insert(0, "..")
+sys.path.insert(0, ".")
+import snapshots
+from apt_btrfs_snapshot import AptBtrfsSnapshot
+from journal import (
+    JOURNAL,
+    Journal,
+)
+from metrics import (
+    HISTORY_FILE,
+    RunHistory,
+)
+from sizes import (
+    SIZES_FILE,
+    SizeCache,
+)
+from snapshots import (
+    PARENT_LINK,
+    SNAP_PREFIX,
+    Snapshot,
+)
+from storage import (
+    DiskStorage,
+    MemoryStorage,
+)
+
+
+class TestMemoryStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = MemoryStorage("/mp")
+        self.storage.makedirs("/mp/@/etc")
+        self.storage.write("/mp/@/etc/file", "data")
+
+    def test_files(self):
+        storage = self.storage
+        self.assertEqual(storage.read("/mp/@/etc/file"), b"data")
+        self.assertEqual(sorted(storage.listdir("/mp")), ["@"])
+        self.assertTrue(storage.isdir("/mp/@/etc"))
+        self.assertFalse(storage.isdir("/mp/@/etc/file"))
+        storage.symlink("../../@x", "/mp/@/etc/link")
+        self.assertEqual(storage.readlink("/mp/@/etc/link"), "../../@x")
+        self.assertTrue(storage.lexists("/mp/@/etc/link"))
+        storage.remove("/mp/@/etc/link")
+        self.assertFalse(storage.lexists("/mp/@/etc/link"))
+        with self.assertRaises(IOError) as cm:
+            storage.read("/mp/@/etc/missing")
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        with self.assertRaises(OSError) as cm:
+            storage.rmdir("/mp/@/etc")
+        self.assertEqual(cm.exception.errno, errno.ENOTEMPTY)
+        with self.assertRaises(OSError) as cm:
+            storage.makedirs("/mp/@/etc")
+        self.assertEqual(cm.exception.errno, errno.EEXIST)
+        storage.rename("/mp/@/etc", "/mp/etc")
+        self.assertEqual(storage.read("/mp/etc/file"), b"data")
+        storage.append("/mp/etc/file", " more")
+        storage.append("/mp/etc/new", "new")
+        self.assertEqual(storage.read("/mp/etc/file"), b"data more")
+        self.assertEqual(storage.read("/mp/etc/new"), b"new")
+
+    def test_subvolumes(self):
+        storage = self.storage
+        self.assertTrue(storage.snapshot("/mp/@", "/mp/@ro", readonly=True))
+        self.assertFalse(storage.snapshot("/mp/@", "/mp/@ro"))
+        self.assertFalse(storage.snapshot("/mp/@missing", "/mp/@x"))
+        # a copy, not the same files
+        storage.write("/mp/@/etc/file", "changed")
+        self.assertEqual(storage.read("/mp/@ro/etc/file"), b"data")
+        with self.assertRaises(IOError) as cm:
+            storage.write("/mp/@ro/etc/file", "changed")
+        self.assertEqual(cm.exception.errno, errno.EROFS)
+        # but it can be renamed and deleted
+        storage.rename("/mp/@ro", "/mp/@ro2")
+        self.assertTrue(storage.delete("/mp/@ro2"))
+        self.assertFalse(storage.delete("/mp/@ro2"))
+
+    def test_costs(self):
+        storage = MemoryStorage("/mp", costs={"write": 0.5, "stat": 0.1})
+        storage.mkdir("/mp/@")
+        storage.write("/mp/@/a", "1")
+        storage.write("/mp/@/b", "2")
+        storage.isdir("/mp/@")
+        self.assertEqual(storage.ops, {"mkdir": 1, "write": 2, "stat": 1})
+        self.assertAlmostEqual(storage.charged, 1.1)
+        storage.reset()
+        self.assertEqual((storage.ops, storage.charged), ({}, 0.0))
+
+
+@mock.patch('sys.stdout', new_callable=StringIO)
+class TestSimulatedVolume(unittest.TestCase):
+    """ the same commands on a copy of the model volume on disk and in
+        memory give the same results
+    """
+
+    def setUp(self):
+        self.testdir = os.path.dirname(os.path.abspath(__file__))
+        self.fstab = os.path.join(self.testdir, "data", "fstab")
+        model_root = os.path.join(self.testdir, "data", "model_root")
+        self.sandbox = os.path.join(self.testdir, "data", "root3")
+        if os.path.exists(self.sandbox):
+            shutil.rmtree(self.sandbox)
+        shutil.copytree(model_root, self.sandbox, symlinks=True)
+        self.memory = MemoryStorage()
+        self.memory.load(model_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.sandbox)
+
+    def run_both(self, command, stdout):
+        outputs = []
+        for sandbox, storage in ((self.sandbox, DiskStorage()),
+                                 (None, self.memory)):
+            apt_btrfs = AptBtrfsSnapshot(fstab=self.fstab, sandbox=sandbox,
+                                         storage=storage)
+            stdout.truncate(0)
+            command(apt_btrfs)
+            apt_btrfs.reload()
+            outputs.append((stdout.getvalue(),
+                            sorted(s.name for s in snapshots.get_list()),
+                            dict((s.name, str(s.parent))
+                                 for s in snapshots.get_list())))
+        return outputs
+
+    def test_tree(self, stdout):
+        disk, memory = self.run_both(lambda a: a.tree(), stdout)
+        self.assertEqual(disk, memory)
+        self.assertIn(SNAP_PREFIX + "2013-08-06_13:26:30", memory[0])
+
+    def test_delete_older_than(self, stdout):
+        disk, memory = self.run_both(
+            lambda a: a.delete_older_than(datetime.datetime(2013, 8, 6)),
+            stdout)
+        self.assertEqual(disk[1:], memory[1:])
+        self.assertNotIn(SNAP_PREFIX + "2013-08-05_04:30:58", memory[1])
+
+    def test_create_and_reclaim(self, stdout):
+        apt_btrfs = AptBtrfsSnapshot(fstab=self.fstab, storage=self.memory)
+        parent = Snapshot("@").parent
+        self.assertTrue(apt_btrfs.create("-simulated"))
+        apt_btrfs.reload()
+        new = Snapshot("@").parent
+        self.assertTrue(new.name.endswith("-simulated"))
+        self.assertEqual(new.parent, parent)
+        self.assertTrue(self.memory.lexists(
+            os.path.join(self.memory.mp, new.name, PARENT_LINK)))
+        self.assertFalse(os.path.exists(self.memory.mp))
+        self.memory.reset()
+        apt_btrfs.delete(new.name)
+        self.assertTrue(apt_btrfs.reclaim())
+        self.assertEqual(self.memory.ops["delete"], 1)
+        apt_btrfs.reload()
+        self.assertEqual(Snapshot("@").parent, parent)
+
+    def test_state_in_memory(self, stdout):
+        mp = self.memory.mp
+        self.memory.mkdir(os.path.join(mp, "@home"))
+        apt_btrfs = AptBtrfsSnapshot(fstab=self.fstab, storage=self.memory,
+                                     group=["@home"])
+        journal = Journal(os.path.join(mp, "@"), self.memory)
+        journal.record([])
+        journal.mark(Snapshot("@").parent.name)
+        journal.record([("install", "zsh", "<none>", "5.0-1")])
+        self.assertTrue(apt_btrfs.create("-journal"))
+        apt_btrfs.record_run("create", 1.5, True)
+        apt_btrfs.reload()
+        new = Snapshot("@").parent
+        # the journal went along with the snapshot and gave its changes
+        self.assertTrue(self.memory.lexists(os.path.join(mp, new.name,
+                                                         JOURNAL)))
+        self.assertEqual(new.changes["install"], [("zsh", "5.0-1")])
+        self.assertEqual(apt_btrfs.group.members_of(new.name), ["@home"])
+        history = RunHistory(os.path.join(mp, HISTORY_FILE), self.memory)
+        self.assertEqual(history.commands["create"]["success"], 1)
+        cache = SizeCache(os.path.join(mp, SIZES_FILE), [new.name],
+                          self.memory)
+        cache.put(new.name, "u:1", (1, 2))
+        cache.save()
+        self.assertEqual(SizeCache(os.path.join(mp, SIZES_FILE), [new.name],
+                                   self.memory).get(new.name, "u:1"), (1, 2))
+        # none of it touched the disk
+        self.assertFalse(os.path.exists(mp))
+        self.assertTrue(self.memory.ops["append"] >= 2)
+
+
+if __name__ == "__main__":
+    unittest.main()